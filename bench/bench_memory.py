@@ -0,0 +1,166 @@
+"""Тест потребления памяти при создании списков из 100, 1000 и 5000 фильмов.
+
+Каждый размер списка выполняется в отдельном процессе (чтобы RSS не зависел от предыдущих замеров)
+с включенным tracemalloc на тестовом сервере Kinopoisk API (fake_kinopoisk.py). Для этапов поиск ->
+загрузка информации -> запись docx записываются пик памяти Python (tracemalloc), память, оставшаяся
+после этапа, RSS и пиковый RSS процесса, а также показатели этапов из kinolist_metrics
+(kinolist_stage_traced_peak_bytes, kinolist_stage_rss_bytes).
+
+Результаты сравниваются с бюджетом из memory_budget.json (МБ): превышение - код завершения 1.
+Бюджет получен на тестовом сервере в Linux (запас 30%); при запуске в CI (переменная окружения CI)
+отсутствие memory_budget.json - тоже ошибка.
+
+Запуск из корня репозитория:
+    python bench/bench_memory.py                    -- проверка бюджета
+    python bench/bench_memory.py --sizes 100 1000
+    python bench/bench_memory.py --update           -- записывает текущие значения (с запасом) в memory_budget.json
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH)
+BUDGET_FILE = os.path.join(BENCH, "memory_budget.json")
+STEPS = ["search", "fetch", "render"]
+HEADROOM = 1.3  # запас при --update
+MB = 1024 * 1024
+
+
+def run_child(size: int, workdir: str) -> dict:
+    """Замер в текущем процессе (--child): адрес тестового сервера - в KINOPOISK_URL."""
+    import tracemalloc
+    tracemalloc.start()
+    sys.path.insert(0, ROOT)
+    os.environ.setdefault("TQDM_DISABLE", "1")
+    import kinolist_api
+    import kinolist_lib
+    from kinolist_metrics import STAGE_RSS, STAGE_TRACED_PEAK, peak_rss, reset_memory_stages, rss
+    from kinolist_storage import open_backend
+
+    backend = open_backend(os.path.join(workdir, f"state-{size}.db"))
+    kinolist_lib.set_cache_backend(backend)
+    kinolist_api.rate_limiter = kinolist_api.RateLimiter(10 ** 6)
+    api = kinolist_api.ApiKeyPool([f"memory-{size}"], daily_quota=10 ** 9)
+    titles = [f"Фильм {i}" for i in range(1, size + 1)]
+    output = os.path.join(workdir, f"list-{size}.docx")
+    data = {}
+
+    def search():
+        data["codes"] = kinolist_lib.find_kp_id(titles, api)[0]
+
+    def fetch():
+        data["films"] = kinolist_lib.get_full_film_list(data.pop("codes"), api)
+
+    def render():
+        document = kinolist_lib.load_template(os.path.join(ROOT, "template.docx"))
+        kinolist_lib.write_all_films_to_docx(document, data["films"], output)
+
+    result = {"steps": {}}
+    for name, function in zip(STEPS, (search, fetch, render)):
+        reset_memory_stages()
+        tracemalloc.reset_peak()
+        start = time.perf_counter()
+        function()
+        current, peak = tracemalloc.get_traced_memory()
+        result["steps"][name] = {
+            "seconds": round(time.perf_counter() - start, 3),
+            "traced_peak": peak,
+            "traced_current": current,
+            "rss": rss(),
+            "peak_rss": peak_rss(),
+            "stages": {key[0]: {"traced_peak": traced, "rss": STAGE_RSS.values().get(key, 0)}
+                       for key, traced in STAGE_TRACED_PEAK.values().items()},
+        }
+    result["traced_peak"] = max(step["traced_peak"] for step in result["steps"].values())
+    result["peak_rss"] = peak_rss()
+    result["output_bytes"] = os.path.getsize(output)
+    backend.close()
+    return result
+
+
+def measure(size: int, url: str, workdir: str) -> dict:
+    env = dict(os.environ, KINOPOISK_URL=url, TQDM_DISABLE="1")
+    process = subprocess.run([sys.executable, os.path.abspath(__file__), "--child", str(size), "--workdir", workdir],
+                             cwd=ROOT, env=env, capture_output=True, text=True)
+    if process.returncode != 0:
+        raise RuntimeError(f"Замер для {size} фильмов завершился ошибкой:\n{process.stderr.strip()[-3000:]}")
+    return json.loads(process.stdout.strip().splitlines()[-1])
+
+
+def check(results: dict, budget: dict) -> list:
+    """Превышения бюджета: (размер, показатель, бюджет МБ, значение МБ)."""
+    exceeded = []
+    for size, result in results.items():
+        for key, limit in budget.get(size, {}).items():
+            value = result.get(key)
+            if value is not None and value / MB > limit:
+                exceeded.append((size, key, limit, value / MB))
+    return exceeded
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Тест потребления памяти при создании списков")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 5000], help="количество фильмов в списках")
+    parser.add_argument("--update", action="store_true", help="обновляет memory_budget.json")
+    parser.add_argument("--json", metavar="FILE", help="сохраняет результаты в FILE")
+    parser.add_argument("--child", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--workdir", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(run_child(args.child, args.workdir)))
+        return 0
+
+    sys.path.insert(0, BENCH)
+    from fake_kinopoisk import FakeKinopoisk, start_server
+
+    server = start_server(FakeKinopoisk())
+    workdir = tempfile.mkdtemp(prefix="kinolist-memory-")
+    results = {}
+    try:
+        for size in args.sizes:
+            result = measure(size, server.url, workdir)
+            results[str(size)] = result
+            steps = "  ".join(f"{name} {step['traced_peak'] / MB:7.1f}/{step['rss'] / MB:7.1f}"
+                              for name, step in result["steps"].items())
+            print(f"{size:5d} фильмов: {steps}  пик Python {result['traced_peak'] / MB:7.1f} МБ  "
+                  f"пик RSS {result['peak_rss'] / MB:7.1f} МБ  docx {result['output_bytes'] / MB:.1f} МБ")
+            for name, step in result["steps"].items():
+                stages = "  ".join(f"{stage} {values['traced_peak'] / MB:.1f}"
+                                   for stage, values in sorted(step["stages"].items()))
+                if stages:
+                    print(" " * 15 + f"{name}: {stages}")
+    finally:
+        server.shutdown()
+        shutil.rmtree(workdir, ignore_errors=True)
+    print("(этап: пик памяти Python/RSS после этапа, МБ)")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=4)
+    if args.update:
+        with open(BUDGET_FILE, "w", encoding="utf-8") as f:
+            json.dump({size: {key: round(result[key] / MB * HEADROOM, 1) for key in ("traced_peak", "peak_rss")}
+                       for size, result in results.items()}, f, indent=4)
+            f.write("\n")
+        print(f"Бюджет сохранен в {BUDGET_FILE}")
+        return 0
+    if not os.path.exists(BUDGET_FILE):
+        print("Нет memory_budget.json, проверка не выполнена (см. --update).")
+        return 1 if os.environ.get("CI") else 0
+    with open(BUDGET_FILE, encoding="utf-8") as f:
+        budget = json.load(f)
+    exceeded = check(results, budget)
+    for size, key, limit, value in exceeded:
+        print(f"Превышен бюджет: {size} фильмов, {key}: {value:.1f} МБ > {limit:.1f} МБ")
+    return 1 if exceeded else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
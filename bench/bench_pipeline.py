@@ -0,0 +1,162 @@
+"""Тест производительности полного цикла создания списка на тестовом сервере Kinopoisk API.
+
+Для списков из 1, 10, 100 и 1000 фильмов выполняются этапы поиск -> загрузка информации ->
+запись docx -> конвертация в pdf (если установлен Libre Office) с пустым кэшем.
+Выводятся длительности этапов и сумма по этапам метрик (kinolist_metrics: поиск, загрузка постеров и т.д.).
+Результаты сравниваются с baseline.json: этап, выполнявшийся дольше базового значения больше чем
+на --tolerance (и больше чем на 50 мс), считается регрессией (код завершения 1). Базовые значения
+получены на тестовом сервере без задержки и без Libre Office; при запуске в CI (переменная окружения CI)
+отсутствие baseline.json - тоже ошибка.
+
+Запуск из корня репозитория:
+    python bench/bench_pipeline.py                         -- сравнение с baseline.json
+    python bench/bench_pipeline.py --sizes 1 10 --latency 50
+    python bench/bench_pipeline.py --save-baseline         -- сохраняет результаты в baseline.json
+"""
+import argparse
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.environ.setdefault("TQDM_DISABLE", "1")
+
+import kinolist_api  # noqa: E402
+import kinolist_lib  # noqa: E402
+from kinolist_metrics import STAGE_SECONDS  # noqa: E402
+from kinolist_storage import open_backend  # noqa: E402
+from fake_kinopoisk import FakeKinopoisk, start_server  # noqa: E402
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+NOISE_FLOOR = 0.05  # c
+STEPS = ["search", "fetch", "render", "convert"]
+
+
+def stage_totals() -> dict:
+    return {key[0]: total for key, (_count, total) in STAGE_SECONDS.totals().items()}
+
+
+def run_pipeline(size: int, workdir: str) -> dict:
+    """Полный цикл для списка из size фильмов с пустым кэшем. Возвращает длительности этапов, с."""
+    state = os.path.join(workdir, f"state-{size}.db")
+    backend = open_backend(state)
+    kinolist_lib.set_cache_backend(backend)
+    api = kinolist_api.ApiKeyPool([f"bench-{size}"], daily_quota=10 ** 9)
+    titles = [f"Фильм {i}" for i in range(1, size + 1)]
+    output = os.path.join(workdir, f"list-{size}.docx")
+    stages_before = stage_totals()
+    result = {}
+
+    start = time.perf_counter()
+    film_codes, not_found = kinolist_lib.find_kp_id(titles, api)
+    result["search"] = time.perf_counter() - start
+    if not_found:
+        logging.warning(f"Не найдено фильмов: {len(not_found)}")
+
+    start = time.perf_counter()
+    films = kinolist_lib.get_full_film_list(film_codes, api)
+    result["fetch"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    document = kinolist_lib.load_template(os.path.join(ROOT, "template.docx"))
+    kinolist_lib.write_all_films_to_docx(document, films, output)
+    result["render"] = time.perf_counter() - start
+
+    if shutil.which("soffice") or shutil.which("libreoffice") or sys.platform == "win32":
+        start = time.perf_counter()
+        code = kinolist_lib.docx_to_pdf_libre(output)
+        result["convert"] = time.perf_counter() - start if code == 0 else None
+    else:
+        result["convert"] = None
+
+    result["total"] = sum(value for value in result.values() if value)
+    stages_after = stage_totals()
+    result["stages"] = {name: round(total - stages_before.get(name, 0.0), 4) for name, total in stages_after.items()
+                        if total - stages_before.get(name, 0.0) > 0}
+    result["output_bytes"] = os.path.getsize(output)
+    backend.close()
+    return result
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    """Список регрессий: (размер, этап, базовое значение, текущее значение)."""
+    regressions = []
+    for size, result in results.items():
+        base = baseline.get(size)
+        if not base:
+            continue
+        for step in STEPS + ["total"]:
+            current, previous = result.get(step), base.get(step)
+            if current is None or previous is None:
+                continue
+            if current > previous * (1 + tolerance) and current - previous > NOISE_FLOOR:
+                regressions.append((size, step, previous, current))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Тест производительности создания списков на тестовом сервере")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1, 10, 100, 1000], help="количество фильмов в списках")
+    parser.add_argument("--latency", type=float, default=0.0, help="задержка ответа сервера, мс")
+    parser.add_argument("--jitter", type=float, default=0.0, help="случайная добавка к задержке, мс")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="доля ответов 500")
+    parser.add_argument("--rate-limit", type=float, default=0.0, help="доля ответов 429")
+    parser.add_argument("--rps", type=float, default=0,
+                        help="ограничение частоты запросов клиента (по умолчанию без ограничения, в работе - 10)")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="допустимое замедление относительно baseline.json")
+    parser.add_argument("--save-baseline", action="store_true", help="сохраняет результаты в baseline.json")
+    parser.add_argument("--json", metavar="FILE", help="сохраняет результаты в FILE")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING, format='[%(asctime)s]%(levelname)s:%(name)s:%(message)s', datefmt='%d.%m.%Y %H:%M:%S')
+
+    fake = FakeKinopoisk(latency=args.latency / 1000, jitter=args.jitter / 1000, error_rate=args.error_rate,
+                         rate_limit=args.rate_limit)
+    server = start_server(fake)
+    kinolist_api.KINOPOISK_URL = server.url
+    kinolist_api.rate_limiter = kinolist_api.RateLimiter(args.rps or 10 ** 6)
+
+    results = {}
+    workdir = tempfile.mkdtemp(prefix="kinolist-bench-")
+    try:
+        for size in args.sizes:
+            requests_before = fake.requests
+            result = run_pipeline(size, workdir)
+            result["requests"] = fake.requests - requests_before
+            results[str(size)] = result
+            steps = "  ".join(f"{step} {result[step]:7.2f} с" if result[step] is not None else f"{step}       -"
+                              for step in STEPS)
+            print(f"{size:5d} фильмов: {steps}  всего {result['total']:7.2f} с  запросов {result['requests']}")
+            print(" " * 14 + "  ".join(f"{name} {total:.2f}" for name, total in sorted(result["stages"].items())))
+    finally:
+        server.shutdown()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=4)
+    if args.save_baseline:
+        with open(BASELINE_FILE, "w", encoding="utf-8") as f:
+            json.dump({size: {step: round(result[step], 3) if result[step] is not None else None for step in STEPS + ["total"]}
+                       for size, result in results.items()}, f, indent=4)
+            f.write("\n")
+        print(f"Базовые значения сохранены в {BASELINE_FILE}")
+        return 0
+    if not os.path.exists(BASELINE_FILE):
+        print("Нет baseline.json, сравнение не выполнено (см. --save-baseline).")
+        return 1 if os.environ.get("CI") else 0
+    with open(BASELINE_FILE, encoding="utf-8") as f:
+        baseline = json.load(f)
+    regressions = compare(results, baseline, args.tolerance)
+    for size, step, previous, current in regressions:
+        print(f"Регрессия: {size} фильмов, {step}: {previous:.2f} с -> {current:.2f} с")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,199 @@
+"""Локальный сервер, заменяющий Kinopoisk API для тестов производительности.
+
+Отвечает на запросы поиска (/api/v2.1/films/search-by-keyword), информации о фильме (/api/v2.2/films/ID),
+списка съемочной группы (/api/v1/staff), лимитов ключа (/api/v1/api_keys/KEY) и постеров (/images/posters/ID.jpg).
+Ответы берутся из файла с записанными ответами API (--fixtures) или создаются по шаблону: фильм с id N
+называется "Фильм N" и находится поиском по этому названию. Постер - no_poster.jpg из репозитория.
+
+Задержка, разброс, доля ошибок 500 и ответов 429 настраиваются.
+
+    python bench/fake_kinopoisk.py --port 8765 --latency 50 --jitter 20 --error-rate 0.01 --rate-limit 0.02
+    KINOPOISK_URL=http://127.0.0.1:8765 kl -m "Фильм 1" "Фильм 2"
+
+Формат файла --fixtures (json): {"search": {"ключевое слово": ответ}, "films": {"id": ответ}, "staff": {"id": ответ}}
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+log = logging.getLogger("FakeKinopoisk")
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+GENRES = ["драма", "комедия", "фантастика", "боевик", "триллер", "мультфильм", "ужасы", "мелодрама"]
+COUNTRIES = ["США", "СССР", "Россия", "Франция", "Великобритания", "Япония"]
+
+
+class FakeKinopoisk:
+    """Данные и параметры сервера.
+
+    Args:
+        fixtures (dict, optional): записанные ответы API
+        latency (float): задержка ответа, с
+        jitter (float): случайная добавка к задержке (от 0 до jitter), с
+        error_rate (float): доля ответов 500
+        rate_limit (float): доля ответов 429 (с заголовком Retry-After)
+        seed (int): начальное значение генератора случайных чисел
+    """
+
+    def __init__(self, fixtures: dict = None, latency: float = 0.0, jitter: float = 0.0, error_rate: float = 0.0,
+                 rate_limit: float = 0.0, seed: int = 0):
+        self.fixtures = fixtures or {}
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.random = random.Random(seed)
+        self.requests = 0
+        self._lock = threading.Lock()
+        with open(os.path.join(ROOT, "no_poster.jpg"), "rb") as f:
+            self.poster = f.read()
+
+    def film(self, film_id: int) -> dict:
+        recorded = self.fixtures.get("films", {}).get(str(film_id))
+        if recorded:
+            return recorded
+        rnd = random.Random(film_id)
+        return {
+            "kinopoiskId": film_id,
+            "nameRu": f"Фильм {film_id}",
+            "nameOriginal": f"Film {film_id}",
+            "nameEn": f"Film {film_id}",
+            "year": 1950 + film_id % 75,
+            "ratingKinopoisk": round(rnd.uniform(5, 9), 1),
+            "countries": [{"country": country} for country in rnd.sample(COUNTRIES, rnd.randint(1, 2))],
+            "genres": [{"genre": genre} for genre in rnd.sample(GENRES, rnd.randint(1, 3))],
+            "description": " ".join(f"Описание фильма {film_id}, предложение {i}." for i in range(rnd.randint(5, 30))),
+            "posterUrl": f"/images/posters/{film_id}.jpg",
+            "posterUrlPreview": f"/images/posters/{film_id}.jpg",
+        }
+
+    def staff(self, film_id: int) -> list:
+        recorded = self.fixtures.get("staff", {}).get(str(film_id))
+        if recorded:
+            return recorded
+        staff = [{"professionText": "Режиссеры", "nameRu": f"Режиссер {film_id}", "nameEn": f"Director {film_id}"}]
+        staff += [{"professionText": "Актеры", "nameRu": f"Актер {film_id}-{i}", "nameEn": f"Actor {film_id}-{i}"}
+                  for i in range(20)]
+        return staff
+
+    def search(self, keyword: str) -> dict:
+        recorded = self.fixtures.get("search", {}).get(keyword)
+        if recorded:
+            return recorded
+        match = re.search(r"(\d+)", keyword)
+        if not match or "не найден" in keyword:
+            return {"keyword": keyword, "pagesCount": 0, "searchFilmsCountResult": 0, "films": []}
+        film = self.film(int(match.group(1)))
+        return {"keyword": keyword, "pagesCount": 1, "searchFilmsCountResult": 1, "films": [{
+            "filmId": film["kinopoiskId"], "nameRu": film["nameRu"], "nameEn": film["nameEn"], "year": str(film["year"]),
+        }]}
+
+    def fault(self):
+        """Случайная ошибка: (код, заголовки) или None."""
+        with self._lock:
+            self.requests += 1
+            value = self.random.random()
+            delay = self.latency + self.random.uniform(0, self.jitter)
+        if delay:
+            time.sleep(delay)
+        if value < self.rate_limit:
+            return 429, {"Retry-After": "1"}
+        if value < self.rate_limit + self.error_rate:
+            return 500, {}
+        return None
+
+
+def make_handler(api: FakeKinopoisk):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        # заголовки и тело ответа пишутся отдельно: без TCP_NODELAY каждый ответ ждет delayed ACK (~40 мс)
+        disable_nagle_algorithm = True
+
+        def send(self, status: int, body: bytes, content_type: str = "application/json", headers: dict = None):
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def send_json(self, data):
+            self.send(200, json.dumps(data, ensure_ascii=False).encode())
+
+        def do_GET(self):
+            url = urlsplit(self.path)
+            query = parse_qs(url.query)
+            fault = api.fault()
+            if fault:
+                status, headers = fault
+                self.send(status, json.dumps({"message": "fake error"}).encode(), headers=headers)
+                return
+            match = re.fullmatch(r"/api/v2\.2/films/(\d+)", url.path)
+            if match:
+                film = dict(api.film(int(match.group(1))))
+                host = f"http://{self.headers.get('Host')}"
+                for key in ("posterUrl", "posterUrlPreview"):
+                    if film[key].startswith("/"):
+                        film[key] = host + film[key]
+                self.send_json(film)
+            elif url.path == "/api/v1/staff":
+                self.send_json(api.staff(int(query["filmId"][0])))
+            elif url.path == "/api/v2.1/films/search-by-keyword":
+                self.send_json(api.search(query.get("keyword", [""])[0]))
+            elif url.path.startswith("/api/v1/api_keys/"):
+                self.send_json({"dailyQuota": {"value": 10 ** 6, "used": api.requests}})
+            elif url.path.startswith("/images/posters/"):
+                self.send(200, api.poster, "image/jpeg")
+            else:
+                self.send(404, b'{"message": "not found"}')
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def start_server(api: FakeKinopoisk, port: int = 0, host: str = "127.0.0.1") -> ThreadingHTTPServer:
+    """Запускает сервер в фоновом потоке (port=0 - свободный порт). Адрес: server.url"""
+    server = ThreadingHTTPServer((host, port), make_handler(api))
+    server.daemon_threads = True
+    server.url = f"http://{host}:{server.server_address[1]}"
+    threading.Thread(target=server.serve_forever, name="fake-kinopoisk", daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Локальный сервер, заменяющий Kinopoisk API")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--fixtures", help="файл с записанными ответами API (json)")
+    parser.add_argument("--latency", type=float, default=0.0, help="задержка ответа, мс")
+    parser.add_argument("--jitter", type=float, default=0.0, help="случайная добавка к задержке, мс")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="доля ответов 500 (от 0 до 1)")
+    parser.add_argument("--rate-limit", type=float, default=0.0, help="доля ответов 429 (от 0 до 1)")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='[%(asctime)s]%(levelname)s:%(name)s:%(message)s', datefmt='%d.%m.%Y %H:%M:%S')
+
+    fixtures = None
+    if args.fixtures:
+        with open(args.fixtures, encoding="utf-8") as f:
+            fixtures = json.load(f)
+    api = FakeKinopoisk(fixtures, args.latency / 1000, args.jitter / 1000, args.error_rate, args.rate_limit, args.seed)
+    server = start_server(api, args.port)
+    log.info(f"Сервер запущен: {server.url}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+"""Локальный сервер, заменяющий Telegram Bot API для нагрузочного тестирования бота.
+
+Поддерживаются getMe, getUpdates (long polling), getWebhookInfo, deleteWebhook, sendMessage, sendDocument, sendPhoto,
+sendSticker, editMessageText и answerCallbackQuery; на остальные методы сервер отвечает {"ok": true}.
+Сообщения пользователей добавляются в очередь обновлений методом FakeTelegram.send_text,
+сообщения бота передаются обработчику on_bot_message (например, для измерения задержки ответа).
+
+Бот подключается к серверу параметром --api-server (kinolist_bot.py --api-server http://127.0.0.1:PORT).
+"""
+import email
+import email.policy
+import itertools
+import json
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+log = logging.getLogger("FakeTelegram")
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "Kinolist", "username": "kinolist_test_bot"}
+
+
+class FakeTelegram:
+    """Очередь обновлений и учет сообщений бота.
+
+    Args:
+        on_bot_message (callable, optional): вызывается для каждого сообщения бота:
+            on_bot_message(chat_id, method, fields, timestamp)
+    """
+
+    def __init__(self, on_bot_message=None):
+        self.on_bot_message = on_bot_message
+        self.updates = []
+        self.calls = {}
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._condition = threading.Condition()
+
+    def send_text(self, chat_id: int, text: str) -> int:
+        """Сообщение пользователя chat_id боту. Возвращает update_id."""
+        message = self._message(chat_id, text, {"id": chat_id, "is_bot": False, "first_name": f"User {chat_id}"})
+        if text.startswith("/"):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        with self._condition:
+            update_id = next(self._update_ids)
+            self.updates.append({"update_id": update_id, "message": message})
+            self._condition.notify_all()
+        return update_id
+
+    def _message(self, chat_id: int, text: str = None, sender: dict = None) -> dict:
+        message = {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private", "first_name": f"User {chat_id}"},
+            "from": sender or BOT_USER,
+        }
+        if text is not None:
+            message["text"] = text
+        return message
+
+    def get_updates(self, offset: int = 0, limit: int = 100, timeout: float = 0) -> list:
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            if offset < 0:
+                self.updates = self.updates[offset:]
+            elif offset:
+                self.updates = [update for update in self.updates if update["update_id"] >= offset]
+            while not self.updates and time.monotonic() < deadline:
+                self._condition.wait(deadline - time.monotonic())
+            return self.updates[:limit]
+
+    def call(self, method: str, fields: dict):
+        """Обработка вызова метода Bot API. Возвращает поле result ответа."""
+        now = time.time()
+        self.calls[method] = self.calls.get(method, 0) + 1
+        if method == "getMe":
+            return BOT_USER
+        if method == "getWebhookInfo":
+            return {"url": "", "has_custom_certificate": False, "pending_update_count": len(self.updates)}
+        if method == "getUpdates":
+            return self.get_updates(int(fields.get("offset", 0) or 0), int(fields.get("limit", 100) or 100),
+                                    float(fields.get("timeout", 0) or 0))
+        if method in ("sendMessage", "sendDocument", "sendPhoto", "sendSticker", "editMessageText"):
+            chat_id = int(fields.get("chat_id", 0))
+            if self.on_bot_message is not None:
+                self.on_bot_message(chat_id, method, fields, now)
+            message = self._message(chat_id, fields.get("text"))
+            if method == "sendDocument":
+                message["document"] = {"file_id": f"doc{message['message_id']}", "file_unique_id": f"u{message['message_id']}"}
+            if method == "sendPhoto":
+                message["photo"] = [{"file_id": f"photo{message['message_id']}", "file_unique_id": f"u{message['message_id']}",
+                                     "width": 360, "height": 540}]
+            if "caption" in fields:
+                message["caption"] = fields["caption"]
+            return message
+        return True
+
+
+def parse_fields(content_type: str, body: bytes) -> dict:
+    """Параметры запроса: json, application/x-www-form-urlencoded или multipart/form-data (файлы пропускаются)."""
+    if content_type.startswith("application/json"):
+        return json.loads(body or b"{}")
+    if content_type.startswith("multipart/form-data"):
+        message = email.message_from_bytes(b"Content-Type: " + content_type.encode() + b"\r\n\r\n" + body,
+                                           policy=email.policy.HTTP)
+        fields = {}
+        for part in message.iter_parts():
+            if part.get_filename():
+                continue
+            name = part.get_param("name", header="content-disposition")
+            fields[name] = part.get_payload(decode=True).decode("utf-8", "replace")
+        return fields
+    return {key: values[0] for key, values in parse_qs(body.decode()).items()}
+
+
+def make_handler(telegram: FakeTelegram):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        # заголовки и тело ответа пишутся отдельно: без TCP_NODELAY каждый ответ ждет delayed ACK (~40 мс)
+        disable_nagle_algorithm = True
+
+        def handle_call(self):
+            # /bot<token>/<method>
+            method = self.path.split("?")[0].rstrip("/").rsplit("/", 1)[-1]
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0) or 0))
+            if "?" in self.path:
+                body = body or self.path.split("?", 1)[1].encode()
+            fields = parse_fields(self.headers.get("Content-Type", ""), body)
+            result = telegram.call(method, fields)
+            data = json.dumps({"ok": True, "result": result}, ensure_ascii=False).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        do_GET = handle_call
+        do_POST = handle_call
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def start_server(telegram: FakeTelegram, port: int = 0, host: str = "127.0.0.1") -> ThreadingHTTPServer:
+    """Запускает сервер в фоновом потоке (port=0 - свободный порт). Адрес: server.url"""
+    server = ThreadingHTTPServer((host, port), make_handler(telegram))
+    server.daemon_threads = True
+    server.url = f"http://{host}:{server.server_address[1]}"
+    threading.Thread(target=server.serve_forever, name="fake-telegram", daemon=True).start()
+    return server
@@ -0,0 +1,82 @@
+"""Время импорта модулей kinolist.
+
+Каждый модуль импортируется в отдельном процессе (python -X importtime) несколько раз,
+в отчет попадает лучшее время. Проверяется, что при импорте не загружаются тяжелые
+и платформенные библиотеки (они загружаются только в функциях, которым нужны),
+и что время импорта не превышает бюджет из import_budget.json.
+
+Запуск из корня репозитория:
+    python bench/import_time.py            -- проверка, код 1 при превышении бюджета
+    python bench/import_time.py --update   -- записывает текущие значения (с запасом) в import_budget.json
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BUDGET_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "import_budget.json")
+
+MODULES = ["kinolist_lib", "kinolist_api", "kinolist_storage", "kinolist_index", "kinolist_daemon", "kinolist_metrics", "kinolist_trace", "kinolist_profile"]
+# Эти библиотеки не должны загружаться при импорте модулей
+LAZY = ["docx", "PIL", "mutagen", "tqdm", "PTN", "requests_cache", "win32com", "docx2pdf"]
+HEADROOM = 1.5  # запас при --update
+
+
+def measure(module: str, runs: int = 5):
+    """Лучшее время импорта module (с) и список загруженных тяжелых библиотек."""
+    code = (f"import sys, {module}; "
+            f"print(','.join(name for name in {LAZY!r} if name in sys.modules))")
+    best = None
+    loaded = []
+    for _ in range(runs):
+        result = subprocess.run([sys.executable, "-X", "importtime", "-c", code],
+                                cwd=ROOT, capture_output=True, text=True)
+        if result.returncode != 0:
+            raise RuntimeError(f"Не удалось импортировать {module}:\n{result.stderr.strip().splitlines()[-1]}")
+        # последняя строка importtime - сам модуль: "import time: self [us] | cumulative | name"
+        lines = [line for line in result.stderr.splitlines() if line.startswith("import time:") and line.rstrip().endswith(f"| {module}")]
+        cumulative = int(lines[-1].split("|")[1]) / 1e6
+        best = cumulative if best is None else min(best, cumulative)
+        loaded = [name for name in result.stdout.strip().split(",") if name]
+    return best, loaded
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Время импорта модулей kinolist")
+    parser.add_argument("--update", action="store_true", help="обновляет import_budget.json")
+    parser.add_argument("--runs", type=int, default=5, help="количество запусков для каждого модуля")
+    args = parser.parse_args()
+
+    budget = {}
+    if os.path.exists(BUDGET_FILE):
+        with open(BUDGET_FILE, encoding="utf-8") as f:
+            budget = json.load(f)
+
+    failed = False
+    results = {}
+    for module in MODULES:
+        seconds, loaded = measure(module, args.runs)
+        results[module] = seconds
+        limit = budget.get(module)
+        status = "ok"
+        if loaded:
+            status = f"загружены: {', '.join(loaded)}"
+            failed = True
+        elif limit is not None and seconds > limit and not args.update:
+            status = f"превышен бюджет {limit * 1000:.0f} мс"
+            failed = True
+        print(f"{module:20} {seconds * 1000:8.1f} мс  {status}")
+
+    if args.update:
+        with open(BUDGET_FILE, "w", encoding="utf-8") as f:
+            json.dump({module: round(seconds * HEADROOM, 3) for module, seconds in results.items()}, f, indent=4)
+            f.write("\n")
+        print(f"Бюджет сохранен в {BUDGET_FILE}")
+        return 0
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
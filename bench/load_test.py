@@ -0,0 +1,334 @@
+"""Нагрузочный тест бота: сколько одновременных пользователей выдерживает один экземпляр kinolist_bot.py.
+
+Запускает тестовые серверы Kinopoisk API (fake_kinopoisk.py) и Telegram Bot API (fake_telegram.py)
+и бота в отдельном процессе (во временном каталоге с тестовым config.py). N чатов отправляют списки
+из --films фильмов в режимах /pdf, /docx и /info (доли задаются --mix) с частотой --rate списков в секунду
+(поток Пуассона). У чата одновременно не больше одного задания: если все чаты заняты, список ждет
+в очереди первого освободившегося чата.
+
+Задержка - время от запланированной отправки списка (а не от фактической, чтобы ожидание в очереди
+при перегрузке тоже учитывалось) до ответа бота (документ, последняя карточка фильма в режиме /info
+или сообщение об ошибке). Выводятся пропускная способность и 50/95/99-й процентили задержки.
+
+Запуск из корня репозитория:
+    python bench/load_test.py --chats 20 --films 10 --rate 2 --duration 60
+    python bench/load_test.py --mix docx:3,info:1 --workers 4 --max-p95 30 --json load.json
+
+Для режима /pdf в Linux нужен Libre Office (soffice), иначе задания /pdf завершаются ошибкой.
+"""
+import argparse
+import glob
+import json
+import logging
+import math
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+BENCH = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH)
+sys.path.insert(0, BENCH)
+
+from fake_kinopoisk import FakeKinopoisk, start_server as start_kinopoisk  # noqa: E402
+from fake_telegram import FakeTelegram, start_server as start_telegram  # noqa: E402
+
+log = logging.getLogger("LoadTest")
+
+MODES = ("pdf", "docx", "info")
+CONFIG = 'TELEGRAM_API_TOKEN = "123456:LOAD-TEST"\nKINOPOISK_API_TOKEN = "load-test"\n'
+# config.py берется из рабочего каталога бота, а не из корня репозитория (sys.path[0] - рабочий каталог)
+BUSY_REPLY = "Подождите, я все еще работаю!"
+BUSY_RETRIES = 20
+BUSY_DELAY = 0.05  # с
+BOOT = "import runpy, sys; sys.argv = sys.argv[1:]; runpy.run_path(sys.argv[0], run_name='__main__')"
+
+
+class Chat:
+    """Чат тестового пользователя: ожидание ответа бота на команду или список."""
+
+    def __init__(self, chat_id: int):
+        self.id = chat_id
+        self.mode = None
+        self.busy = False
+        self._expect = None
+        self._photos = 0
+        self._done = threading.Event()
+        self.finished = None
+        self.error = None
+
+    def expect(self, what: str, films: int = 0):
+        self._expect = what
+        self._photos = films
+        self.finished = None
+        self.error = None
+        self._done.clear()
+
+    def wait(self, timeout: float) -> bool:
+        return self._done.wait(timeout)
+
+    def on_message(self, method: str, fields: dict, timestamp: float):
+        if self._expect is None or self._done.is_set():
+            return
+        if self._expect == "command":
+            self._finish(timestamp)
+        elif method == "sendDocument":
+            self._finish(timestamp)
+        elif method == "sendPhoto":
+            self._photos -= 1
+            if self._photos <= 0:
+                self._finish(timestamp)
+        elif method == "sendMessage":
+            self._finish(timestamp, fields.get("text", "ошибка"))
+
+    def _finish(self, timestamp: float, error: str = None):
+        self.finished = timestamp
+        self.error = error
+        self._done.set()
+
+
+def percentile(values: list, p: float):
+    """Процентиль p (0-100) методом ближайшего ранга."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+
+def parse_mix(text: str) -> dict:
+    """"docx:3,info:1" -> {"docx": 3.0, "info": 1.0}"""
+    mix = {}
+    for item in text.split(","):
+        mode, _, weight = item.strip().partition(":")
+        if mode not in MODES:
+            raise argparse.ArgumentTypeError(f"неизвестный режим: {mode}")
+        mix[mode] = float(weight or 1)
+    return mix
+
+
+class LoadTest:
+    def __init__(self, args):
+        self.args = args
+        self.random = random.Random(args.seed)
+        self.chats = {}
+        self.results = []
+        self.backlog = []  # (режим, текст, запланированное время) - списки, ожидающие свободного чата
+        self.queued = 0
+        self.stopped = False
+        self._lock = threading.Lock()
+        self.telegram = FakeTelegram(on_bot_message=self.on_bot_message)
+
+    def on_bot_message(self, chat_id: int, method: str, fields: dict, timestamp: float):
+        chat = self.chats.get(chat_id)
+        if chat is not None:
+            chat.on_message(method, fields, timestamp)
+
+    def titles(self) -> str:
+        ids = self.random.sample(range(1, self.args.distinct + 1), min(self.args.films, self.args.distinct))
+        return "\n".join(f"Фильм {film_id}" for film_id in ids)
+
+    def run_jobs(self, chat: Chat, mode: str, text: str, scheduled: float):
+        """Задание чата, затем задания из очереди, пока она не опустеет."""
+        while True:
+            self.run_job(chat, mode, text, scheduled)
+            with self._lock:
+                if not self.backlog or self.stopped:
+                    chat.busy = False
+                    return
+                mode, text, scheduled = self.backlog.pop(0)
+
+    def run_job(self, chat: Chat, mode: str, text: str, scheduled: float):
+        timeout = self.args.timeout
+        result = {"mode": mode, "chat": chat.id, "latency": None, "wait": round(time.time() - scheduled, 3), "error": None}
+        try:
+            if chat.mode != mode:
+                chat.expect("command")
+                self.telegram.send_text(chat.id, f"/{mode}")
+                if not chat.wait(timeout):
+                    result["error"] = "timeout"
+                    return
+                chat.mode = mode
+            for _attempt in range(BUSY_RETRIES):
+                chat.expect(mode, self.args.films)
+                self.telegram.send_text(chat.id, text)
+                if not chat.wait(timeout):
+                    result["error"] = "timeout"
+                    return
+                if chat.error != BUSY_REPLY:
+                    break
+                # бот отправил ответ на предыдущий список, но еще не снял блокировку задания чата
+                time.sleep(BUSY_DELAY)
+            result["latency"] = chat.finished - scheduled
+            result["error"] = chat.error
+        finally:
+            with self._lock:
+                self.results.append(result)
+
+    def generate(self):
+        """Поток заданий с частотой --rate в течение --duration секунд. Возвращает потоки заданий."""
+        modes, weights = zip(*self.args.mix.items())
+        jobs = []
+        deadline = time.monotonic() + self.args.duration
+        while True:
+            time.sleep(self.random.expovariate(self.args.rate))
+            if time.monotonic() >= deadline:
+                break
+            scheduled = time.time()
+            mode = self.random.choices(modes, weights)[0]
+            text = self.titles()
+            with self._lock:
+                idle = [chat for chat in self.chats.values() if not chat.busy]
+                if not idle:
+                    self.backlog.append((mode, text, scheduled))
+                    self.queued += 1
+                    continue
+                chat = self.random.choice(idle)
+                chat.busy = True
+            job = threading.Thread(target=self.run_jobs, args=(chat, mode, text, scheduled), daemon=True)
+            job.start()
+            jobs.append(job)
+        return jobs
+
+    def run(self) -> dict:
+        args = self.args
+        kinopoisk = FakeKinopoisk(latency=args.latency / 1000, jitter=args.jitter / 1000, seed=args.seed)
+        kinopoisk_server = start_kinopoisk(kinopoisk)
+        telegram_server = start_telegram(self.telegram)
+        workdir = tempfile.mkdtemp(prefix="kinolist-load-")
+        for path in glob.glob(os.path.join(ROOT, "*.docx")) + glob.glob(os.path.join(ROOT, "*.jpg")):
+            shutil.copy(path, workdir)
+        with open(os.path.join(workdir, "config.py"), "w", encoding="utf-8") as f:
+            f.write(CONFIG)
+        env = dict(os.environ, PYTHONPATH=ROOT, KINOPOISK_URL=kinopoisk_server.url, TQDM_DISABLE="1")
+        command = [sys.executable, "-c", BOOT, os.path.join(ROOT, "kinolist_bot.py"),
+                   "--api-server", telegram_server.url, "--state", f"sqlite:///{os.path.join(workdir, 'state.db')}",
+                   "--workers", str(args.workers), "--slow", "1e9"]
+        bot_log = args.bot_log or os.path.join(workdir, "bot.log")
+        self.chats = {100000 + i: Chat(100000 + i) for i in range(args.chats)}
+        try:
+            with open(bot_log, "w", encoding="utf-8") as output:
+                process = subprocess.Popen(command, cwd=workdir, env=env, stdout=output, stderr=subprocess.STDOUT)
+                try:
+                    self.wait_ready(process, bot_log)
+                    log.info(f"Бот запущен, нагрузка: {args.rate} списков/с, {args.chats} чатов, {args.films} фильмов")
+                    started = time.time()
+                    jobs = self.generate()
+                    deadline = time.monotonic() + args.timeout * 2
+                    for job in jobs:
+                        job.join(max(0.0, deadline - time.monotonic()))
+                    elapsed = time.time() - started
+                    with self._lock:
+                        # не дождавшиеся свободного чата списки - таймауты
+                        self.stopped = True
+                        self.results.extend({"mode": mode, "chat": None, "latency": None, "wait": None, "error": "timeout"}
+                                            for mode, _text, _scheduled in self.backlog)
+                        self.backlog.clear()
+                finally:
+                    process.terminate()
+                    try:
+                        process.wait(10)
+                    except subprocess.TimeoutExpired:
+                        process.kill()
+        finally:
+            kinopoisk_server.shutdown()
+            telegram_server.shutdown()
+            shutil.rmtree(workdir, ignore_errors=True)
+        return self.report(elapsed, kinopoisk.requests)
+
+    def wait_ready(self, process: subprocess.Popen, bot_log: str):
+        # бот готов, когда после пропуска старых обновлений начинает ждать новые
+        deadline = time.monotonic() + self.args.startup_timeout
+        while self.telegram.calls.get("getUpdates", 0) < 2:
+            if process.poll() is not None or time.monotonic() > deadline:
+                with open(bot_log, encoding="utf-8", errors="replace") as f:
+                    tail = f.read()[-3000:]
+                raise RuntimeError(f"Бот не запустился (код {process.poll()}):\n{tail}")
+            time.sleep(0.1)
+
+    def report(self, elapsed: float, kinopoisk_requests: int) -> dict:
+        summary = {"elapsed": round(elapsed, 3), "queued": self.queued, "kinopoisk_requests": kinopoisk_requests,
+                   "modes": {}}
+        for mode in (None,) + MODES:
+            results = [r for r in self.results if mode is None or r["mode"] == mode]
+            if mode is not None and not results:
+                continue
+            ok = [r for r in results if r["error"] is None]
+            latencies = [r["latency"] for r in ok]
+            stats = {
+                "jobs": len(results),
+                "ok": len(ok),
+                "errors": sum(1 for r in results if r["error"] not in (None, "timeout")),
+                "timeouts": sum(1 for r in results if r["error"] == "timeout"),
+                "throughput": round(len(ok) / elapsed, 3) if elapsed else 0.0,
+            }
+            for p in (50, 95, 99):
+                value = percentile(latencies, p)
+                stats[f"p{p}"] = round(value, 3) if value is not None else None
+            stats["max"] = round(max(latencies), 3) if latencies else None
+            waits = [r["wait"] for r in ok]
+            stats["max_wait"] = round(max(waits), 3) if waits else None
+            summary["modes"][mode or "all"] = stats
+        summary["errors"] = sorted({r["error"] for r in self.results if r["error"] not in (None, "timeout")})
+        return summary
+
+
+def print_report(summary: dict):
+    def seconds(value):
+        return f"{value:7.2f}" if value is not None else "      -"
+
+    print(f"Длительность {summary['elapsed']:.1f} с, ждали свободного чата: {summary['queued']} списков, "
+          f"запросов к Kinopoisk API: {summary['kinopoisk_requests']}")
+    print("режим   заданий  успешно  ошибки  таймауты  списков/с     p50     p95     p99     max  очередь")
+    for mode, s in summary["modes"].items():
+        print(f"{mode:6s}  {s['jobs']:7d}  {s['ok']:7d}  {s['errors']:6d}  {s['timeouts']:8d}  {s['throughput']:9.2f} "
+              f"{seconds(s['p50'])} {seconds(s['p95'])} {seconds(s['p99'])} {seconds(s['max'])}  {seconds(s['max_wait'])}")
+    for error in summary["errors"]:
+        print(f"Ошибка: {error}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест kinolist_bot.py на тестовых серверах Telegram и Kinopoisk")
+    parser.add_argument("--chats", type=int, default=10, help="количество чатов (одновременных пользователей)")
+    parser.add_argument("--films", type=int, default=10, help="количество фильмов в списке")
+    parser.add_argument("--distinct", type=int, default=10000, help="количество разных фильмов (меньше - больше попаданий в кэш)")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix("docx:2,info:1,pdf:1"),
+                        help="доли режимов, например docx:2,info:1,pdf:1")
+    parser.add_argument("--rate", type=float, default=1.0, help="частота отправки списков, в секунду")
+    parser.add_argument("--duration", type=float, default=60.0, help="длительность подачи нагрузки, с")
+    parser.add_argument("--workers", type=int, default=1, help="количество процессов-обработчиков бота (--workers)")
+    parser.add_argument("--latency", type=float, default=0.0, help="задержка ответа Kinopoisk API, мс")
+    parser.add_argument("--jitter", type=float, default=0.0, help="случайная добавка к задержке, мс")
+    parser.add_argument("--timeout", type=float, default=300.0, help="время ожидания ответа на список, с")
+    parser.add_argument("--startup-timeout", type=float, default=60.0, help="время ожидания запуска бота, с")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--bot-log", metavar="FILE", help="сохраняет вывод бота в FILE")
+    parser.add_argument("--json", metavar="FILE", help="сохраняет результаты в FILE")
+    parser.add_argument("--max-p95", type=float, metavar="SECONDS",
+                        help="код завершения 1, если 95-й процентиль задержки больше SECONDS")
+    parser.add_argument("--max-errors", type=float, default=0.0, help="допустимая доля ошибок и таймаутов")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='[%(asctime)s]%(levelname)s:%(name)s:%(message)s', datefmt='%d.%m.%Y %H:%M:%S')
+
+    summary = LoadTest(args).run()
+    print_report(summary)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(summary, f, ensure_ascii=False, indent=4)
+
+    total = summary["modes"]["all"]
+    failed = total["jobs"] - total["ok"]
+    if total["jobs"] and failed / total["jobs"] > args.max_errors:
+        print(f"Доля неудачных заданий {failed / total['jobs']:.1%} больше допустимой {args.max_errors:.1%}")
+        return 1
+    if args.max_p95 is not None and total["p95"] is not None and total["p95"] > args.max_p95:
+        print(f"95-й процентиль задержки {total['p95']:.2f} с больше {args.max_p95:.2f} с")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
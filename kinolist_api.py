@@ -0,0 +1,446 @@
+import hashlib
+import logging
+import os
+import random
+import re
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+
+import requests
+
+from kinolist_metrics import CACHE_REQUESTS, RETRIES, RETRY_FAILURES, UPSTREAM_ERRORS
+
+log = logging.getLogger("Api")
+
+# Адрес Kinopoisk API (переменная окружения KINOPOISK_URL - например, тестовый сервер bench/fake_kinopoisk.py)
+KINOPOISK_URL = os.environ.get("KINOPOISK_URL", "https://kinopoiskapiunofficial.tech")
+DAILY_QUOTA = 500  # дневной лимит запросов бесплатного ключа
+LOW_QUOTA_WARNING = 0.1  # предупреждение, когда осталось меньше 10% запросов
+
+
+RETRYABLE_STATUS = (429, 500, 502, 503, 504)
+RETRYABLE_ERRORS = (requests.ConnectionError, requests.Timeout)
+
+# Счетчики повторов запросов (для логов и метрик), изменяются из нескольких потоков под _retry_stats_lock
+retry_stats = {"retries": 0, "failures": 0}
+_retry_stats_lock = threading.Lock()
+REQUESTS_PER_SECOND = 10  # общий лимит частоты запросов к Kinopoisk API (сервер допускает 20)
+
+
+class ApiQuotaError(Exception):
+    """Исчерпаны лимиты всех ключей Kinopoisk API."""
+
+
+class RetryPolicy:
+    """Политика повторов запросов: экспоненциальная задержка со случайным разбросом.
+
+    Args:
+        attempts (int): максимальное количество попыток
+        base_delay (float): задержка перед первым повтором, с
+        max_delay (float): максимальная задержка между попытками, с
+        budget (float): общее время на запрос со всеми повторами, с
+        timeout (float): таймаут одной попытки, с
+    """
+
+    def __init__(self, attempts: int = 4, base_delay: float = 0.5, max_delay: float = 8.0, budget: float = 30.0,
+                 timeout: float = 10.0):
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.budget = budget
+        self.timeout = timeout
+
+    def deadline(self) -> float:
+        return time.monotonic() + self.budget
+
+    def attempt_timeout(self, deadline: float) -> float:
+        return max(0.1, min(self.timeout, deadline - time.monotonic()))
+
+    def delay(self, attempt: int, retry_after: float = None) -> float:
+        """Задержка перед повтором номер attempt (с нуля), full jitter.
+
+        Retry-After имеет приоритет и не ограничивается max_delay: раньше сервер все равно не ответит
+        (если ожидание не укладывается в общее время на запрос, wait отказывается от повтора).
+        """
+        if retry_after is not None:
+            return retry_after
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2**attempt))
+
+    def wait(self, attempt: int, deadline: float, retry_after: float = None, reason: str = "") -> bool:
+        """Ждет перед повтором, если он допустим. Возвращает False, если попытки или время исчерпаны."""
+        delay = self.delay(attempt, retry_after)
+        if attempt + 1 >= self.attempts or time.monotonic() + delay >= deadline:
+            with _retry_stats_lock:
+                retry_stats["failures"] += 1
+            RETRY_FAILURES.inc()
+            log.warning(f"Запрос не выполнен после {attempt + 1} попыток: {reason}")
+            return False
+        with _retry_stats_lock:
+            retry_stats["retries"] += 1
+        RETRIES.inc()
+        log.warning(f"Повтор запроса через {delay:.1f} с (попытка {attempt + 2} из {self.attempts}): {reason}")
+        time.sleep(delay)
+        return True
+
+
+retry_policy = RetryPolicy()
+
+
+class RateLimiter:
+    """Ограничение частоты запросов, общее для всех потоков процесса."""
+
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next)
+            self._next = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
+rate_limiter = RateLimiter(REQUESTS_PER_SECOND)
+_session = None
+
+
+def session() -> requests.Session:
+    """Общая сессия HTTP (постоянные соединения).
+
+    Пересоздается, если requests_cache установил или снял кэширование (подменяет класс requests.Session).
+    """
+    global _session
+    if type(_session) is not requests.Session:
+        _session = requests.Session()
+    return _session
+
+
+# HTTP-кэш ответов (requests_cache)
+HTTP_CACHE_EXPIRE = 3600  # срок хранения ответов, не указанных в http_cache_policy
+HTTP_CACHE_MAX_SIZE = 200 * 1024 * 1024
+DAY = 24 * 3600
+
+
+def http_cache_policy(do_not_cache) -> dict:
+    """Сроки хранения ответов в HTTP-кэше по адресам запросов (используется первое совпадение).
+
+    Постеры и списки актеров почти не меняются, рейтинг фильма и результаты поиска обновляются чаще.
+    Устаревший ответ с ETag или Last-Modified проверяется условным запросом (ответ 304 не загружается заново).
+    """
+    host = KINOPOISK_URL.split("://", 1)[-1]
+    return {
+        f"{host}/api/v1/api_keys/*": do_not_cache,
+        f"{host}/api/v1/staff*": 30 * DAY,
+        f"{host}/api/v2.2/films/*": DAY,
+        f"{host}/api/v2.1/films/search-by-keyword*": DAY,
+        f"{host}/images/*": 90 * DAY,
+        "avatars.mds.yandex.net/*": 90 * DAY,
+    }
+
+
+def install_http_cache(path: str, max_size: int = HTTP_CACHE_MAX_SIZE):
+    """Включает HTTP-кэш requests_cache с политикой http_cache_policy (если он еще не включен).
+
+    Args:
+        path (str): путь к базе данных кэша (SQLite)
+        max_size (int): максимальный размер базы, байт (см. trim_http_cache)
+    """
+    import requests_cache
+    if issubclass(requests.Session, requests_cache.CachedSession):
+        return
+    requests_cache.install_cache(path,
+                                 backend="sqlite",
+                                 expire_after=HTTP_CACHE_EXPIRE,
+                                 urls_expire_after=http_cache_policy(requests_cache.DO_NOT_CACHE),
+                                 stale_if_error=True,
+                                 wal=True)
+    trim_http_cache(max_size)
+
+
+def trim_http_cache(max_size: int = HTTP_CACHE_MAX_SIZE):
+    """Удаляет устаревшие ответы из HTTP-кэша и, если база больше max_size, ответы с ближайшим сроком истечения."""
+    import requests_cache
+    cache = requests_cache.get_cache()
+    if cache is None:
+        return
+    size = cache.responses.size()
+    if size <= max_size:
+        return
+    cache.delete(expired=True, vacuum=True)
+    while cache.responses.size() > max_size and len(cache.responses):
+        count = max(1, len(cache.responses) // 10)
+        keys = [response.cache_key for response in cache.responses.sorted(key="expires", limit=count)]
+        cache.delete(*keys, vacuum=True)
+    log.info(f"HTTP-кэш уменьшен: {size // 1024} КБ -> {cache.responses.size() // 1024} КБ")
+
+
+def retry_after(response) -> float:
+    """Значение заголовка Retry-After в секундах (число или дата) или None."""
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def endpoint_name(path: str) -> str:
+    """Путь запроса без идентификаторов для меток метрик: /api/v2.2/films/328 -> /api/v2.2/films/{id}"""
+    return re.sub(r"/\d+(?=/|$)", "/{id}", path)
+
+
+def record_response(endpoint: str, response: requests.Response):
+    """Учитывает ответ в метриках (обращения к HTTP-кэшу и ошибки)."""
+    CACHE_REQUESTS.labels(cache="http", result="hit" if getattr(response, "from_cache", False) else "miss").inc()
+    if response.status_code >= 400:
+        UPSTREAM_ERRORS.labels(endpoint=endpoint, status=response.status_code).inc()
+
+
+def http_get(url: str, policy: RetryPolicy = None, **kwargs) -> requests.Response:
+    """GET-запрос с повторами при сетевых ошибках и ответах 429/5xx (например, загрузка постера)."""
+    policy = policy or retry_policy
+    deadline = policy.deadline()
+    endpoint = urlsplit(url).netloc
+    attempt = 0
+    while True:
+        try:
+            r = session().get(url, timeout=policy.attempt_timeout(deadline), **kwargs)
+        except RETRYABLE_ERRORS as e:
+            UPSTREAM_ERRORS.labels(endpoint=endpoint, status=type(e).__name__).inc()
+            if not policy.wait(attempt, deadline, reason=f"{url} ({e})"):
+                raise
+            attempt += 1
+            continue
+        record_response(endpoint, r)
+        if r.status_code in RETRYABLE_STATUS and policy.wait(attempt, deadline, retry_after(r), f"{url} ({r.status_code})"):
+            attempt += 1
+            continue
+        return r
+
+
+def key_id(key: str) -> str:
+    """Короткий идентификатор ключа для логов и счетчиков (сам ключ не сохраняется)."""
+    return hashlib.sha1(key.encode()).hexdigest()[:8]
+
+
+class ApiKeyPool:
+    """Пул ключей Kinopoisk API с учетом дневных лимитов.
+
+    Для каждого ключа считаются запросы за текущие сутки (UTC). Запрос выполняется ключом
+    с наибольшим остатком. При ответе 402 ключ помечается исчерпанным до конца суток,
+    при ответе 429 запрос повторяется следующим ключом.
+    Если передано общее хранилище (kinolist_storage), счетчики общие для всех процессов.
+    """
+
+    def __init__(self, keys: list, daily_quota: int = DAILY_QUOTA, backend=None):
+        if not keys:
+            raise ValueError("Список ключей Kinopoisk API не может быть пустым.")
+        self.keys = list(dict.fromkeys(keys))
+        self.daily_quota = daily_quota
+        self.backend = backend
+        self._counters = {}
+        self._warned = set()
+        self._cooldown = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _today():
+        return time.strftime("%Y-%m-%d", time.gmtime())
+
+    def _counter_key(self, key, name):
+        return f"{self._today()}:{key_id(key)}:{name}"
+
+    def _get(self, key, name):
+        counter_key = self._counter_key(key, name)
+        if self.backend is not None:
+            return self.backend.get("quota", counter_key, 0)
+        return self._counters.get(counter_key, 0)
+
+    def _incr(self, key, name, amount=1):
+        counter_key = self._counter_key(key, name)
+        if self.backend is not None:
+            return self.backend.incr("quota", counter_key, amount, ttl=2 * 24 * 3600)
+        with self._lock:
+            self._counters[counter_key] = self._counters.get(counter_key, 0) + amount
+            return self._counters[counter_key]
+
+    def _set(self, key, name, value):
+        counter_key = self._counter_key(key, name)
+        if self.backend is not None:
+            self.backend.set("quota", counter_key, value, ttl=2 * 24 * 3600)
+        else:
+            with self._lock:
+                self._counters[counter_key] = value
+
+    def used(self, key: str) -> int:
+        return self._get(key, "used")
+
+    def quota(self, key: str) -> int:
+        """Дневной лимит ключа: полученный из Kinopoisk API (см. sync) или daily_quota."""
+        return self._get(key, "quota") or self.daily_quota
+
+    def is_exhausted(self, key: str) -> bool:
+        return bool(self._get(key, "exhausted")) or self.used(key) >= self.quota(key)
+
+    def remaining(self, key: str = None) -> int:
+        """Остаток запросов на сегодня для ключа key или для всего пула."""
+        keys = [key] if key else self.keys
+        return sum(0 if self.is_exhausted(k) else self.quota(k) - self.used(k) for k in keys)
+
+    def has_capacity(self) -> bool:
+        return self.remaining() > 0
+
+    def key(self) -> str:
+        """Ключ с наибольшим остатком запросов (ключи с превышением частоты запросов - в последнюю очередь)."""
+        available = [k for k in self.keys if not self.is_exhausted(k)]
+        if not available:
+            raise ApiQuotaError("Исчерпан дневной лимит запросов всех ключей Kinopoisk API.")
+        now = time.monotonic()
+        return min(available, key=lambda k: (self._cooldown.get(k, 0) > now, self.used(k)))
+
+    def cooldown(self, key: str, seconds: float = 1.0):
+        """Временно понижает приоритет ключа после ответа 429 (превышена частота запросов)."""
+        self._cooldown[key] = time.monotonic() + seconds
+
+    def record(self, key: str):
+        """Учитывает выполненный запрос."""
+        self._incr(key, "used")
+        remaining = self.remaining()
+        if remaining <= int(sum(map(self.quota, self.keys)) * LOW_QUOTA_WARNING) and self._first_today("low_quota"):
+            log.warning(f"Заканчивается дневной лимит Kinopoisk API: осталось {remaining} запросов.")
+
+    def _first_today(self, name: str) -> bool:
+        """True только при первом вызове за сутки (во всех процессах, если есть общее хранилище)."""
+        flag_key = f"{self._today()}:{'+'.join(key_id(k) for k in self.keys)}:{name}"
+        if self.backend is not None:
+            return self.backend.incr("quota", flag_key, ttl=2 * 24 * 3600) == 1
+        with self._lock:
+            if flag_key in self._warned:
+                return False
+            self._warned.add(flag_key)
+            return True
+
+    def exhaust(self, key: str):
+        """Помечает ключ исчерпанным до конца суток."""
+        if not self._get(key, "exhausted"):
+            self._incr(key, "exhausted")
+            log.warning(f"Ключ Kinopoisk API {key_id(key)} исчерпан, осталось ключей: "
+                        f"{sum(not self.is_exhausted(k) for k in self.keys)}")
+
+    def sync(self):
+        """Загружает дневной лимит и его фактический расход для каждого ключа из Kinopoisk API."""
+        for key in self.keys:
+            try:
+                rate_limiter.wait()
+                r = http_get(f"{KINOPOISK_URL}/api/v1/api_keys/{key}", headers={'X-API-KEY': key})
+                if r.status_code != 200:
+                    log.warning(f"Не удалось получить лимиты ключа {key_id(key)}: {r.status_code}")
+                    continue
+                daily = r.json()["dailyQuota"]
+            except Exception as e:
+                log.warning(f"Не удалось получить лимиты ключа {key_id(key)}: {e}")
+                continue
+            self._set(key, "quota", daily["value"])
+            self._set(key, "used", daily["used"])
+
+    def report(self) -> list:
+        """Состояние ключей: идентификатор, использовано, остаток, признак исчерпания."""
+        return [{
+            "key": key_id(k),
+            "used": self.used(k),
+            "remaining": self.remaining(k),
+            "exhausted": self.is_exhausted(k),
+        } for k in self.keys]
+
+
+_pools = {}
+
+
+def make_api(keys, daily_quota: int = DAILY_QUOTA, backend=None) -> ApiKeyPool:
+    """Возвращает пул для одного ключа (str) или списка ключей.
+
+    Пулы кэшируются по набору ключей; если передано другое хранилище, пул создается заново.
+    """
+    if isinstance(keys, ApiKeyPool):
+        return keys
+    if isinstance(keys, str):
+        keys = [keys]
+    pool_id = tuple(keys)
+    pool = _pools.get(pool_id)
+    if pool is None or (backend is not None and pool.backend is not backend):
+        pool = _pools[pool_id] = ApiKeyPool(keys, daily_quota, backend)
+    return pool
+
+
+def api_from_config(config, backend=None) -> ApiKeyPool:
+    """Пул ключей из config.py: KINOPOISK_API_TOKENS (список) или KINOPOISK_API_TOKEN."""
+    keys = getattr(config, "KINOPOISK_API_TOKENS", None) or [config.KINOPOISK_API_TOKEN]
+    daily_quota = getattr(config, "KINOPOISK_DAILY_QUOTA", DAILY_QUOTA)
+    pool = make_api(keys, daily_quota, backend)
+    pool.daily_quota = daily_quota
+    return pool
+
+
+def api_get(path: str, api, params: dict = None, policy: RetryPolicy = None) -> requests.Response:
+    """GET-запрос к Kinopoisk API с ротацией ключей пула и повторами.
+
+    При ответе 429 сначала пробуются остальные ключи пула, затем запрос повторяется
+    по политике policy (с учетом Retry-After). Сетевые ошибки и ответы 5xx также повторяются.
+
+    Args:
+        path (str): путь запроса, например /api/v2.2/films/328
+        api (str | ApiKeyPool): ключ или пул ключей
+        params (dict, optional): параметры запроса
+        policy (RetryPolicy, optional): политика повторов
+
+    Raises:
+        ApiQuotaError: исчерпаны лимиты всех ключей
+
+    Returns:
+        requests.Response: ответ сервера
+    """
+    pool = make_api(api)
+    policy = policy or retry_policy
+    deadline = policy.deadline()
+    endpoint = endpoint_name(path)
+    attempt = 0
+    rotations = 0
+    while True:
+        key = pool.key()
+        headers = {'X-API-KEY': key, 'Content-Type': 'application/json'}
+        rate_limiter.wait()
+        try:
+            r = session().get(KINOPOISK_URL + path, headers=headers, params=params, timeout=policy.attempt_timeout(deadline))
+        except RETRYABLE_ERRORS as e:
+            UPSTREAM_ERRORS.labels(endpoint=endpoint, status=type(e).__name__).inc()
+            if not policy.wait(attempt, deadline, reason=f"{path} ({e})"):
+                raise
+            attempt += 1
+            continue
+        if not getattr(r, "from_cache", False) or getattr(r, "revalidated", False):
+            pool.record(key)  # условный запрос (ответ 304) тоже расходует лимит
+        record_response(endpoint, r)
+        if r.status_code == 402:
+            pool.exhaust(key)
+            if pool.has_capacity():
+                continue
+            return r
+        if r.status_code == 429 and rotations < len(pool.keys) - 1:
+            pool.cooldown(key)
+            rotations += 1
+            continue
+        if r.status_code in RETRYABLE_STATUS and policy.wait(attempt, deadline, retry_after(r), f"{path} ({r.status_code})"):
+            attempt += 1
+            rotations = 0
+            continue
+        return r
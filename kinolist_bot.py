@@ -1,21 +1,31 @@
+import asyncio
 import logging
+import multiprocessing
 import shutil
 import os
+import sys
+import threading
+import time
+import uuid
 import argparse_ru
 import argparse
+from collections import OrderedDict
 from random import choice
 
 from aiogram import Bot, Dispatcher, executor, types
-from aiogram.contrib.fsm_storage.memory import MemoryStorage
+from aiogram.dispatcher.storage import BaseStorage
 from aiogram.dispatcher.filters.state import State, StatesGroup
 import aiogram.utils.markdown as fmt
-from docx2pdf import convert
+import kinolist_api
 from kinolist_lib import *
+from kinolist_metrics import ACTIVE_JOBS, DEFAULT_PORT, LISTS_CREATED, QUEUE_DEPTH, stage, start_http_server
+from kinolist_profile import configure_sampling, sampled, tag as profile_tag
+from kinolist_storage import open_backend
+from kinolist_trace import annotate, configure as configure_tracing, install_log_factory, trace
 import config
 
 VER = '0.4.3'
 TELEGRAM_API_TOKEN = config.TELEGRAM_API_TOKEN
-KINOPOISK_API_TOKEN = config.KINOPOISK_API_TOKEN
 
 
 parser = argparse.ArgumentParser(prog='Kinolist_Bot',
@@ -23,23 +33,272 @@ parser = argparse.ArgumentParser(prog='Kinolist_Bot',
 parser.add_argument("-ver", "--version", action="version", version=f"%(prog)s {VER}", help="выводит версию программы и завершает работу")
 parser.add_argument("-l", "--log", action='store_true', help="включает запись лога в файл kinolist_bot.log")
 parser.add_argument("--libre", action='store_true', help="конвертация docx в pdf с помощью Libre Office")
+parser.add_argument("--state", default="sqlite:///kinolist_state.db",
+                    help="адрес общего хранилища состояния (по умолчанию sqlite:///kinolist_state.db)")
+parser.add_argument("--offline", action='store_true',
+                    help="автономный режим: списки создаются только из кэша, без запросов к Kinopoisk API")
+parser.add_argument("-w", "--workers", type=int, default=1,
+                    help="количество процессов-обработчиков, обновления распределяются по chat_id "
+                         "(лимит частоты запросов к Kinopoisk API делится между ними)")
+parser.add_argument("--metrics", nargs="?", type=int, const=DEFAULT_PORT, metavar="PORT",
+                    help=f"отдает метрики Prometheus по адресу http://127.0.0.1:PORT/metrics (порт {DEFAULT_PORT} по умолчанию); "
+                         "обработчики используют порты PORT+1, PORT+2, ...")
+parser.add_argument("--trace", metavar="FILE", help="сохраняет трассировки обработки сообщений в FILE (json lines)")
+parser.add_argument("--slow", type=float, default=30.0, metavar="SECONDS",
+                    help="записывает в kinolist_slow.log дерево этапов заданий дольше SECONDS секунд (30 по умолчанию)")
+parser.add_argument("--profile-every", type=int, default=0, metavar="N",
+                    help="сохраняет профиль выполнения (folded stacks для flamegraph) каждого N-го задания")
+parser.add_argument("--profile-dir", default="profiles", metavar="DIR", help="каталог для профилей (profiles по умолчанию)")
+parser.add_argument("--tracemalloc", action='store_true',
+                    help="учитывает пик памяти Python для каждого этапа (метрика kinolist_stage_traced_peak_bytes, замедляет работу)")
+parser.add_argument("--api-server", metavar="URL",
+                    help="адрес сервера Bot API вместо https://api.telegram.org (например, тестовый сервер bench/fake_telegram.py)")
 args = parser.parse_args()
+if sys.platform not in ("win32", "darwin"):
+    args.libre = True  # docx2pdf (Microsoft Word) доступен только в Windows и macOS
+
+if args.tracemalloc:
+    import tracemalloc
+    tracemalloc.start()
 
 # Configure logging
+install_log_factory()
+configure_tracing(args.trace, args.slow, "kinolist_slow.log")
+configure_sampling(args.profile_every, args.profile_dir)
 if args.log:
     logging.basicConfig(filename='kinolist_bot.log', level=logging.INFO,
-                        format='[%(asctime)s]%(levelname)s:%(name)s:%(message)s',
+                        format='[%(asctime)s]%(levelname)s:%(name)s:[%(trace_id)s]:%(message)s',
                         datefmt='%d.%m.%Y %H:%M:%S')
 else:
     logging.basicConfig(level=logging.INFO,
-                        format='[%(asctime)s]%(levelname)s:%(name)s:%(message)s',
+                        format='[%(asctime)s]%(levelname)s:%(name)s:[%(trace_id)s]:%(message)s',
                         datefmt='%d.%m.%Y %H:%M:%S')
 log = logging.getLogger("Bot")
 log.info(f"Kinolist_Bot ver. {VER}, Kinolist_Lib ver. {LIB_VER}")
 
+JOB_LOCK_TTL = 600
+# Блокировки выполняющихся заданий продлеваются с этим интервалом (задание может идти дольше JOB_LOCK_TTL)
+JOB_LOCK_RENEW = JOB_LOCK_TTL / 3
+# Обновления, одновременно обрабатываемые одним процессом при --workers > 1
+SHARD_CONCURRENCY = 16
+# Последний список чата (для /add, /remove, /move, /list) хранится месяц
+LIST_TTL = 30 * 24 * 3600
+CARD_DOCUMENTS_MAX = 20
+
+
+class BackendStorage(BaseStorage):
+    """Хранилище состояний FSM в общем хранилище (kinolist_storage).
+
+    Выбранный режим (pdf/docx/info) сохраняется между перезапусками и доступен всем процессам.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    @staticmethod
+    def _key(chat, user):
+        return f"{chat}:{user}"
+
+    def _get_record(self, chat, user):
+        chat, user = self.check_address(chat=chat, user=user)
+        return self.backend.get("fsm", self._key(chat, user), {"state": None, "data": {}, "bucket": {}})
+
+    def _set_record(self, chat, user, record):
+        chat, user = self.check_address(chat=chat, user=user)
+        if record["state"] is None and not record["data"] and not record["bucket"]:
+            self.backend.delete("fsm", self._key(chat, user))
+        else:
+            self.backend.set("fsm", self._key(chat, user), record)
+
+    async def close(self):
+        self.backend.close()
+
+    async def wait_closed(self):
+        pass
+
+    async def get_state(self, *, chat=None, user=None, default=None):
+        return self._get_record(chat, user)["state"] or self.resolve_state(default)
+
+    async def get_data(self, *, chat=None, user=None, default=None):
+        return self._get_record(chat, user)["data"] or (default or {})
+
+    async def set_state(self, *, chat=None, user=None, state=None):
+        record = self._get_record(chat, user)
+        record["state"] = self.resolve_state(state)
+        self._set_record(chat, user, record)
+
+    async def set_data(self, *, chat=None, user=None, data=None):
+        record = self._get_record(chat, user)
+        record["data"] = data or {}
+        self._set_record(chat, user, record)
+
+    async def update_data(self, *, chat=None, user=None, data=None, **kwargs):
+        record = self._get_record(chat, user)
+        record["data"].update(data or {}, **kwargs)
+        self._set_record(chat, user, record)
+
+    async def reset_state(self, *, chat=None, user=None, with_data=True):
+        record = self._get_record(chat, user)
+        record["state"] = None
+        if with_data:
+            record["data"] = {}
+        self._set_record(chat, user, record)
+
+    def has_bucket(self):
+        return True
+
+    async def get_bucket(self, *, chat=None, user=None, default=None):
+        return self._get_record(chat, user)["bucket"] or (default or {})
+
+    async def set_bucket(self, *, chat=None, user=None, bucket=None):
+        record = self._get_record(chat, user)
+        record["bucket"] = bucket or {}
+        self._set_record(chat, user, record)
+
+    async def update_bucket(self, *, chat=None, user=None, bucket=None, **kwargs):
+        record = self._get_record(chat, user)
+        record["bucket"].update(bucket or {}, **kwargs)
+        self._set_record(chat, user, record)
+
+
+async def check_api(message: types.Message) -> bool:
+    """Проверка доступности Kinopoisk API и остатка дневного лимита запросов."""
+    if args.offline:
+        return True
+    if not kinopoisk_api.has_capacity():
+        log.warning("Исчерпан дневной лимит запросов всех ключей Kinopoisk API.")
+        await message.reply("Ой, на сегодня лимит запросов к Кинопоиску исчерпан!((\nПопробуйте завтра.")
+        return False
+    if not is_api_ok(kinopoisk_api):
+        log.warning("API error.")
+        await message.reply("Ой, что-то сломалось!((\n(API error)")
+        return False
+    log.info(f"Остаток запросов Kinopoisk API: {kinopoisk_api.remaining()}")
+    return True
+
+
+def acquire_job(chat_id: str) -> str:
+    """Блокировка задания для чата, общая для всех процессов.
+
+    Returns:
+        str: владелец блокировки (уникальный для задания) или None, если задание для чата уже выполняется
+    """
+    owner = uuid.uuid4().hex
+    if not backend.acquire_lock(f"job:{chat_id}", owner, JOB_LOCK_TTL):
+        return None
+    with running_jobs_lock:
+        running_jobs[chat_id] = owner
+        start_lock_renewal()
+    ACTIVE_JOBS.inc()
+    return owner
+
+
+def release_job(chat_id: str, owner: str):
+    """Снимает блокировку задания и удаляет каталог чата.
+
+    Если блокировка истекла и ее получило другое задание, каталог не удаляется (он принадлежит новому заданию).
+    """
+    with running_jobs_lock:
+        if running_jobs.get(chat_id) == owner:
+            del running_jobs[chat_id]
+    name = f"job:{chat_id}"
+    if backend.acquire_lock(name, owner, JOB_LOCK_TTL):  # блокировка все еще наша (или свободна)
+        shutil.rmtree(chat_id, ignore_errors=True)
+        backend.release_lock(name, owner)
+    else:
+        log.warning(f"Блокировка задания истекла и занята другим заданием, каталог не удален (chat_id: {chat_id})")
+    ACTIVE_JOBS.dec()
+
+
+# Выполняющиеся задания процесса (chat_id -> владелец блокировки), блокировки продлевает отдельный поток:
+# обработчики выполняют долгие операции в потоке событий
+running_jobs = {}
+running_jobs_lock = threading.Lock()
+_renewal_thread = None
+
+
+def start_lock_renewal():
+    global _renewal_thread
+    if _renewal_thread is None:
+        _renewal_thread = threading.Thread(target=renew_job_locks, name="job-locks", daemon=True)
+        _renewal_thread.start()
+
+
+def renew_job_locks():
+    """Продлевает блокировки выполняющихся заданий каждые JOB_LOCK_RENEW секунд."""
+    while True:
+        time.sleep(JOB_LOCK_RENEW)
+        with running_jobs_lock:
+            jobs = list(running_jobs.items())
+        for chat_id, owner in jobs:
+            try:
+                if not backend.acquire_lock(f"job:{chat_id}", owner, JOB_LOCK_TTL):
+                    log.warning(f"Не удалось продлить блокировку задания (chat_id: {chat_id})")
+            except Exception as e:
+                log.warning(f"Ошибка продления блокировки задания (chat_id: {chat_id}): {e}")
+
+
+# Документы последних списков чатов в памяти процесса (обновления чата всегда обрабатывает один процесс);
+# если документа нет (перезапуск), он создается заново по сохраненному списку kinopoisk id
+card_documents = OrderedDict()
+
+
+def list_template(list_format: str) -> str:
+    if list_format == "pdf" and args.libre:
+        return get_resource_path('template_libre.docx')
+    return get_resource_path('template.docx')
+
+
+def remember_list(chat_id: str, list_format: str, codes: list, titles: list, card: CardDocument = None):
+    """Запоминает последний список чата для изменения командами /add, /remove и /move."""
+    backend.set("chat_list", chat_id, {"format": list_format, "codes": codes, "titles": titles}, ttl=LIST_TTL)
+    card_documents.pop(chat_id, None)
+    if card is not None:
+        card_documents[chat_id] = card
+        while len(card_documents) > CARD_DOCUMENTS_MAX:
+            card_documents.popitem(last=False)
+
+
+def forget_list(chat_id: str):
+    backend.delete("chat_list", chat_id)
+    card_documents.pop(chat_id, None)
+
+
+def load_card_document(chat_id: str, record: dict) -> CardDocument:
+    """Документ последнего списка чата (из памяти или заново по сохраненным kinopoisk id).
+
+    Returns:
+        CardDocument: документ или None, если не все фильмы списка удалось загрузить
+            (номера фильмов в командах не совпали бы с документом)
+    """
+    card = card_documents.get(chat_id)
+    if card is not None and card.codes == record["codes"]:
+        return card
+    log.info(f"Документ списка для {chat_id} создается заново ({len(record['codes'])} фильмов)")
+    if not os.path.isdir(chat_id):
+        os.mkdir(chat_id)
+    card = CardDocument(list_template(record["format"]))
+    card.build(get_full_film_list(record["codes"], kinopoisk_api), chat_id + "/list.docx")
+    if card.codes != record["codes"]:
+        missing = [str(code) for code in record["codes"] if code not in card.codes]
+        log.warning(f"Документ списка для {chat_id} не создан, не загружены: {', '.join(missing)}")
+        return None
+    return card
+
+
 # Initialize bot and dispatcher
-storage = MemoryStorage()
-bot = Bot(token=TELEGRAM_API_TOKEN)
+backend = open_backend(args.state)
+set_cache_backend(backend)
+set_offline_mode(args.offline)
+install_http_cache(get_resource_path('cache'), getattr(config, "HTTP_CACHE_MAX_SIZE", HTTP_CACHE_MAX_SIZE))
+storage = BackendStorage(backend)
+kinopoisk_api = api_from_config(config, backend)
+QUEUE_DEPTH.set_function(backend.pending_updates)
+if args.api_server:
+    from aiogram.bot.api import TelegramAPIServer
+    bot = Bot(token=TELEGRAM_API_TOKEN, server=TelegramAPIServer.from_base(args.api_server))
+else:
+    bot = Bot(token=TELEGRAM_API_TOKEN)
 dp = Dispatcher(bot, storage=storage)
 
 
@@ -48,6 +307,7 @@ class DocFormat(StatesGroup):
     pdf = State()
     docx = State()
     info = State()
+    all = State()
 
 
 @dp.message_handler(state='*', commands=['start', 'help'])
@@ -56,9 +316,12 @@ async def send_welcome(message: types.Message):
     This handler will be called when user sends `/start` or `/help` command
     """
     log.info(f"Начало работы (chat_id: {message.chat.id})")
-    if os.path.exists("./" + str(message.chat.id)):
-        shutil.rmtree("./" + str(message.chat.id))
-        log.info(f"Каталог очищен")
+    chat_id = str(message.chat.id)
+    owner = acquire_job(chat_id)
+    if owner is not None:  # каталог выполняющегося задания не удаляется
+        if os.path.exists("./" + chat_id):
+            log.info(f"Каталог очищен")
+        release_job(chat_id, owner)
     await DocFormat.pdf.set()
     await message.reply("Привет, я Кinolist Bot!\nОтправьте мне список фильмов, и я пришлю его в формате pdf.")
 
@@ -84,6 +347,48 @@ async def send_welcome(message: types.Message):
     await message.reply("Ок, отправьте мне название фильма, и я пришлю его описание в чат\.", parse_mode="MarkdownV2")
 
 
+@dp.message_handler(state='*', commands=['all'])
+async def send_welcome(message: types.Message):
+    log.info(f"Переключение на отправку списков во всех форматах (chat_id: {message.chat.id})")
+    await DocFormat.all.set()
+    await message.reply("Ок, отправьте мне список фильмов, и я пришлю его в форматах *pdf*, *docx*, краткий список *docx* и *txt*\.",
+                        parse_mode="MarkdownV2")
+
+
+@dp.message_handler(state='*', commands=['list'])
+async def show_list(message: types.Message):
+    record = backend.get("chat_list", str(message.chat.id))
+    if record is None:
+        await message.reply("Списка пока нет, отправьте мне список фильмов.")
+        return
+    await message.reply(numbered_list(record["titles"]))
+
+
+@dp.message_handler(state='*', commands=['add', 'remove', 'move'])
+@trace("edit")
+@sampled("edit")
+async def edit_list(message: types.Message):
+    """Изменение последнего списка чата: /add названия (по одному в строке), /remove номера, /move откуда куда."""
+    chat_id = str(message.chat.id)
+    command = message.get_command(pure=True).lower()
+    annotate(chat_id=chat_id, command=command)
+    record = backend.get("chat_list", chat_id)
+    if record is None:
+        await message.reply("Списка пока нет, отправьте мне список фильмов.")
+        return
+    if command == "add" and not await check_api(message):
+        return
+    owner = acquire_job(chat_id)
+    if owner is None:
+        log.info(f"Задание для {chat_id} уже выполняется")
+        await message.reply("Подождите, я все еще работаю!")
+        return
+    try:
+        await apply_edit(message, chat_id, record, command, message.get_args() or "")
+    finally:
+        release_job(chat_id, owner)
+
+
 @dp.message_handler(state='*', commands=['lisa', 'Lisa'])
 async def send_heart(message: types.Message):
     stickers = ["CAACAgIAAxkBAAEEjSZiZXLQqPDFY70qC0m9PPH2AAEJjfgAAjIAA-Sgzgd7_cFVbY2YfiQE",
@@ -99,24 +404,32 @@ async def send_heart(message: types.Message):
 
 
 @dp.message_handler(state=DocFormat.pdf)
+@trace("pdf")
+@sampled("pdf")
 async def reply(message: types.Message):
-    if not is_api_ok(KINOPOISK_API_TOKEN):
-        log.warning("API error.")
-        await message.reply("Ой, что-то сломалось!((\n(API error)")
+    if not await check_api(message):
         return
 
     chat_id = str(message.chat.id)
+    annotate(chat_id=chat_id, films=len(list(filter(None, message.text.split('\n')))))
     log.info(f"Начало создания списка для chat_id: {chat_id}")
-    if os.path.isdir(chat_id):
-        log.info(f"Папка {chat_id} обнаружена")
+    owner = acquire_job(chat_id)
+    if owner is None:
+        log.info(f"Задание для {chat_id} уже выполняется")
         await message.reply("Подождите, я все еще работаю!")
         return
+    try:
+        await make_pdf(message, chat_id)
+    finally:
+        release_job(chat_id, owner)
 
+
+async def make_pdf(message: types.Message, chat_id: str):
     film_list = message.text.split('\n')
     film_list = list(filter(None, film_list))
     log.info("Запрос: " + ", ".join(film_list))
 
-    kp_id = find_kp_id(film_list, KINOPOISK_API_TOKEN)
+    kp_id = find_kp_id(film_list, kinopoisk_api)
     film_codes = kp_id[0]
     film_not_found = kp_id[1]
 
@@ -126,7 +439,7 @@ async def reply(message: types.Message):
         await message.reply("Ой, ничего не найдено!")
         return
 
-    full_films_list = get_full_film_list(film_codes, KINOPOISK_API_TOKEN)
+    full_films_list = get_full_film_list(film_codes, kinopoisk_api)
     if len(full_films_list) < 1:
         await message.reply("Ни один фильм не найден!")
         return
@@ -135,7 +448,7 @@ async def reply(message: types.Message):
     else:
         template_path = get_resource_path('template.docx')
     try:
-        doc = Document(template_path)
+        card = CardDocument(template_path)
     except Exception:
         log.warning('Не найден шаблон "template.docx". Список не создан.')
         await message.reply("Ой, что-то сломалось!((")
@@ -146,12 +459,13 @@ async def reply(message: types.Message):
 
     path_docx = chat_id + "/list.docx"
     try:
-        write_all_films_to_docx(doc, full_films_list, path_docx)
+        card.build(full_films_list, path_docx)
     except:
         log.warning('Ошибка при записи файла docx')
         await message.reply("Ой, что-то сломалось!((")
         return
     path_pdf = chat_id + "/list.pdf"
+    profile_tag(format="pdf")
     if args.libre:
         log.info("Конвертация docx в pdf через Libre Office")
         if docx_to_pdf_libre(path_docx) != 0:
@@ -160,38 +474,49 @@ async def reply(message: types.Message):
             return
     else:
         log.info("Конвертация docx в pdf через Microsoft Word")
-        convert(path_docx, path_pdf)
-    log.info(f'Файл "{path_pdf}" создан.')
-    with open(path_pdf, 'rb') as pdf:
+        from docx2pdf import convert  # только Windows и macOS
+        with stage("pdf_convert"):
+            convert(path_docx, path_pdf)
+    log.info(f'Файл "{path_pdf}" создан ({os.path.getsize(path_pdf) / 1024 / 1024:.1f} МБ).')
+    with open(path_pdf, 'rb') as pdf, stage("telegram_upload"):
         if len(film_not_found) > 0:
             text = "Список готов!\n" + "Правда, вот эти фильмы не смог найти:\n" + "\n".join(film_not_found)
             await message.reply_document(pdf, caption=text)
         else:
             await message.reply_document(pdf, caption='Список готов!')
+    LISTS_CREATED.labels(format="pdf").inc()
+    remember_list(chat_id, "pdf", card.codes, card.titles, card)
     log.info(f'Список отправлен в чат: {chat_id}')
-    shutil.rmtree(chat_id)
     return
 
 
 @dp.message_handler(state=DocFormat.docx)
+@trace("docx")
+@sampled("docx")
 async def reply(message: types.Message):
-    if not is_api_ok(KINOPOISK_API_TOKEN):
-        log.warning("API error.")
-        await message.reply("Ой, что-то сломалось!((\n(API error)")
+    if not await check_api(message):
         return
 
     chat_id = str(message.chat.id)
+    annotate(chat_id=chat_id, films=len(list(filter(None, message.text.split('\n')))))
     log.info(f"Начало создания списка для chat_id: {chat_id}")
-    if os.path.isdir(chat_id):
-        log.info(f"Папка {chat_id} обнаружена")
+    owner = acquire_job(chat_id)
+    if owner is None:
+        log.info(f"Задание для {chat_id} уже выполняется")
         await message.reply("Подождите, я все еще работаю!")
         return
+    try:
+        await make_docx_list(message, chat_id)
+    finally:
+        release_job(chat_id, owner)
 
+
+async def make_docx_list(message: types.Message, chat_id: str):
     film_list = message.text.split('\n')
     film_list = list(filter(None, film_list))
     log.info("Запрос: " + ", ".join(film_list))
 
-    kp_id = find_kp_id(film_list, KINOPOISK_API_TOKEN)
+    kp_id = find_kp_id(film_list, kinopoisk_api)
     film_codes = kp_id[0]
     film_not_found = kp_id[1]
 
@@ -201,14 +526,14 @@ async def reply(message: types.Message):
         await message.reply("Ой, ничего не найдено!")
         return
 
-    full_films_list = get_full_film_list(film_codes, KINOPOISK_API_TOKEN)
+    full_films_list = get_full_film_list(film_codes, kinopoisk_api)
     if len(full_films_list) < 1:
         await message.reply("Ни один фильм не найден!")
         return
 
     template_path = get_resource_path('template.docx')
     try:
-        doc = Document(template_path)
+        card = CardDocument(template_path)
     except Exception:
         log.warning('Не найден шаблон "template.docx". Список не создан.')
         await message.reply("Ой, что-то сломалось!((")
@@ -219,38 +544,102 @@ async def reply(message: types.Message):
 
     path_docx = chat_id + "/list.docx"
     try:
-        write_all_films_to_docx(doc, full_films_list, path_docx)
+        card.build(full_films_list, path_docx)
     except:
         log.warning('Ошибка при записи файла docx')
         await message.reply("Ой, что-то сломалось!((")
         return
 
-    with open(path_docx, 'rb') as docx:
+    with open(path_docx, 'rb') as docx, stage("telegram_upload"):
         if len(film_not_found) > 0:
             text = "Список готов!\n" + "Правда, вот эти фильмы не смог найти:\n" + "\n".join(film_not_found)
             await message.reply_document(docx, caption=text)
         else:
             await message.reply_document(docx, caption='Список готов!')
+    LISTS_CREATED.labels(format="docx").inc()
+    remember_list(chat_id, "docx", card.codes, card.titles, card)
     log.info(f'Список отправлен в чат: {chat_id}')
-    shutil.rmtree(chat_id)
+    return
+
+
+@dp.message_handler(state=DocFormat.all)
+@trace("all")
+@sampled("all")
+async def reply(message: types.Message):
+    if not await check_api(message):
+        return
+
+    chat_id = str(message.chat.id)
+    annotate(chat_id=chat_id, films=len(list(filter(None, message.text.split('\n')))))
+    log.info(f"Начало создания списка для chat_id: {chat_id}")
+    owner = acquire_job(chat_id)
+    if owner is None:
+        log.info(f"Задание для {chat_id} уже выполняется")
+        await message.reply("Подождите, я все еще работаю!")
+        return
+    try:
+        await make_all_formats(message, chat_id)
+    finally:
+        release_job(chat_id, owner)
+
+
+async def make_all_formats(message: types.Message, chat_id: str):
+    """Один поиск и одна загрузка информации о фильмах - список во всех форматах (см. render_formats)."""
+    film_list = message.text.split('\n')
+    film_list = list(filter(None, film_list))
+    log.info("Запрос: " + ", ".join(film_list))
+
+    film_codes, film_not_found = find_kp_id(film_list, kinopoisk_api)
+    if len(film_not_found) > 0:
+        log.info(f'Не найдено: {", ".join(film_not_found)}')
+    if len(film_codes) == 0:
+        await message.reply("Ой, ничего не найдено!")
+        return
+
+    full_films_list = get_full_film_list(film_codes, kinopoisk_api)
+    if len(full_films_list) < 1:
+        await message.reply("Ни один фильм не найден!")
+        return
+
+    if not os.path.isdir(chat_id):
+        os.mkdir(chat_id)
+    paths = render_formats(full_films_list, OUTPUT_FORMATS, chat_id + "/list.docx", 'template.docx',
+                           'template_libre.docx' if args.libre else 'template.docx', libre=args.libre)
+    created = [(name, path) for name, path in paths.items() if path]
+    if not created:
+        await message.reply("Ой, что-то сломалось!((")
+        return
+
+    text = 'Список готов!'
+    if len(film_not_found) > 0:
+        text = "Список готов!\n" + "Правда, вот эти фильмы не смог найти:\n" + "\n".join(film_not_found)
+    with stage("telegram_upload"):
+        for i, (name, path) in enumerate(created):
+            with open(path, 'rb') as document:
+                await message.reply_document(document, caption=text if i == len(created) - 1 else None)
+    for name, _path in created:
+        LISTS_CREATED.labels(format=name).inc()
+    forget_list(chat_id)  # списки во всех форматах не изменяются командами /add, /remove, /move
+    log.info(f'Списки ({", ".join(name for name, _path in created)}) отправлены в чат: {chat_id}')
     return
 
 
 @dp.message_handler(state=DocFormat.info)
+@trace("info")
+@sampled("info")
 async def reply(message: types.Message):
-    if not is_api_ok(KINOPOISK_API_TOKEN):
-        log.warning("API error.")
-        await message.reply("Ой, что-то сломалось!((\n(API error)")
+    if not await check_api(message):
         return
 
     chat_id = str(message.chat.id)
+    annotate(chat_id=chat_id, films=len(list(filter(None, message.text.split('\n')))))
     log.info(f"Начало создания списка для chat_id: {chat_id}")
 
     film_list = message.text.split('\n')
     film_list = list(filter(None, film_list))
     log.info("Запрос: " + ", ".join(film_list))
 
-    kp_id = find_kp_id(film_list, KINOPOISK_API_TOKEN)
+    kp_id = find_kp_id(film_list, kinopoisk_api)
     film_codes = kp_id[0]
     film_not_found = kp_id[1]
 
@@ -260,26 +649,198 @@ async def reply(message: types.Message):
         await message.reply("Ой, ничего не найдено!")
         return
 
-    full_films_list = get_full_film_list(film_codes, KINOPOISK_API_TOKEN)
+    full_films_list = get_full_film_list(film_codes, kinopoisk_api, fields=FORMAT_FIELDS["info"])
     if len(full_films_list) < 1:
         await message.reply("Ни один фильм не найден!")
         return
 
+    profile_tag(films=len(full_films_list), format="info")
     for film in full_films_list:
-        text = fmt.text(fmt.text(fmt.bold(f"{film[0]} ({film[1]}) - Кинопоиск {film[2]}") if film[2] != None else
-                                 fmt.bold(f"{film[0]} ({film[1]}) - нет рейтинга") ),
-                        fmt.text(", ".join(film[3])),
-                        fmt.text("Режиссер:" if len(film[7]) ==1 else "Режиссеры:", text_to_markdown(", ".join(film[7]))),
-                        fmt.text(""),
-                        fmt.text("В главных ролях:", fmt.underline(", ".join(film[8]))),
-                        fmt.text(""),
-                        fmt.text(text_to_markdown(film[4]) if (film[4]) != None else ""),
-                        sep="\n"
-        )
-        await message.reply_photo(film[6], caption=text, parse_mode="MarkdownV2")
+        await send_film_info(message, film)
+    LISTS_CREATED.labels(format="info").inc()
+    remember_list(chat_id, "info", [film[10] for film in full_films_list],
+                  [f"{film[0]} ({film[1]})" for film in full_films_list])
     log.info(f'Информация о фильмах отправлена в чат: {chat_id}')
     return
 
 
+async def send_film_info(message: types.Message, film: list):
+    text = fmt.text(fmt.text(fmt.bold(f"{film[0]} ({film[1]}) - Кинопоиск {film[2]}") if film[2] != None else
+                             fmt.bold(f"{film[0]} ({film[1]}) - нет рейтинга") ),
+                    fmt.text(", ".join(film[3])),
+                    fmt.text("Режиссер:" if len(film[7]) ==1 else "Режиссеры:", text_to_markdown(", ".join(film[7]))),
+                    fmt.text(""),
+                    fmt.text("В главных ролях:", fmt.underline(", ".join(film[8]))),
+                    fmt.text(""),
+                    fmt.text(text_to_markdown(film[4]) if (film[4]) != None else ""),
+                    sep="\n"
+    )
+    with stage("telegram_upload"):
+        await message.reply_photo(film[6], caption=text, parse_mode="MarkdownV2")
+
+
+def numbered_list(titles: list) -> str:
+    return "\n".join(f"{num}. {title}" for num, title in enumerate(titles, start=1)) or "Список пуст."
+
+
+def parse_positions(text: str, titles: list) -> list:
+    """Номера фильмов (от 0) из аргументов команды: номера через пробел или запятую либо название фильма."""
+    words = text.replace(",", " ").split()
+    if words and all(word.isdigit() for word in words):
+        positions = [int(word) - 1 for word in words]
+        return positions if all(0 <= position < len(titles) for position in positions) else []
+    text = text.strip().lower()
+    return [num for num, title in enumerate(titles) if text and title.lower().startswith(text)][:1]
+
+
+async def apply_edit(message: types.Message, chat_id: str, record: dict, command: str, text: str):
+    """Выполняет /add, /remove или /move над последним списком чата. Перерисовываются только измененные карточки."""
+    list_format = record["format"]
+    film_not_found = []
+    if command == "add":
+        film_list = list(filter(None, (line.strip() for line in text.split('\n'))))
+        if not film_list:
+            await message.reply("Напишите после /add названия фильмов, по одному в строке.")
+            return
+        log.info("Добавление: " + ", ".join(film_list))
+        film_codes, film_not_found = find_kp_id(film_list, kinopoisk_api)
+        films = get_full_film_list(film_codes, kinopoisk_api, fields=FORMAT_FIELDS[list_format]) if film_codes else []
+        if not films:
+            await message.reply("Ой, ничего не найдено!")
+            return
+    elif command == "remove":
+        positions = parse_positions(text, record["titles"])
+        if not positions:
+            await message.reply("Не нашел такие фильмы в списке. Пример: /remove 2 5\n\n" + numbered_list(record["titles"]))
+            return
+    else:
+        positions = [int(word) - 1 for word in text.replace(",", " ").split() if word.isdigit()]
+        if len(positions) != 2 or not all(0 <= position < len(record["codes"]) for position in positions):
+            await message.reply("Укажите, откуда и куда переставить фильм. Пример: /move 5 1\n\n" + numbered_list(record["titles"]))
+            return
+
+    if list_format == "info":
+        codes, titles = list(record["codes"]), list(record["titles"])
+        if command == "add":
+            for film in films:
+                await send_film_info(message, film)
+                codes.append(film[10])
+                titles.append(f"{film[0]} ({film[1]})")
+        elif command == "remove":
+            for position in sorted(set(positions), reverse=True):
+                del codes[position], titles[position]
+        else:
+            codes.insert(positions[1], codes.pop(positions[0]))
+            titles.insert(positions[1], titles.pop(positions[0]))
+        remember_list(chat_id, list_format, codes, titles)
+        if command != "add":
+            await message.reply(numbered_list(titles))
+        return
+
+    card = load_card_document(chat_id, record)
+    if card is None:
+        await message.reply("Ой, не удалось загрузить фильмы списка!((\nПопробуйте позже.")
+        return
+    if command == "add":
+        card.add(films)
+    elif command == "remove":
+        for position in sorted(set(positions), reverse=True):
+            card.remove(position)
+    else:
+        card.move(*positions)
+    if not len(card):
+        forget_list(chat_id)
+        await message.reply("Список пуст.")
+        return
+    remember_list(chat_id, list_format, card.codes, card.titles, card)
+
+    if not os.path.isdir(chat_id):
+        os.mkdir(chat_id)
+    path = chat_id + "/list.docx"
+    card.save(path)
+    if list_format == "pdf":
+        path = docx_to_pdf(path, args.libre)
+        if path is None:
+            await message.reply("Ой, что-то сломалось!((")
+            return
+    text = "Список обновлен!"
+    if film_not_found:
+        text += "\nПравда, вот эти фильмы не смог найти:\n" + "\n".join(film_not_found)
+    with open(path, 'rb') as document, stage("telegram_upload"):
+        await message.reply_document(document, caption=text)
+    log.info(f'Обновленный список ({command}) отправлен в чат: {chat_id}')
+
+
+def update_chat_id(update: dict) -> int:
+    """Определяет chat_id входящего обновления для распределения по процессам."""
+    for key in ("message", "edited_message", "channel_post", "edited_channel_post"):
+        if key in update:
+            return update[key]["chat"]["id"]
+    if "callback_query" in update and "message" in update["callback_query"]:
+        return update["callback_query"]["message"]["chat"]["id"]
+    for value in update.values():
+        if isinstance(value, dict) and "from" in value:
+            return value["from"]["id"]
+    return 0
+
+
+async def poll_updates(workers: int):
+    """Получает обновления от Telegram и раскладывает их в очереди процессов по chat_id."""
+    updates = await bot.get_updates(offset=-1, timeout=1)  # skip_updates
+    offset = updates[-1].update_id + 1 if updates else None
+    while True:
+        try:
+            updates = await bot.get_updates(offset=offset, timeout=20)
+        except Exception as e:
+            log.warning(f"Ошибка получения обновлений: {e}")
+            await asyncio.sleep(5)
+            continue
+        for update in updates:
+            payload = update.to_python()
+            backend.push_update(update_chat_id(payload) % workers, payload)
+            offset = update.update_id + 1
+
+
+async def process_update(payload: dict, semaphore: asyncio.Semaphore):
+    try:
+        await dp.process_update(types.Update.to_object(payload))
+    except Exception as e:
+        log.error(f"Ошибка обработки обновления {payload.get('update_id')}: {e}")
+    finally:
+        semaphore.release()
+
+
+async def process_shard(shard: int):
+    """Обрабатывает обновления из очереди процесса shard (не больше SHARD_CONCURRENCY одновременно)."""
+    Bot.set_current(bot)
+    Dispatcher.set_current(dp)
+    semaphore = asyncio.Semaphore(SHARD_CONCURRENCY)
+    while True:
+        updates = backend.pop_updates(shard)
+        if not updates:
+            await asyncio.sleep(0.2)
+            continue
+        for payload in updates:
+            await semaphore.acquire()
+            asyncio.create_task(process_update(payload, semaphore))
+
+
+def run_worker(shard: int):
+    log.info(f"Запуск обработчика {shard} (pid: {os.getpid()})")
+    # лимит частоты запросов к Kinopoisk API общий для ключа, процессы делят его поровну
+    kinolist_api.rate_limiter = kinolist_api.RateLimiter(kinolist_api.REQUESTS_PER_SECOND / args.workers)
+    if args.metrics:
+        start_http_server(args.metrics + shard + 1)
+    asyncio.run(process_shard(shard))
+
+
 if __name__ == '__main__':
-    executor.start_polling(dp, skip_updates=True)
+    if args.metrics:
+        start_http_server(args.metrics)
+    if args.workers > 1:
+        workers = [multiprocessing.Process(target=run_worker, args=(i,), daemon=True) for i in range(args.workers)]
+        for worker in workers:
+            worker.start()
+        asyncio.run(poll_updates(args.workers))
+    else:
+        executor.start_polling(dp, skip_updates=True)
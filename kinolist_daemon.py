@@ -0,0 +1,183 @@
+"""Фоновый процесс kl и клиент для него.
+
+Запуск фонового процесса:  kl --daemon [SOCKET]
+Выполнение команды:        python kinolist_daemon.py [параметры kl]
+
+Фоновый процесс один раз загружает библиотеки, кэши, шаблоны и соединения HTTP и выполняет
+команды kl, полученные через Unix-сокет. Клиент не импортирует тяжелые библиотеки; если фоновый
+процесс не запущен, команда выполняется в текущем процессе.
+
+Протокол - строки json: клиент отправляет {"argv": [...], "cwd": "..."} и затем ответы на вопросы
+({"in": "..."}), сервер отправляет вывод ({"out": "..."}), запросы ввода ({"read": true})
+и код завершения ({"exit": 0}).
+"""
+import io
+import json
+import logging
+import os
+import socket
+import sys
+import tempfile
+import threading
+
+log = logging.getLogger("Daemon")
+
+DAEMON_SOCKET = os.path.join(tempfile.gettempdir(), f"kinolist-{os.getuid() if hasattr(os, 'getuid') else 0}.sock")
+
+
+class SocketWriter(io.TextIOBase):
+    """Поток вывода, который пересылает текст клиенту."""
+
+    def __init__(self, conn: socket.socket):
+        self.conn = conn
+
+    def writable(self):
+        return True
+
+    def write(self, text):
+        if text:
+            send(self.conn, {"out": text})
+        return len(text)
+
+
+class SocketReader(io.TextIOBase):
+    """Поток ввода, который читает ответы клиента (например, для подтверждения переименования)."""
+
+    def __init__(self, conn: socket.socket, reader):
+        self.conn = conn
+        self.reader = reader
+
+    def readable(self):
+        return True
+
+    def readline(self, size=-1):
+        send(self.conn, {"read": True})
+        line = self.reader.readline()
+        if not line:
+            return ""
+        return json.loads(line).get("in", "")
+
+
+def send(conn: socket.socket, message: dict):
+    conn.sendall((json.dumps(message, ensure_ascii=False) + "\n").encode())
+
+
+def run_job(conn: socket.socket, reader, request: dict) -> int:
+    """Выполняет одну команду kl с выводом в сокет. Возвращает код завершения."""
+    import kinolist_lib
+
+    handler = logging.StreamHandler(SocketWriter(conn))
+    handler.setFormatter(logging.Formatter('[%(asctime)s]%(levelname)s:%(name)s:%(message)s', datefmt='%d.%m.%Y %H:%M:%S'))
+    root = logging.getLogger()
+    saved = sys.stdout, sys.stderr, sys.stdin, os.getcwd(), root.handlers[:]
+    root.handlers = [handler]
+    sys.stdout = sys.stderr = SocketWriter(conn)
+    sys.stdin = SocketReader(conn, reader)
+    code = 0
+    try:
+        os.chdir(request["cwd"])
+        kinolist_lib.main(request["argv"])
+    except SystemExit as e:
+        code = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+    except Exception:
+        log.exception("Ошибка выполнения команды")
+        code = 1
+    finally:
+        sys.stdout, sys.stderr, sys.stdin, cwd, root.handlers = saved
+        os.chdir(cwd)
+    return code
+
+
+def serve(path: str = None):
+    """Запускает фоновый процесс, принимающий команды kl через Unix-сокет path."""
+    import kinolist_lib  # библиотеки загружаются один раз при запуске
+
+    path = path or DAEMON_SOCKET
+    if not hasattr(socket, "AF_UNIX"):
+        log.error("Unix-сокеты не поддерживаются в этой системе.")
+        return
+    if os.path.exists(path):
+        if ping(path):
+            log.error(f"Фоновый процесс уже запущен: {path}")
+            return
+        os.remove(path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    os.chmod(path, 0o600)
+    server.listen()
+    # команды выполняются по очереди: main() меняет текущий каталог и глобальные настройки библиотеки
+    job_lock = threading.Lock()
+    log.info(f"Kinolist Lib {kinolist_lib.LIB_VER}: фоновый процесс запущен, сокет {path}")
+
+    def handle(conn):
+        with conn, conn.makefile("r", encoding="utf-8") as reader:
+            line = reader.readline()
+            if not line:
+                return
+            request = json.loads(line)
+            if request.get("ping"):
+                send(conn, {"exit": 0})
+                return
+            with job_lock:
+                code = run_job(conn, reader, request)
+            send(conn, {"exit": code})
+
+    try:
+        while True:
+            conn, _ = server.accept()
+            threading.Thread(target=handle, args=(conn,), daemon=True).start()
+    except KeyboardInterrupt:
+        log.info("Фоновый процесс остановлен.")
+    finally:
+        server.close()
+        os.remove(path)
+
+
+def connect(path: str = None):
+    """Соединение с фоновым процессом или None, если он не запущен."""
+    path = path or DAEMON_SOCKET
+    if not hasattr(socket, "AF_UNIX") or not os.path.exists(path):
+        return None
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(path)
+    except OSError:
+        conn.close()
+        return None
+    return conn
+
+
+def ping(path: str = None) -> bool:
+    conn = connect(path)
+    if conn is None:
+        return False
+    with conn:
+        send(conn, {"ping": True})
+        return bool(conn.makefile("r", encoding="utf-8").readline())
+
+
+def run(argv: list, path: str = None) -> int:
+    """Выполняет команду kl в фоновом процессе (или в текущем процессе, если фоновый не запущен)."""
+    conn = connect(path or os.environ.get("KINOLIST_SOCKET"))
+    if conn is None:
+        import kinolist_lib
+        logging.basicConfig(level=logging.INFO, format='[%(asctime)s]%(levelname)s:%(name)s:%(message)s', datefmt='%d.%m.%Y %H:%M:%S')
+        kinolist_lib.main(argv)
+        return 0
+    with conn, conn.makefile("r", encoding="utf-8") as reader:
+        send(conn, {"argv": argv, "cwd": os.getcwd()})
+        for line in reader:
+            message = json.loads(line)
+            if "out" in message:
+                sys.stdout.write(message["out"])
+                sys.stdout.flush()
+            elif "read" in message:
+                send(conn, {"in": sys.stdin.readline()})
+            elif "exit" in message:
+                return message["exit"]
+    log.error("Соединение с фоновым процессом прервано.")
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(run(sys.argv[1:]))
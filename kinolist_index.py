@@ -0,0 +1,143 @@
+import logging
+import re
+import threading
+from collections import Counter
+
+log = logging.getLogger("Index")
+
+MIN_SCORE = 0.8  # ниже этого порога используется поиск через Kinopoisk API
+AMBIGUITY_MARGIN = 0.05  # разные фильмы с близкой оценкой считаются неоднозначным результатом
+AMBIGUITY_PENALTY = 0.25
+YEAR_BONUS = 0.15
+YEAR_PENALTY = 0.25
+NUMBER_PENALTY = 0.3  # разные номера в названии (Терминатор / Терминатор 2)
+
+
+def normalize(title: str) -> str:
+    """Приводит название к виду для сравнения: нижний регистр, ё -> е, без знаков препинания."""
+    title = title.lower().replace("ё", "е")
+    title = re.sub(r"[^\w\s]", " ", title)
+    return " ".join(title.split())
+
+
+def trigrams(text: str) -> set:
+    text = f"  {text} "
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def numbers(text: str) -> frozenset:
+    return frozenset(token for token in text.split() if token.isdigit())
+
+
+def split_year(query: str):
+    """Отделяет год в конце запроса: "Чужие (1986)" -> ("Чужие", 1986)."""
+    match = re.search(r"^(.*\S)[\s(\[]+((?:19|20)\d{2})[)\]]?\s*$", query)
+    if match:
+        return match.group(1), int(match.group(2))
+    return query, None
+
+
+class TitleIndex:
+    """Локальный индекс названий фильмов для поиска kinopoisk id без запросов к API.
+
+    Содержит русские и оригинальные названия и год фильма (запросы пользователей не сохраняются:
+    первый результат поиска может оказаться не тем фильмом).
+    Поиск по триграммам с учетом года. Записи сохраняются в общем хранилище
+    (пространство имен "titles") и добавляются в индекс по мере загрузки фильмов.
+    """
+
+    def __init__(self, backend=None):
+        self.backend = backend
+        self._names = []  # (kinopoisk_id, количество триграмм, числа в названии)
+        self._known = set()
+        self._grams = {}
+        self._films = {}
+        self._lock = threading.Lock()
+        if backend is not None:
+            self.load()
+
+    def __len__(self):
+        return len(self._films)
+
+    def load(self):
+        """Загружает индекс из хранилища."""
+        for kp_id, entry, _stored, _expires in self.backend.items("titles"):
+            self._add_names(kp_id, entry["names"], entry["year"])
+        log.info(f"Индекс названий: {len(self._films)} фильмов, {len(self._names)} названий")
+
+    def _add_names(self, kp_id, names, year):
+        with self._lock:
+            film = self._films.setdefault(kp_id, {"names": [], "year": year})
+            if year:
+                film["year"] = year
+            for name in names:
+                norm = normalize(name or "")
+                if not norm or (kp_id, norm) in self._known:
+                    continue
+                self._known.add((kp_id, norm))
+                film["names"].append(name)
+                idx = len(self._names)
+                grams = trigrams(norm)
+                self._names.append((kp_id, len(grams), numbers(norm)))
+                for gram in grams:
+                    self._grams.setdefault(gram, []).append(idx)
+
+    def add(self, kp_id, names: list, year=None):
+        """Добавляет названия фильма в индекс (и в хранилище)."""
+        kp_id = str(kp_id)
+        film = self._films.get(kp_id)
+        if film and all((kp_id, normalize(name or "")) in self._known for name in names) and (not year or film["year"] == year):
+            return
+        self._add_names(kp_id, names, year)
+        if self.backend is not None:
+            self.backend.set("titles", kp_id, self._films[kp_id])
+
+    def get(self, kp_id):
+        """Название и год фильма по kinopoisk id: (название, год) или None."""
+        film = self._films.get(str(kp_id))
+        if not film or not film["names"] or not film["year"]:
+            return None
+        return film["names"][0], film["year"]
+
+    def lookup(self, query: str):
+        """Поиск фильма по названию.
+
+        Returns:
+            tuple: (kinopoisk_id, название, год, оценка от 0 до 1) или None
+        """
+        title, year = split_year(query)
+        norm = normalize(title)
+        if not norm:
+            return None
+        query_grams = trigrams(norm)
+        query_numbers = numbers(norm)
+        counts = Counter()
+        for gram in query_grams:
+            counts.update(self._grams.get(gram, ()))
+        best = {}
+        for idx, shared in counts.items():
+            kp_id, name_grams, name_numbers = self._names[idx]
+            name_year = self._films[kp_id]["year"]
+            score = 2 * shared / (len(query_grams) + name_grams)
+            if query_numbers != name_numbers:
+                score -= NUMBER_PENALTY
+            if year and name_year:
+                score += YEAR_BONUS if int(name_year) == year else -YEAR_PENALTY
+            score = max(0.0, min(1.0, score))
+            if kp_id not in best or score > best[kp_id][3]:
+                best[kp_id] = (kp_id, self._films[kp_id]["names"][0], self._films[kp_id]["year"], score)
+        if not best:
+            return None
+        ranked = sorted(best.values(), key=lambda item: item[3], reverse=True)
+        result = ranked[0]
+        if len(ranked) > 1 and result[3] - ranked[1][3] < AMBIGUITY_MARGIN:
+            # несколько фильмов с похожими названиями (например, ремейки) - понижаем уверенность
+            result = result[:3] + (result[3] - AMBIGUITY_PENALTY,)
+        return result
+
+    def resolve(self, query: str, min_score: float = MIN_SCORE):
+        """kinopoisk id, название и год, если уверенность не ниже min_score, иначе None."""
+        result = self.lookup(query)
+        if result and result[3] >= min_score:
+            return result
+        return None
@@ -1,28 +1,27 @@
 import glob
+import hashlib
 import io
 import logging
 import os
 import re
+import shutil
 import sys
 import textwrap
 import time
 import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from copy import deepcopy
 from pathlib import Path
 
 
-import requests
-from docx import Document
-from docx.shared import Cm, Pt, RGBColor
-from kinopoisk_unofficial.kinopoisk_api_client import KinopoiskApiClient
-from kinopoisk_unofficial.request.films.film_request import FilmRequest
-from kinopoisk_unofficial.request.staff.staff_request import StaffRequest
-from mutagen.mp4 import MP4, MP4Cover, MP4StreamInfoError, MP4FreeForm, AtomDataType
-from PIL import Image
-from tqdm import tqdm
-import PTN
-import win32com.client
-import requests_cache
+import kinolist_api
+from kinolist_api import HTTP_CACHE_MAX_SIZE, api_from_config, api_get, http_get, install_http_cache, retry_stats
+from kinolist_index import TitleIndex
+from kinolist_metrics import CACHE_REQUESTS, DEFAULT_PORT as METRICS_PORT, FILMS_NOT_FOUND, stage, start_http_server
+from kinolist_profile import current_profile, profile, tag as profile_tag
+from kinolist_storage import export_bundle, import_bundle, open_backend
+from kinolist_trace import annotate, bind, configure as configure_tracing, span, trace
 
 LIB_VER = "0.2.40"
 
@@ -30,6 +29,40 @@ if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO, format='[%(asctime)s]%(levelname)s:%(name)s:%(message)s', datefmt='%d.%m.%Y %H:%M:%S')
 log = logging.getLogger("Lib")
 
+# Общее хранилище для кэша фильмов и результатов поиска (см. kinolist_storage)
+cache_backend = None
+# Локальный индекс названий для поиска kinopoisk id без запросов к API (см. kinolist_index)
+title_index = None
+FILM_CACHE_TTL = 7 * 24 * 3600
+SEARCH_CACHE_TTL = 24 * 3600
+# Устаревшие записи кэша отдаются сразу и обновляются в фоне, но не старше этого срока
+FILM_MAX_STALE = 30 * 24 * 3600
+SEARCH_MAX_STALE = 7 * 24 * 3600
+CACHE_NAMESPACES = ["search", "film", "poster"]
+# Поля информации о фильме (см. get_film_info). Загружаются только запросы, нужные для выбранных полей:
+# режиссеры и актеры - /api/v1/staff, постер - загрузка изображения, остальное - /api/v2.2/films/ID
+# (название и год берутся из индекса названий, если фильм уже найден поиском).
+FIELDS_ALL = frozenset({"title", "year", "rating", "countries", "description", "poster_url", "directors", "actors",
+                        "poster", "genres"})
+STAFF_FIELDS = frozenset({"directors", "actors"})
+FILM_FIELDS = FIELDS_ALL - STAFF_FIELDS
+INDEX_FIELDS = frozenset({"title", "year"})
+# Поля, которые нужны форматам списка (см. OUTPUT_FORMATS)
+FORMAT_FIELDS = {
+    "docx": FIELDS_ALL,
+    "pdf": FIELDS_ALL,
+    "newformat": frozenset({"title", "year", "directors", "actors"}),
+    "txt": frozenset({"title"}),
+    "info": FIELDS_ALL - {"poster"},  # карточки в чате бота: постер отправляется по ссылке
+}
+# Автономный режим: только данные из кэша, без запросов к Kinopoisk API
+offline_mode = False
+
+_refresh_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="revalidate")
+_refreshing = set()
+_refreshing_lock = threading.Lock()
+_metrics_server = None
+
 genres_hierarchy = [
     "мультфильм",
     "мюзикл",
@@ -68,13 +101,10 @@ def get_main_genre(genres: list, genres_hierarchy: list) -> str:
 def is_api_ok(api):
     '''Проверка авторизации.'''
     try:
-        api_client = KinopoiskApiClient(api)
-        request = FilmRequest(328)
-        api_client.films.send_film_request(request)
+        r = api_get('/api/v2.2/films/328', api)
     except Exception:
         return False
-    else:
-        return True
+    return r.status_code == 200
 
 
 def image_to_file(image):
@@ -84,6 +114,66 @@ def image_to_file(image):
     return image_file
 
 
+COVER_SIZE = (360, 540)
+# Постер в карточке фильма - 7 см по ширине. 130 dpi - 358 точек, почти исходный размер постера.
+POSTER_WIDTH_CM = 7
+POSTER_DPI = 130
+POSTER_QUALITY = 80
+# Ограничение Telegram на размер файла, отправляемого ботом, - 50 МБ
+DOCX_MAX_SIZE = 45 * 1024 * 1024
+# Перекодированные постеры: одинаковые изображения дают одинаковые байты, и python-docx
+# сохраняет их в документе одной частью word/media (совпадение по sha1)
+_poster_files = {}
+_poster_files_lock = threading.Lock()
+POSTER_FILES_MAX = 512
+
+
+def poster_size(dpi: int = POSTER_DPI) -> tuple:
+    """Размер постера в точках для ширины POSTER_WIDTH_CM при разрешении dpi (не больше COVER_SIZE)."""
+    width = min(COVER_SIZE[0], round(POSTER_WIDTH_CM / 2.54 * dpi))
+    return width, round(width * 1.5)
+
+
+def cover_to_file(cover, quality: int = POSTER_QUALITY, dpi: int = POSTER_DPI):
+    """Обложка как file-like object для вставки в docx (JPEG размером poster_size(dpi)).
+
+    Обложка в исходном виде (bytes из тегов mp4) вставляется без перекодирования, если это JPEG
+    не больше COVER_SIZE: такие обложки записывает write_tags_to_mp4, в карточке шириной 7 см это ~130 dpi.
+    Обложки PNG перекодируются в JPEG: без потерь они в несколько раз больше, а размер docx ограничен
+    (DOCX_MAX_SIZE). Остальные изображения уменьшаются и перекодируются в JPEG с качеством quality;
+    результат запоминается, поэтому одинаковые постеры (например, no_poster.jpg) кодируются один раз.
+    """
+    from PIL import Image
+    size = poster_size(dpi)
+    if isinstance(cover, (bytes, bytearray)):
+        image = Image.open(io.BytesIO(cover))  # читается только заголовок
+        if image.format == "JPEG" and image.width <= COVER_SIZE[0] and image.height <= COVER_SIZE[1]:
+            return io.BytesIO(cover)
+        digest = hashlib.sha1(cover).hexdigest()
+    else:
+        image = cover
+        digest = hashlib.sha1(image.tobytes()).hexdigest() + f"{image.mode}{image.size}"
+    key = (digest, size, quality)
+    with _poster_files_lock:
+        data = _poster_files.get(key)
+    if data is None:
+        image = image.copy()
+        image.thumbnail(size)
+        data = image_to_jpeg(image, quality)
+        with _poster_files_lock:
+            if len(_poster_files) >= POSTER_FILES_MAX:
+                _poster_files.clear()
+            _poster_files[key] = data
+    return io.BytesIO(data)
+
+
+def image_to_jpeg(image, quality: int = 90) -> bytes:
+    """Return `image` as JPEG bytes."""
+    image_file = io.BytesIO()
+    image.convert("RGB").save(image_file, format="JPEG", quality=quality, optimize=True)
+    return image_file.getvalue()
+
+
 def get_resource_path(relative_path):
     '''
     Определение пути для запуска из автономного exe файла.
@@ -97,7 +187,22 @@ def get_resource_path(relative_path):
     return os.path.join(base_path, relative_path)
 
 
+_templates = {}
+
+
+def load_template(path: str):
+    """Открывает шаблон docx. Файл читается и разбирается один раз (и повторно после изменения),
+    каждый вызов возвращает независимую копию разобранного документа."""
+    from docx import Document
+    mtime = os.path.getmtime(path)
+    if path not in _templates or _templates[path][0] != mtime:
+        _templates[path] = (mtime, Document(path))
+    return deepcopy(_templates[path][1])
+
+
 def get_target(lnk):
+    """Цель ярлыка .lnk (только Windows, через pywin32)."""
+    import win32com.client
     shell = win32com.client.Dispatch("WScript.Shell")
     shortcut = shell.CreateShortCut(lnk)
     return shortcut.Targetpath
@@ -110,7 +215,7 @@ def copy_table_after(table, paragraph):
     p.addnext(new_tbl)
 
 
-def clone_first_table(document: Document, num):
+def clone_first_table(document, num):
     '''Клонирует первую таблицу в документе num раз.'''
     template = document.tables[0]
     paragraph = document.paragraphs[0]
@@ -119,6 +224,173 @@ def clone_first_table(document: Document, num):
         paragraph = document.add_paragraph()
 
 
+def set_cache_backend(backend):
+    """Подключает общее хранилище (kinolist_storage.StateBackend) для кэша фильмов и поиска."""
+    global cache_backend, title_index
+    cache_backend = backend
+    title_index = TitleIndex(backend) if backend is not None else None
+
+
+def set_offline_mode(offline: bool):
+    """Включает автономный режим (только данные из кэша, устаревшие записи без ограничения срока)."""
+    global offline_mode
+    offline_mode = offline
+
+
+def cache_lookup(namespace: str, key: str, max_stale: float):
+    """Поиск записи в кэше.
+
+    Returns:
+        tuple: (значение, признак актуальности). Значение None, если записи нет
+               или она устарела больше чем на max_stale секунд.
+    """
+    entry = cache_backend.get_entry(namespace, key)
+    if entry is None:
+        CACHE_REQUESTS.labels(cache=namespace, result="miss").inc()
+        return None, False
+    value, _stored, expires = entry
+    now = time.time()
+    if expires is None or expires >= now:
+        CACHE_REQUESTS.labels(cache=namespace, result="hit").inc()
+        return value, True
+    if offline_mode or now - expires <= max_stale:
+        CACHE_REQUESTS.labels(cache=namespace, result="stale").inc()
+        return value, False
+    CACHE_REQUESTS.labels(cache=namespace, result="miss").inc()
+    return None, False
+
+
+def revalidate(namespace: str, key: str, fetch):
+    """Обновляет устаревшую запись кэша в фоне (не более одного обновления на запись)."""
+    if offline_mode:
+        return
+    with _refreshing_lock:
+        if (namespace, key) in _refreshing:
+            return
+        _refreshing.add((namespace, key))
+
+    def run():
+        try:
+            fetch()
+            log.info(f"Запись кэша обновлена: {namespace}/{key}")
+        except Exception as e:
+            log.warning(f"Не удалось обновить запись кэша {namespace}/{key}: {e}")
+        finally:
+            with _refreshing_lock:
+                _refreshing.discard((namespace, key))
+
+    _refresh_executor.submit(run)
+
+
+def film_to_record(film: list) -> dict:
+    """Преобразует информацию о фильме в запись для кэша (постер хранится отдельно в формате JPEG)."""
+    poster = io.BytesIO()
+    film[9].save(poster, format="JPEG", quality=95)
+    return {"info": film[:9] + [None] + film[10:], "poster": poster.getvalue()}
+
+
+def film_from_record(info: list, poster: bytes) -> list:
+    """Восстанавливает информацию о фильме из записи кэша (poster=None - без постера)."""
+    film = list(info)
+    if poster is not None:
+        from PIL import Image
+        film[9] = Image.open(io.BytesIO(poster))
+    return film
+
+
+def fields_for_formats(formats: list, genres: bool = False) -> frozenset:
+    """Поля информации о фильме, нужные для списка в форматах formats (см. FORMAT_FIELDS)."""
+    fields = frozenset().union(*(FORMAT_FIELDS[name] for name in formats))
+    return fields | {"genres"} if genres else fields
+
+
+def shorten_description(description: str) -> str:
+    """Сокращение описания фильма, чтобы поместились два фильма на странице."""
+    description = description.replace("\n\n", " ")
+    return textwrap.shorten(description, 665, fix_sentence_endings=True, break_long_words=False, placeholder='...')
+
+
+@span("search_film")
+def search_film(keyword: str, api: str, year: int = None):
+    """Поиск фильма по ключевому слову (первый результат поиска).
+
+    Если указан год, выбирается первый результат этого года (или первый результат, если таких нет).
+
+    Returns:
+        list: [kinopoisk_id, название, год] или пустой список, если фильм не найден.
+        None: ошибка доступа к API.
+    """
+    cache_key = f"{keyword} ({year})" if year else keyword
+    annotate(query=cache_key)
+    if title_index is not None:
+        found = title_index.resolve(cache_key)
+        CACHE_REQUESTS.labels(cache="titles", result="hit" if found else "miss").inc()
+        if found:
+            annotate(source="index")
+            return list(found[:3])
+    if cache_backend is not None:
+        cached, fresh = cache_lookup("search", cache_key, SEARCH_MAX_STALE)
+        if cached is not None:
+            annotate(source="cache" if fresh else "stale")
+            if not fresh:
+                revalidate("search", cache_key, lambda: fetch_search(keyword, api, year))
+            return cached
+    if offline_mode:
+        log.info(f'Нет в кэше (автономный режим): {cache_key}')
+        return []
+    annotate(source="api")
+    return fetch_search(keyword, api, year)
+
+
+def fetch_search(keyword: str, api: str, year: int = None):
+    """Поиск фильма в Kinopoisk API с сохранением результата в кэш (формат см. search_film)."""
+    payload = {'keyword': keyword, 'page': 1}
+    with stage("search"):
+        r = api_get('/api/v2.1/films/search-by-keyword', api, params=payload)
+    if r.status_code != 200:
+        log.warning(f'Ошибка доступа к {kinolist_api.KINOPOISK_URL} ({r.status_code}): {keyword}')
+        return None
+    resp_json = json.loads(r.text)
+    if resp_json['searchFilmsCountResult'] == 0:
+        result = []
+    else:
+        first = resp_json['films'][0]
+        if year:
+            first = next((film for film in resp_json['films'] if year_to_int(film['year']) == year), first)
+        if 'nameRu' in first:
+            found_film = first['nameRu']
+        else:
+            found_film = first['nameEn']
+        result = [first['filmId'], found_film, first['year']]
+        if title_index is not None:
+            # только названия из API: запрос пользователя мог найти не тот фильм (он кэшируется в "search" с TTL)
+            title_index.add(first['filmId'], [found_film, first.get('nameEn')], year_to_int(first['year']))
+    if cache_backend is not None:
+        cache_backend.set("search", f"{keyword} ({year})" if year else keyword, result, ttl=SEARCH_CACHE_TTL)
+    return result
+
+
+def year_to_int(year):
+    """Год из ответа поиска ("1991", "2010-2015") в виде числа или None."""
+    match = re.match(r"\d{4}", str(year or ""))
+    return int(match.group(0)) if match else None
+
+
+def update_title_index(mp4_files: list = None):
+    """Добавляет в индекс названий фильмы из кэша и из тегов mp4 файлов (по тегу kpid).
+
+    Returns:
+        int: количество фильмов в индексе
+    """
+    for film_code, info, _stored, _expires in cache_backend.items("film"):
+        title_index.add(film_code, [info[0]], info[1])
+    for file in mp4_files or []:
+        film = read_tags_record(file)
+        if film and film[10]:
+            title_index.add(film[10], [film[0]], film[1])
+    return len(title_index)
+
+
 def find_kp_id_in_title(title: str):
     """Находит тег KP~xxx в названии и возвращает xxx (kinopoisk id)
 
@@ -148,44 +420,34 @@ def find_kp_id(film_list: list, api: str):
     film_codes = []
     film_not_found = []
     for film in film_list:
-
-        code_in_name = find_kp_id_in_title(film)
-        if code_in_name:
+        with span("find_film", title=film):
+            code_in_name = find_kp_id_in_title(film)
+            if code_in_name:
+                try:
+                    film_info = get_film_info(code_in_name, api, fields=INDEX_FIELDS)
+                    log.info(f'Найден фильм: {film_info[0]} ({film_info[1]}), kinopoisk id: {code_in_name}')
+                    film_codes.append(code_in_name)
+                    continue
+                except Exception:
+                    film_not_found.append(code_in_name)
+                    continue
             try:
-                film_info = get_film_info(code_in_name, api)
-                log.info(f'Найден фильм: {film_info[0]} ({film_info[1]}), kinopoisk id: {code_in_name}')
-                film_codes.append(code_in_name)
-                continue
-            except Exception:
-                film_not_found.append(code_in_name)
-                continue
-        time.sleep(0.2)
-        payload = {'keyword': film, 'page': 1}
-        headers = {'X-API-KEY': api, 'Content-Type': 'application/json'}
-        try:
-            r = requests.get('https://kinopoiskapiunofficial.tech/api/v2.1/films/search-by-keyword', headers=headers, params=payload)
-            if r.status_code == 200:
-                resp_json = json.loads(r.text)
-                if resp_json['searchFilmsCountResult'] == 0:
+                found = search_film(film, api)
+                if found is None:
+                    film_not_found.append(film)
+                    continue
+                if not found:
                     log.info(f'{film} не найден')
                     film_not_found.append(film)
                     continue
-                else:
-                    id = resp_json['films'][0]['filmId']
-                    year = resp_json['films'][0]['year']
-                    if 'nameRu' in resp_json['films'][0]:
-                        found_film = resp_json['films'][0]['nameRu']
-                    else:
-                        found_film = resp_json['films'][0]['nameEn']
-                    log.info(f'Найден фильм: {found_film} ({year}), kinopoisk id: {id}')
-                    film_codes.append(id)
-            else:
-                log.warning('Ошибка доступа к https://kinopoiskapiunofficial.tech')
-                return
-        except Exception as e:
-            log.warning(f"Exeption: {e}")
-            film_not_found.append(film)
-            continue
+                id, found_film, year = found
+                log.info(f'Найден фильм: {found_film} ({year}), kinopoisk id: {id}')
+                film_codes.append(id)
+            except Exception as e:
+                log.warning(f"Exeption: {e}")
+                film_not_found.append(film)
+                continue
+    FILMS_NOT_FOUND.inc(len(film_not_found))
     return [film_codes, film_not_found]
 
 
@@ -194,48 +456,44 @@ def find_kp_id2(film: str, api: str):
     code_in_name = find_kp_id_in_title(film)
     if code_in_name:
         try:
-            film_info = get_film_info(code_in_name, api)
+            film_info = get_film_info(code_in_name, api, fields=INDEX_FIELDS)
             log.info(f'Найден фильм: {film_info[0]} ({film_info[1]}), kinopoisk id: {code_in_name}')
             result.append(code_in_name)
             result.append(film_info[0])
-            result.append({film_info[1]})
+            result.append(film_info[1])
             return result
         except Exception:
+            FILMS_NOT_FOUND.inc()
             return result
-    payload = {'keyword': film, 'page': 1}
-    headers = {'X-API-KEY': api, 'Content-Type': 'application/json'}
     try:
-        r = requests.get('https://kinopoiskapiunofficial.tech/api/v2.1/films/search-by-keyword', headers=headers, params=payload)
-        if r.status_code == 200:
-            resp_json = json.loads(r.text)
-            if resp_json['searchFilmsCountResult'] == 0:
+        found = search_film(film, api)
+        if not found:
+            if found is not None:
                 log.info(f'{film} не найден')
-                return result
-            else:
-                id = resp_json['films'][0]['filmId']
-                year = resp_json['films'][0]['year']
-                if 'nameRu' in resp_json['films'][0]:
-                    found_film = resp_json['films'][0]['nameRu']
-                else:
-                    found_film = resp_json['films'][0]['nameEn']
-                log.info(f'Найден фильм: {found_film} ({year}), kinopoisk id: {id}')
-                result.append(id)
-                result.append(found_film)
-                result.append(year)
-                return result
-        else:
-            log.warning('Ошибка доступа к https://kinopoiskapiunofficial.tech')
+            FILMS_NOT_FOUND.inc()
             return result
+        id, found_film, year = found
+        log.info(f'Найден фильм: {found_film} ({year}), kinopoisk id: {id}')
+        result.append(id)
+        result.append(found_film)
+        result.append(year)
+        return result
     except Exception as e:
         log.warning(f"Exeption: {e}")
         log.info(f'{film} не найден')
+        FILMS_NOT_FOUND.inc()
         return result
 
 
-def get_film_info(film_code: int, api, shorten=False):
+@span("get_film_info")
+def get_film_info(film_code: int, api, shorten=False, fields: frozenset = None):
     '''
     Получение информации о фильме с помощью kinopoisk_api_client.
 
+    fields - нужные поля (по умолчанию FIELDS_ALL, см. FORMAT_FIELDS). Запросы, не нужные для этих полей,
+    не выполняются, остальные поля - None (списки - пустые). В кэш сохраняется полная информация
+    и информация без постера (постер загружается и сохраняется, когда понадобится).
+
             Элементы списка:
                 0 - название фильма на русском языке
                 1 - год
@@ -251,108 +509,217 @@ def get_film_info(film_code: int, api, shorten=False):
                 11 - Жанры фильма
                 12 - Основной жанр
     '''
-    api_client = KinopoiskApiClient(api)
-    request_staff = StaffRequest(film_code)
-    response_staff = api_client.staff.send_staff_request(request_staff)
-
-    directors_list = []
-    for item in response_staff.items:
-        if item.profession_text == 'Режиссеры':
-            if item.name_ru == '':
-                directors_list.append(item.name_en)
-            else:
-                directors_list.append(item.name_ru)
+    result = None
+    fields = FIELDS_ALL if fields is None else fields
+    annotate(kp_id=film_code)
+    if cache_backend is not None:
+        record, fresh = cache_lookup("film", str(film_code), FILM_MAX_STALE)
+        poster = cache_backend.get_entry("poster", str(film_code)) if "poster" in fields else (None,)
+        if record is not None and poster is not None:
+            annotate(source="cache" if fresh else "stale")
+            result = film_from_record(record, poster[0])
+            if not fresh:
+                revalidate("film", str(film_code), lambda: cache_film_info(film_code, api))
+    if result is None:
+        if offline_mode:
+            raise LookupError(f"Фильм отсутствует в кэше (автономный режим), kinopoisk id: {film_code}")
+        annotate(source="api")
+        if fields >= FIELDS_ALL:
+            result = cache_film_info(film_code, api)
+        else:
+            annotate(fields=",".join(sorted(fields)))
+            result = fetch_film_info(film_code, api, fields)
+            if cache_backend is not None and fields >= FIELDS_ALL - {"poster"}:
+                cache_backend.set("film", str(film_code), result[:9] + [None] + result[10:], ttl=FILM_CACHE_TTL)
+    if shorten and result[4]:
+        result[4] = shorten_description(result[4])
+    return result
 
-    staff_list = []
-    for item in response_staff.items:
-        if len(staff_list) == 10:
-            break
-        if item.profession_text == 'Актеры':
-            if item.name_ru == '':
-                staff_list.append(item.name_en)
-            else:
-                staff_list.append(item.name_ru)
-
-    request_film = FilmRequest(film_code)
-    response_film = api_client.films.send_film_request(request_film)
-    # с помощью регулярного выражения находим значение стран в кавычках ''
-    countries = re.findall("'([^']*)'", str(response_film.film.countries))
-    # имя файла
-    if response_film.film.name_ru:
-        film_name = response_film.film.name_ru
-    else:
-        film_name = response_film.film.name_original
 
-    # Сокращение описания фильма
-    if shorten:
-        description = response_film.film.description.replace("\n\n", " ")
-        description = textwrap.shorten(description, 665, fix_sentence_endings=True, break_long_words=False, placeholder='...')
-    else:
-        description = response_film.film.description
-    if response_film.film.rating_kinopoisk:
-        rating = str(response_film.film.rating_kinopoisk)
-    else:
-        rating = ""
-
-    film_list = [
-        film_name, response_film.film.year, rating, countries, description, response_film.film.poster_url,
-        response_film.film.poster_url_preview
-    ]
-    result = film_list
-    result.append(directors_list)
-    result.append(staff_list)
-
-    # загрузка постера
-    cover_url = response_film.film.poster_url
-    cover = requests.get(cover_url, stream=True)
-    if cover.status_code == 200:
-        cover.raw.decode_content = True
-        image = Image.open(cover.raw)
-        width, height = image.size
-        # обрезка до соотношения сторон 1x1.5
-        if width > (height / 1.5):
-            image = image.crop((((width - height / 1.5) / 2), 0, ((width - height / 1.5) / 2) + height / 1.5, height))
-        elif height > (1.5 * width):
-            image = image.crop((0, ((height - width * 1.5) / 2), width, ((height + width * 1.5) / 2)))
-        image.thumbnail((360, 540))
-        rgb_image = image.convert('RGB')  # Fix "OSError: cannot write mode RGBA as JPEG"
-        result.append(rgb_image)
-    else:
-        cover = Image.open(get_resource_path("no_poster.jpg"))
-        result.append(cover)
-    result.append(film_code)
+def cache_film_info(film_code: int, api):
+    """Загружает информацию о фильме и сохраняет ее в кэш."""
+    result = fetch_film_info(film_code, api)
+    if cache_backend is not None:
+        record = film_to_record(result)
+        cache_backend.set("film", str(film_code), record["info"], ttl=FILM_CACHE_TTL)
+        cache_backend.set("poster", str(film_code), record["poster"], ttl=FILM_CACHE_TTL)
+        # постер из кэша, чтобы теги и хэш тегов совпадали при повторных запусках
+        result = film_from_record(record["info"], record["poster"])
+    return result
+
+
+def fetch_film_info(film_code: int, api, fields: frozenset = FIELDS_ALL):
+    """Загружает информацию о фильме из Kinopoisk API (формат см. get_film_info).
+
+    Выполняются только запросы, нужные для полей fields, остальные поля - None (списки - пустые).
+    """
+    result = [None, None, None, [], None, None, None, [], [], None, film_code, [], None]
+    if fields & STAFF_FIELDS:
+        with stage("staff_fetch"):
+            r = api_get('/api/v1/staff', api, params={'filmId': film_code})
+        r.raise_for_status()
+        response_staff = r.json()
+
+        directors_list = []
+        for item in response_staff:
+            if item['professionText'] == 'Режиссеры':
+                if not item['nameRu']:
+                    directors_list.append(item['nameEn'])
+                else:
+                    directors_list.append(item['nameRu'])
+
+        staff_list = []
+        for item in response_staff:
+            if len(staff_list) == 10 or "actors" not in fields:
+                break
+            if item['professionText'] == 'Актеры':
+                if not item['nameRu']:
+                    staff_list.append(item['nameEn'])
+                else:
+                    staff_list.append(item['nameRu'])
+        result[7] = directors_list
+        result[8] = staff_list
+
+    # название и год фильма, найденного поиском, известны без запроса к API
+    known = None
+    if title_index is not None and fields & FILM_FIELDS <= INDEX_FIELDS:
+        known = title_index.get(film_code)
+    if known is not None:
+        result[0], result[1] = known
+    elif fields & FILM_FIELDS:
+        with stage("film_fetch"):
+            r = api_get(f'/api/v2.2/films/{film_code}', api)
+        r.raise_for_status()
+        response_film = r.json()
+        countries = [item['country'] for item in response_film['countries']]
+        # имя файла
+        if response_film['nameRu']:
+            film_name = response_film['nameRu']
+        else:
+            film_name = response_film['nameOriginal']
 
-    # Добавляем информацию о жанрах фильма
-    genres = [genre.genre for genre in response_film.film.genres]
-    main_genre = get_main_genre(genres, genres_hierarchy)
-    result.append(genres)
-    result.append(main_genre)
+        if title_index is not None:
+            title_index.add(film_code, [response_film['nameRu'], response_film['nameOriginal'], response_film.get('nameEn')],
+                            response_film['year'])
+
+        description = response_film['description']
+        if response_film['ratingKinopoisk']:
+            rating = str(response_film['ratingKinopoisk'])
+        else:
+            rating = ""
+
+        result[0:7] = [
+            film_name, response_film['year'], rating, countries, description, response_film['posterUrl'],
+            response_film['posterUrlPreview']
+        ]
+
+        # загрузка постера
+        if "poster" in fields:
+            from PIL import Image
+            cover_url = response_film['posterUrl']
+            with stage("poster_download"):
+                cover = http_get(cover_url)
+                data = cover.content
+            if cover.status_code == 200:
+                with stage("poster_crop"):
+                    image = Image.open(io.BytesIO(data))
+                    width, height = image.size
+                    # обрезка до соотношения сторон 1x1.5
+                    if width > (height / 1.5):
+                        image = image.crop((((width - height / 1.5) / 2), 0, ((width - height / 1.5) / 2) + height / 1.5, height))
+                    elif height > (1.5 * width):
+                        image = image.crop((0, ((height - width * 1.5) / 2), width, ((height + width * 1.5) / 2)))
+                    image.thumbnail((360, 540))
+                    rgb_image = image.convert('RGB')  # Fix "OSError: cannot write mode RGBA as JPEG"
+                result[9] = rgb_image
+            else:
+                result[9] = Image.open(get_resource_path("no_poster.jpg"))
+
+        # Добавляем информацию о жанрах фильма
+        genres = [item['genre'] for item in response_film['genres']]
+        result[11] = genres
+        result[12] = get_main_genre(genres, genres_hierarchy)
 
     return result
 
 
-def get_full_film_list(film_codes: list, api: str, shorten=False):
+def get_full_film_list(film_codes: list, api: str, shorten=False, fields: frozenset = None):
     """Загружает информацию о фильмах
 
     Args:
         film_codes (list): Список kinopoisk_id фильмов
         api (str): Kinopoisk API token
         shorten (boolean): Option to shorten movie descriptions
+        fields (frozenset, optional): нужные поля (см. get_film_info), по умолчанию все
     Returns:
         list: Список с полной информацией о фильмах для записи в таблицу.
     """
+    from tqdm import tqdm
     full_films_list = []
+    stats_before = dict(retry_stats)  # счетчики общие для процесса, в лог - повторы за этот список
     for film_code in tqdm(film_codes, desc="Загрузка информации...   "):
         try:
-            film_info = get_film_info(film_code, api, shorten)
+            film_info = get_film_info(film_code, api, shorten, fields)
             full_films_list.append(film_info)
         except Exception as e:
-            log.warning(f"Exeption: {e}")
+            log.warning(f"Не удалось загрузить фильм (kinopoisk id: {film_code}): {e}")
         else:
             continue
+    retries = retry_stats["retries"] - stats_before["retries"]
+    failures = retry_stats["failures"] - stats_before["failures"]
+    if retries or failures:
+        log.info(f"Повторов запросов: {retries}, неудачных запросов: {failures}")
     return full_films_list
 
 
+def warm_cache(file: str, api, jobs: int = 4, restart: bool = False):
+    """Заполняет кэш поиска, фильмов и постеров по списку названий или kinopoisk id из файла.
+
+    Обработанные строки сохраняются в хранилище на время жизни кэша фильмов (FILM_CACHE_TTL),
+    повторный запуск продолжает с места остановки.
+
+    Args:
+        file (str): текстовый файл, по одному названию или KP~xxx в строке
+            (число без KP~ считается названием: "1917", "300")
+        api (str | ApiKeyPool): ключ или пул ключей Kinopoisk API
+        jobs (int): количество одновременных запросов
+        restart (bool): обработать все строки заново, не учитывая сохраненные
+    """
+    from tqdm import tqdm
+    progress_id = os.path.abspath(file)
+    lines = list(dict.fromkeys(filter(None, (line.strip() for line in file_to_list(file)))))
+    if restart:
+        pending = lines
+    else:
+        pending = [line for line in lines if not cache_backend.get("warmup", f"{progress_id}:{line}")]
+    log.info(f"Прогрев кэша: всего {len(lines)}, уже обработано {len(lines) - len(pending)}")
+
+    def warm(line):
+        film_code = find_kp_id_in_title(line)
+        if film_code is None:
+            found = search_film(line, api)
+            if not found:
+                return False
+            film_code = found[0]
+        get_film_info(film_code, api)
+        cache_backend.set("warmup", f"{progress_id}:{line}", 1, ttl=FILM_CACHE_TTL)
+        return True
+
+    not_found = []
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = {executor.submit(bind(warm), line): line for line in pending}
+        for future in tqdm(futures, desc="Прогрев кэша...          "):
+            try:
+                if not future.result():
+                    not_found.append(futures[future])
+            except Exception as e:
+                log.warning(f"Ошибка загрузки ({futures[future]}): {e}")
+                not_found.append(futures[future])
+    if not_found:
+        log.warning("Не найдены или не загружены: " + ", ".join(not_found))
+    log.info(f"Прогрев кэша завершен: загружено {len(pending) - len(not_found)}, ошибок {len(not_found)}")
+
+
 def write_film_to_table(current_table, filminfo: list, genres: bool = False):
     """Заполнение таблицы в файле docx.
 
@@ -360,6 +727,7 @@ def write_film_to_table(current_table, filminfo: list, genres: bool = False):
         current_table (Document object loaded from *docx*): указатель на текущую таблицу
         filminfo (list): информация о фильме
     """
+    from docx.shared import Cm, Pt, RGBColor
     paragraph = current_table.cell(0, 1).paragraphs[0]  # название фильма + рейтинг
     if filminfo[2] == "" or filminfo[2] == "None":
         run = paragraph.add_run(filminfo[0] + ' - ' + 'нет рейтинга')
@@ -425,18 +793,22 @@ def write_film_to_table(current_table, filminfo: list, genres: bool = False):
     # запись постера в таблицу
     paragraph = current_table.cell(0, 0).paragraphs[1]
     run = paragraph.add_run()
-    run.add_picture(image_to_file(filminfo[9]), width=Cm(7))
+    run.add_picture(cover_to_file(filminfo[9]), width=Cm(7))
 
 
-def write_all_films_to_docx(document, films: list, path: str, genres: bool = False):
+@stage("docx_write")
+def write_all_films_to_docx(document, films: list, path: str, genres: bool = False, max_size: int = DOCX_MAX_SIZE):
     """Записывает информацию о фильмах в таблицы файла docx
 
     Args:
         document (_type_): Объект файла docx
         films (list): Список с информацией о фильмах
         path (str): Путь и имя для сохранения нового файла docx
+        max_size (int): желаемый наибольший размер файла, байт (см. compact_docx)
 
     """
+    from tqdm import tqdm
+    profile_tag(films=len(films), format="docx")
     table_num = len(films)
     if table_num > 1:
         clone_first_table(document, table_num - 1)
@@ -448,10 +820,186 @@ def write_all_films_to_docx(document, films: list, path: str, genres: bool = Fal
         log.info(f'Файл "{path}" создан.')
     except PermissionError:
         log.error(f'Ошибка! Нет доступа на запись к файлу "{path}". Список не сохранен.')
+        return
+    compact_docx(path, max_size)
+
+
+def drop_unused_images(document):
+    """Удаляет из документа docx изображения, на которые не ссылается ни одна картинка (удаленных карточек)."""
+    from docx.opc.constants import RELATIONSHIP_TYPE as RT
+    part = document.part
+    used = set(part.element.xpath("//@r:embed"))
+    for rId, rel in list(part.rels.items()):
+        if rel.reltype == RT.IMAGE and rId not in used:
+            part.drop_rel(rId)
+
+
+class CardDocument:
+    """Список фильмов в формате docx (карточки по шаблону), который можно изменять по частям.
+
+    Новые фильмы записываются в новые таблицы (в конце документа или на указанную позицию), при удалении
+    и перестановке таблицы удаляются и переставляются; остальные карточки не перезаписываются.
+
+    Args:
+        template_path (str): шаблон docx (см. load_template)
+        genres (bool): добавлять жанры
+    """
+
+    def __init__(self, template_path: str, genres: bool = False):
+        self.document = load_template(template_path)
+        self.pristine_table = deepcopy(self.document.tables[0]._tbl)
+        self.genres = genres
+        self.codes = []  # kinopoisk id в порядке списка
+        self.titles = []
+
+    def __len__(self):
+        return len(self.codes)
+
+    def build(self, films: list, path: str):
+        """Записывает фильмы в шаблон и сохраняет документ (см. write_all_films_to_docx)."""
+        write_all_films_to_docx(self.document, films, path, self.genres)
+        self.codes = [film[10] for film in films]
+        self.titles = [f"{film[0]} ({film[1]})" for film in films]
+
+    @stage("docx_edit")
+    def add(self, films: list):
+        """Добавляет карточки фильмов в конец списка."""
+        from docx.table import Table
+        for film in films:
+            tbl = deepcopy(self.pristine_table)
+            self.document.paragraphs[-1]._p.addnext(tbl)
+            self.document.add_paragraph()
+            write_film_to_table(Table(tbl, self.document._body), film, self.genres)
+            self.codes.append(film[10])
+            self.titles.append(f"{film[0]} ({film[1]})")
+
+    @stage("docx_edit")
+    def insert(self, index: int, film: list):
+        """Вставляет карточку фильма на позицию index (от 0)."""
+        if index >= len(self.codes):
+            self.add([film])
+            return
+        from docx.oxml import OxmlElement
+        from docx.table import Table
+        tbl = deepcopy(self.pristine_table)
+        anchor = self._card(index)[0]
+        anchor.addprevious(tbl)
+        anchor.addprevious(OxmlElement("w:p"))
+        write_film_to_table(Table(tbl, self.document._body), film, self.genres)
+        self.codes.insert(index, film[10])
+        self.titles.insert(index, f"{film[0]} ({film[1]})")
+
+    @stage("docx_edit")
+    def replace(self, index: int, film: list):
+        """Перезаписывает карточку с номером index (от 0)."""
+        from docx.table import Table
+        old_tbl = self.document.tables[index]._tbl
+        tbl = deepcopy(self.pristine_table)
+        old_tbl.addnext(tbl)
+        old_tbl.getparent().remove(old_tbl)
+        write_film_to_table(Table(tbl, self.document._body), film, self.genres)
+        self.codes[index] = film[10]
+        self.titles[index] = f"{film[0]} ({film[1]})"
+
+    def _card(self, index: int) -> list:
+        """Элементы карточки с номером index (от 0): таблица и пустой абзац-разделитель после нее."""
+        from docx.oxml.ns import qn
+        tbl = self.document.tables[index]._tbl
+        following = tbl.getnext()
+        if (following is not None and following.tag == qn("w:p")
+                and not following.xpath(".//w:t|.//w:br|.//w:drawing|.//w:sectPr")):
+            return [tbl, following]
+        return [tbl]
+
+    @stage("docx_edit")
+    def remove(self, index: int):
+        """Удаляет карточку с номером index (от 0) вместе с пустым абзацем-разделителем после нее."""
+        for element in self._card(index):
+            element.getparent().remove(element)
+        if not self.document.paragraphs:  # новые карточки добавляются после последнего абзаца
+            self.document.add_paragraph()
+        del self.codes[index]
+        del self.titles[index]
+
+    @stage("docx_edit")
+    def move(self, source: int, target: int):
+        """Переставляет карточку (таблицу вместе с разделителем) с позиции source на позицию target (от 0)."""
+        if source == target:
+            return
+        card, anchor = self._card(source), self._card(target)
+        for element in card:
+            element.getparent().remove(element)
+        if target > source:
+            for element in reversed(card):
+                anchor[-1].addnext(element)
+        else:
+            for element in card:
+                anchor[0].addprevious(element)
+        self.codes.insert(target, self.codes.pop(source))
+        self.titles.insert(target, self.titles.pop(source))
+
+    def save(self, path: str) -> int:
+        """Сохраняет документ (изображения удаленных карточек в файл не попадают). Возвращает размер файла."""
+        drop_unused_images(self.document)
+        self.document.save(path)
+        log.info(f'Файл "{path}" сохранен.')
+        return compact_docx(path)
+
+
+# (качество JPEG, доля размера постера) для последовательных попыток уменьшить файл
+COMPACT_STEPS = [(65, 1.0), (50, 1.0), (50, 0.75), (40, 0.5)]
+
 
+@stage("docx_compact")
+def compact_docx(path: str, max_size: int = DOCX_MAX_SIZE) -> int:
+    """Уменьшает файл docx больше max_size: перекодирует изображения JPEG с меньшим качеством и размером.
 
+    Изображения каждый раз перекодируются из исходного файла, чтобы потери не накапливались.
+
+    Args:
+        path (str): файл docx
+        max_size (int): желаемый наибольший размер, байт
+
+    Returns:
+        int: размер файла после уменьшения, байт
+    """
+    import zipfile
+    from PIL import Image
+    before = os.path.getsize(path)
+    if not max_size or before <= max_size:
+        log.info(f'Размер файла "{path}": {before / 1024 / 1024:.1f} МБ')
+        return before
+    with zipfile.ZipFile(path) as source:
+        items = [(item, source.read(item)) for item in source.infolist()]
+    size = before
+    for quality, scale in COMPACT_STEPS:
+        temp_path = path + ".tmp"
+        with zipfile.ZipFile(temp_path, "w", zipfile.ZIP_DEFLATED) as target:
+            for item, data in items:
+                if item.filename.startswith("word/media/") and item.filename.lower().endswith((".jpeg", ".jpg")):
+                    image = Image.open(io.BytesIO(data))
+                    if scale < 1:
+                        image.thumbnail((round(image.width * scale), round(image.height * scale)))
+                    data = image_to_jpeg(image, quality)
+                target.writestr(item, data)
+        os.replace(temp_path, path)
+        size = os.path.getsize(path)
+        if size <= max_size:
+            break
+    log.info(f'Размер файла "{path}": {before / 1024 / 1024:.1f} МБ -> {size / 1024 / 1024:.1f} МБ '
+             f'(качество изображений {quality}, размер {scale:.0%})')
+    if size > max_size:
+        log.warning(f'Файл "{path}" больше {max_size / 1024 / 1024:.0f} МБ')
+    return size
+
+
+@stage("docx_write")
 def write_all_films_to_docx_newformat(films: list, path: str, genres: bool = False):
     """Записывает информацию о фильмах в формате docx в новом формате."""
+    from docx import Document
+    from docx.shared import Cm, Pt
+    from tqdm import tqdm
+    profile_tag(films=len(films), format="docx_newformat")
 
     # Создаем новый документ
     doc = Document()
@@ -540,23 +1088,36 @@ def file_to_list(file: str):
         raise FileNotFoundError
 
 
-def write_tags_to_mp4(film: list, file_path: str):
+KPID_KEY = "----:com.apple.iTunes:kpid"
+TAG_PADDING = 256 * 1024  # резерв для перезаписи тегов на месте
+
+
+@stage("tags_write")
+def write_tags_to_mp4(film: list, file_path: str, padding: int = TAG_PADDING):
     """Запись тегов в файл mp4.
 
+    Теги записываются на место старых, если помещаются в них вместе с резервом (атомом free).
+    Иначе атом тегов увеличивается и резервируется padding байт для следующих записей,
+    при этом может быть перезаписана большая часть файла.
+
     Args:
         film (list): Информация о фильме
         file_path (str): Путь к файлу mp4
+        padding (int): Резерв для тегов в байтах
+
+    Returns:
+        str | bool: "in_place" - теги записаны на место старых, "rewritten" - файл перезаписан,
+                    False - ошибка
     """
+    from mutagen.mp4 import MP4, MP4Cover, MP4StreamInfoError, MP4FreeForm, AtomDataType
     try:
         video = MP4(file_path)
     except MP4StreamInfoError as error:
         log.error(f"Ошибка! Не удалось открыть файл ({error}): {os.path.basename(file_path)}")
         return False
-    try:
-        video.delete()  # удаление всех тегов
-    except Exception as error:
-        log.error(f"Ошибка при сохранении тегов в файл ({error}): {os.path.basename(file_path)}")
-        return False
+    if video.tags is None:
+        video.add_tags()
+    video.tags.clear()  # удаление всех тегов (запись в файл - одним сохранением ниже)
     video["\xa9nam"] = film[0]  # title
     if film[4]:
         video["desc"] = film[4]  # description
@@ -566,7 +1127,8 @@ def write_tags_to_mp4(film: list, file_path: str):
         video["ldes"] = " "  # long description
     if film[1]:
         video["\xa9day"] = str(film[1])  # year
-    video["covr"] = [MP4Cover(image_to_file(film[9]).getvalue(), imageformat=MP4Cover.FORMAT_PNG)]
+    cover = image_to_jpeg(film[9])
+    video["covr"] = [MP4Cover(cover, imageformat=MP4Cover.FORMAT_JPEG)]
     video["----:com.apple.iTunes:DIRECTOR"] = MP4FreeForm((";".join(film[7])).encode(), AtomDataType.UTF8)
     bufferlist = []
     for item in film[8]:
@@ -578,19 +1140,143 @@ def write_tags_to_mp4(film: list, file_path: str):
     else:
         video["----:com.apple.iTunes:kpra"] = MP4FreeForm(("").encode(), AtomDataType.UTF8)
     video["----:com.apple.iTunes:countr"] = MP4FreeForm((";".join(film[3])).encode(), AtomDataType.UTF8)
-    video["----:com.apple.iTunes:kpid"] = MP4FreeForm((str(film[10])).encode(), AtomDataType.UTF8)
+    video[KPID_KEY] = MP4FreeForm((str(film[10])).encode(), AtomDataType.UTF8)
     video["----:com.apple.iTunes:genre"] = MP4FreeForm((";".join(film[11])).encode(), AtomDataType.UTF8)
     video["\xa9gen"] = str(film[12])
+    video[TAGS_HASH_KEY] = MP4FreeForm(tags_hash(film, cover).encode(), AtomDataType.UTF8)
+
+    resized = False
+
+    def keep_padding(info):
+        nonlocal resized
+        if info.padding >= 0:
+            return info.padding  # размер атома не меняется, запись на месте
+        resized = True
+        return padding
 
     try:
-        video.save()
+        video.save(padding=keep_padding)
     except Exception as error:
         log.error(f"Ошибка при сохранении тегов в файл ({error}): {os.path.basename(file_path)}")
         return False
-    return True
+    if resized:
+        log.info(f"Размер тегов увеличен, зарезервировано {padding // 1024} КБ: {os.path.basename(file_path)}")
+        return "rewritten"
+    return "in_place"
+
+
+TAGS_HASH_KEY = "----:com.apple.iTunes:kltag"
+
+
+def tags_hash(film: list, cover: bytes = None) -> str:
+    """Хэш содержимого тегов фильма (для пропуска файлов с актуальными тегами)."""
+    if cover is None:
+        cover = image_to_jpeg(film[9])
+    data = json.dumps([film[0], film[1], film[2], film[3], film[4], film[7], film[8], str(film[10]), film[11], film[12]],
+                      ensure_ascii=False)
+    return hashlib.sha1(data.encode() + cover).hexdigest()
+
+
+def read_tags_state(file_path: str):
+    """Возвращает kinopoisk id и хэш тегов из файла mp4 (пустые строки, если тегов нет)."""
+    from mutagen.mp4 import MP4
+    video = MP4(file_path)
+    tags = video.tags or {}
+    kpid = tags[KPID_KEY][0].decode() if KPID_KEY in tags else ""
+    digest = tags[TAGS_HASH_KEY][0].decode() if TAGS_HASH_KEY in tags else ""
+    return kpid, digest
+
+
+def tag_file(file_path: str, api, kp_id=None, padding: int = TAG_PADDING) -> str:
+    """Записывает теги в файл mp4, если они отличаются от имеющихся.
+
+    Если kp_id не указан, используется KP~xxx из имени файла, затем kinopoisk id из тегов файла
+    и только для файлов без тегов - поиск по имени файла.
+
+    Returns:
+        str: "in_place" - теги записаны на место старых, "rewritten" - файл перезаписан,
+             "skipped" - теги актуальны, "not_found" - фильм не найден, "error" - ошибка
+    """
+    try:
+        current_kpid, current_hash = read_tags_state(file_path)
+    except Exception as error:
+        log.error(f"Ошибка! Не удалось открыть файл ({error}): {os.path.basename(file_path)}")
+        return "error"
+    if kp_id is None:
+        name = os.path.splitext(os.path.basename(file_path))[0]
+        kp_id = find_kp_id_in_title(name) or current_kpid
+    if not kp_id:
+        kp_ids, _ = find_kp_id([name], api)
+        if not kp_ids:
+            return "not_found"
+        kp_id = kp_ids[0]
+    film = get_film_info(kp_id, api)
+    if current_kpid == str(kp_id) and current_hash == tags_hash(film):
+        return "skipped"
+    return write_tags_to_mp4(film, file_path, padding) or "error"
+
+
+def tag_files(mp4_files: list, api, jobs: int = 4, padding: int = TAG_PADDING) -> dict:
+    """Параллельная запись тегов в файлы mp4 с пропуском файлов с актуальными тегами.
+
+    Args:
+        mp4_files (list): пути к файлам mp4
+        api (str | ApiKeyPool): ключ или пул ключей Kinopoisk API
+        jobs (int): количество одновременно обрабатываемых файлов
+        padding (int): резерв для тегов в байтах
+
+    Returns:
+        dict: количество файлов по результатам (in_place, rewritten, skipped, not_found, error)
+    """
+    from tqdm import tqdm
+    results = {"in_place": 0, "rewritten": 0, "skipped": 0, "not_found": 0, "error": 0}
+    written_bytes = 0
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = {executor.submit(bind(tag_file), file, api, None, padding): file for file in mp4_files}
+        for future in tqdm(futures, desc="Запись тегов...          "):
+            file = futures[future]
+            try:
+                status = future.result()
+            except Exception as e:
+                log.warning(f"Exeption: {e}")
+                status = "error"
+            results[status] += 1
+            if status == "in_place":
+                log.info(f"Записан тег в файл (на месте): {os.path.basename(file)}")
+            elif status == "rewritten":
+                written_bytes += os.path.getsize(file)
+                log.info(f"Записан тег в файл (файл перезаписан): {os.path.basename(file)}")
+            elif status == "skipped":
+                log.info(f"Теги актуальны: {os.path.basename(file)}")
+            elif status == "not_found":
+                log.warning(f"Фильм не найден: {os.path.basename(file)}")
+            else:
+                log.warning(f"Тег не записан в файл: {os.path.basename(file)}")
+    elapsed = time.perf_counter() - start
+    log.info(f"Записано на месте: {results['in_place']}, с перезаписью файла: {results['rewritten']}, "
+             f"пропущено: {results['skipped']}, не найдено: {results['not_found']}, ошибок: {results['error']} "
+             f"за {elapsed:.1f} с ({len(mp4_files) / elapsed:.1f} файлов/с, {written_bytes / 2**20 / elapsed:.1f} МБ/с перезаписано)")
+    return results
 
 
 def read_tags_from_mp4(file_path: str):
+    from PIL import Image
+    film = read_tags_record(file_path)
+    if not film:
+        return film
+    film[9] = Image.open(io.BytesIO(film[9]))
+    return film
+
+
+def read_tags_record(file_path: str):
+    """Чтение тегов из файла mp4 без декодирования обложки.
+
+    Returns:
+        list: информация о фильме (см. get_film_info), элемент 9 - обложка в исходном виде (bytes).
+              None, если теги неполные, False, если файл не удалось открыть.
+    """
+    from mutagen.mp4 import MP4
     try:
         video = MP4(file_path)
     except Exception as error:
@@ -619,7 +1305,7 @@ def read_tags_from_mp4(file_path: str):
         result.append("")
         result.append(video["----:com.apple.iTunes:DIRECTOR"][0].decode().split(";"))
         result.append(video["----:com.apple.iTunes:Actors"][0].decode().split("\r\n")[1::2])
-        result.append(Image.open(io.BytesIO(video["covr"][0])))
+        result.append(bytes(video["covr"][0]))
         try:
             result.append(video["----:com.apple.iTunes:kpid"][0].decode())
         except:
@@ -641,6 +1327,7 @@ def clear_tags(file_path: str):
     Args:
         file_path (str): Путь к файлу mp4
     """
+    from mutagen.mp4 import MP4, MP4StreamInfoError
     try:
         video = MP4(file_path)
     except MP4StreamInfoError as error:
@@ -651,18 +1338,122 @@ def clear_tags(file_path: str):
     return True
 
 
+@stage("pdf_convert")
 def docx_to_pdf_libre(file_in):
     file_in_abs = os.path.abspath(file_in)
     dir_out_abs = os.path.dirname(file_in_abs)
-    soffice_path = "C:\Program Files\LibreOffice\program\soffice.exe"
+    if sys.platform == "win32":
+        soffice_path = "C:\Program Files\LibreOffice\program\soffice.exe"
+    else:
+        soffice_path = shutil.which("soffice") or shutil.which("libreoffice") or ""
     if not os.path.isfile(soffice_path):
-        log.warning("Не найден файл soffice.exe. Возможно Libre Office не установлен.")
+        log.warning("Не найден файл soffice. Возможно Libre Office не установлен.")
         return 1
     command = f'"{soffice_path}" --headless --convert-to pdf --outdir {dir_out_abs} {file_in_abs}'
     code_exit = os.system(command)
     return code_exit
 
 
+def docx_to_pdf(path_docx: str, libre: bool = True):
+    """Конвертирует docx в pdf (рядом с исходным файлом) через Libre Office или Microsoft Word (docx2pdf).
+
+    Returns:
+        str | None: путь к файлу pdf или None при ошибке конвертации
+    """
+    path_pdf = os.path.splitext(path_docx)[0] + ".pdf"
+    if libre:
+        if docx_to_pdf_libre(path_docx) != 0:
+            log.warning("Ошибка конвертации в pdf через Libre Office")
+            return None
+    else:
+        from docx2pdf import convert  # только Windows и macOS
+        with stage("pdf_convert"):
+            convert(path_docx, path_pdf)
+    return path_pdf
+
+
+# Форматы списка для render_formats: карточки docx и pdf, краткий список docx (--newformat), названия txt
+OUTPUT_FORMATS = ["docx", "pdf", "newformat", "txt"]
+
+
+def render_formats(films: list,
+                   formats: list,
+                   output: str,
+                   template: str = "template.docx",
+                   pdf_template: str = None,
+                   genres: bool = False,
+                   libre: bool = True) -> dict:
+    """Создает список в нескольких форматах по одному набору фильмов.
+
+    Форматы создаются параллельно из одних и тех же данных (постеры перекодируются один раз, см. cover_to_file).
+    Если pdf создается по тому же шаблону, что и docx, конвертируется уже созданный файл docx.
+    Имена файлов: output (docx), output.pdf, output_new.docx (newformat), output.txt.
+
+    Args:
+        films (list): информация о фильмах (см. get_full_film_list)
+        formats (list): форматы из OUTPUT_FORMATS
+        output (str): путь к файлу docx, от него образуются имена остальных файлов
+        template (str): шаблон карточек docx
+        pdf_template (str, optional): шаблон для pdf (по умолчанию template)
+        genres (bool): добавлять жанры
+        libre (bool): конвертация в pdf через Libre Office, иначе через Microsoft Word
+
+    Returns:
+        dict: формат -> путь к созданному файлу (None, если файл не создан)
+    """
+    import tempfile
+    base = os.path.splitext(output)[0]
+    pdf_template = pdf_template or template
+    formats = sorted(set(formats), key=OUTPUT_FORMATS.index)  # docx раньше pdf: pdf может ждать docx
+    profile_tag(films=len(films), format="+".join(formats))
+    # постеры из кэша открываются лениво (см. film_from_record), а декодирование одного изображения
+    # PIL из нескольких потоков не потокобезопасно: изображения декодируются заранее
+    for film in films:
+        if hasattr(film[9], "load"):
+            film[9].load()
+
+    def card_docx(path, template_name):
+        write_all_films_to_docx(load_template(get_resource_path(template_name)), films, path, genres)
+        return path if os.path.isfile(path) else None
+
+    def pdf():
+        if "docx" in formats and pdf_template == template:
+            path_docx = futures["docx"].result()
+            return docx_to_pdf(path_docx, libre) if path_docx else None
+        workdir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(output)))
+        try:
+            path_docx = card_docx(os.path.join(workdir, os.path.basename(output)), pdf_template)
+            path_pdf = docx_to_pdf(path_docx, libre) if path_docx else None
+            if path_pdf is None or not os.path.isfile(path_pdf):
+                return None
+            os.replace(path_pdf, base + ".pdf")
+            return base + ".pdf"
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    def newformat():
+        write_all_films_to_docx_newformat(films, base + "_new.docx", genres)
+        return base + "_new.docx"
+
+    def txt():
+        write_all_films_to_txt(base + ".txt", films)
+        return base + ".txt"
+
+    renderers = {"docx": lambda: card_docx(output, template), "pdf": pdf, "newformat": newformat, "txt": txt}
+    futures = {}
+    result = {}
+    with ThreadPoolExecutor(max_workers=len(formats), thread_name_prefix="render") as executor:
+        for name in formats:
+            futures[name] = executor.submit(bind(renderers[name]))
+        for name, future in futures.items():
+            try:
+                result[name] = future.result()
+            except Exception as e:
+                log.warning(f"Не удалось создать список в формате {name}: {e}")
+                result[name] = None
+    return result
+
+
 def make_docx(kp_id_list: list,
               output: str,
               template: str,
@@ -670,59 +1461,88 @@ def make_docx(kp_id_list: list,
               shorten: bool = False,
               txtlist: bool = False,
               newformat: bool = False,
-              genres: bool = False):
-    full_list = get_full_film_list(kp_id_list, api, shorten)
+              genres: bool = False,
+              formats: list = None):
+    fields = fields_for_formats(formats or (["newformat"] if newformat else ["docx"]) + (["txt"] if txtlist else []), genres)
+    full_list = get_full_film_list(kp_id_list, api, shorten, fields)
+    if formats:
+        for name, path in render_formats(full_list, formats, output, template, genres=genres).items():
+            if path:
+                log.info(f'Создан список в формате {name}: "{path}"')
+        return
     if newformat:
         write_all_films_to_docx_newformat(full_list, output, genres)
     else:
         file_path = get_resource_path(template)
-        doc = Document(file_path)
+        doc = load_template(file_path)
         write_all_films_to_docx(doc, full_list, output, genres)
     if txtlist:
         txt_output = os.path.splitext(output)[0] + '.txt'
         write_all_films_to_txt(txt_output, full_list)
 
 
-def rename_torrents(api: str, path=""):
-    """Парсит имя из торрент файла и переименовывает в формат: название.ext
+def plan_renames(api: str, path="", jobs: int = 4) -> list:
+    """Составляет план переименования торрент файлов в формат: название (год).ext
+
+    Имена всех файлов разбираются заранее, одинаковые названия ищутся один раз,
+    год из имени файла используется для выбора фильма. Поиск выполняется параллельно.
 
     Args:
         api (str): токен kinopoisk api
-        path (str, optional): путь до файла. По умолчанию "".
+        path (str, optional): путь до файла (шаблон glob). По умолчанию "".
+        jobs (int): количество одновременных запросов
+
+    Returns:
+        list: список словарей {'source_path': ..., 'dest_path': ...}
     """
+    import PTN
     files_paths = glob.glob(path)
     if not files_paths:
         log.warning("Файлы не найдены.")
-        return
+        return []
 
-    all_data = []
+    parsed = {}
     for file in files_paths:
-        log.info('Поиск названия фильма в имени файла: ' + os.path.basename(file))
-        data = {}
-        data['source_path'] = file
-        base_name = os.path.basename(file)
-        name, ext = os.path.splitext(base_name)
+        name = os.path.splitext(os.path.basename(file))[0]
         parsed_data = PTN.parse(name)
-        if 'title' in parsed_data:
-            title = parsed_data['title']
-        else:
-            title = ""
-        if title:
-            kp = find_kp_id2(f'{title}', api)
-            if kp:
-                _, kp_title, kp_year = kp
-            else:
-                log.info(f'Не найдено название фильма в имени файла: {base_name}')
-                continue
-        else:
-            log.info(f'Не найдено название фильма в имени файла: {base_name}')
+        title = parsed_data.get('title', "")
+        if not title:
+            log.info(f'Не найдено название фильма в имени файла: {os.path.basename(file)}')
+            continue
+        kp_code = find_kp_id_in_title(name)
+        parsed[file] = (f'KP~{kp_code}', None) if kp_code else (title, parsed_data.get('year'))
+
+    def resolve(query):
+        title, year = query
+        if year is None:
+            return find_kp_id2(title, api)
+        found = search_film(title, api, year)
+        if found:
+            log.info(f'Найден фильм: {found[1]} ({found[2]}), kinopoisk id: {found[0]}')
+        return found
+
+    queries = list(dict.fromkeys(parsed.values()))
+    log.info(f"Файлов: {len(files_paths)}, уникальных названий: {len(queries)}")
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        resolved = dict(zip(queries, executor.map(bind(resolve), queries)))
+
+    all_data = []
+    for file, query in parsed.items():
+        kp = resolved[query]
+        if not kp:
+            log.info(f'Не найдено название фильма в имени файла: {os.path.basename(file)}')
             continue
-        trtable = kp_title.maketrans('', '', '\/:*?"<>')
+        _, kp_title, kp_year = kp
+        ext = os.path.splitext(file)[1]
+        trtable = kp_title.maketrans('', '', '\\/:*?"<>')
         kp_title_filtered = kp_title.translate(trtable)  # отфильтровываем запрещенные символы в новом имени файла
-        data['dest_path'] = os.path.join(os.path.dirname(file), f'{kp_title_filtered} ({kp_year}){ext}')
-        all_data.append(data)
-        time.sleep(0.2)
+        all_data.append({'source_path': file,
+                         'dest_path': os.path.join(os.path.dirname(file), f'{kp_title_filtered} ({kp_year}){ext}')})
+    return all_data
+
 
+def apply_renames(all_data: list):
+    """Выводит план переименования и после подтверждения переименовывает файлы."""
     print("")
     print('Будут переименованы файлы:')
     for i, item in enumerate(all_data, start=1):
@@ -742,6 +1562,23 @@ def rename_torrents(api: str, path=""):
         log.info('Отмена переименования файлов.')
 
 
+def rename_torrents(api: str, path="", jobs: int = 4, plan_file: str = None):
+    """Парсит имя из торрент файла и переименовывает в формат: название.ext
+
+    Args:
+        api (str): токен kinopoisk api
+        path (str, optional): путь до файла. По умолчанию "".
+        jobs (int): количество одновременных запросов
+        plan_file (str, optional): файл для сохранения плана переименования (см. --apply-plan)
+    """
+    all_data = plan_renames(api, path, jobs)
+    if plan_file:
+        with open(plan_file, 'w', encoding="utf-8") as f:
+            json.dump(all_data, f, ensure_ascii=False, indent=2)
+        log.info(f"План переименования сохранен: {plan_file}")
+    apply_renames(all_data)
+
+
 def text_to_markdown(text: str) -> str:
     """Экранирует символы для вывода в режиме markdown
 
@@ -759,10 +1596,11 @@ def text_to_markdown(text: str) -> str:
     return text_markdown
 
 
-def main():
+@trace("kl")
+def main(argv: list = None):
     import argparse_ru
     import argparse
-    from config import KINOPOISK_API_TOKEN as api
+    import config
     parser = argparse.ArgumentParser(prog='kl',
                                      description=f'Библиотека для создания списков фильмов в формате docx. Версия {LIB_VER}.',
                                      formatter_class=argparse.RawDescriptionHelpFormatter,
@@ -771,6 +1609,7 @@ def main():
 kl -m "Terminator" "Terminator 2" KP~319  --создает список list.docx из 3 фильмов: Terminator,
                                                 Terminator 2 и Terminator 3 (*)
 kl -f movies.txt -o movies.docx           --создает список movies.docx из всех фильмов в файле movies.txt
+kl -f movies.txt --formats docx pdf txt   --создает list.docx, list.pdf и list.txt по одной загрузке фильмов
 kl -t ./Terminator.mp4                    --записывает теги в файл Terminator.mp4 в текущем каталоге
 kl -t c:\movies\Terminator.mp4            --записывает теги в файл Terminator.mp4 в каталоге c:\movies
 kl -t c:\movies\Chuzhie.mp4 -kp 406       --записывает в файл Chuzhie.mp4 теги фильма Чужие (Kinopoisk_id 406)
@@ -778,6 +1617,10 @@ kl -t                                     --записывает теги во 
 kl -t c:\movies                           --записывает теги во все mp4 файлы в каталоге c:\movies
 kl --cleartags                            --удаляет все теги во всех mp4 файлах в текущем каталоге
 kl -r *.mp4                               --переименовывает mp4 файлы в текущем каталоге (торрент -> название.mp4)
+kl -r *.mp4 --plan plan.json              --сохраняет план переименования в plan.json
+kl --apply-plan plan.json                 --переименовывает файлы по плану из plan.json без повторного поиска
+kl --daemon                               --запускает фоновый процесс; команды передаются через клиент:
+                                            python kinolist_daemon.py -t c:\movies
 kl -l                                     --создает список list.docx из всех mp4 файлов в текущем каталоге.
 kl --loc                                  --создает список list.docx из всех mp4 файлов в текущем каталоге, используя
                                                 только теги файлов (все теги должны быть предварительно записаны в
@@ -786,6 +1629,11 @@ kl --loc                                  --создает список list.doc
                                                 (например: i6.7) интерпретируется как рейтинг IMDb.
 kl --loc --newformat                      --создает список из тегов файлов в новом формате
 kl --loc --a5                             --создает список из тегов файлов в формате A5 (для планшетов)
+kl --loc d:\movies -R --watch             --создает список из всех mp4 файлов в d:\movies и вложенных каталогах
+                                                и обновляет его при добавлении, переименовании и изменении файлов
+kl --warm movies.txt -j 8                 --заполняет кэш фильмами из файла movies.txt (8 одновременных запросов)
+kl --export-cache cache.zip               --сохраняет кэш в архив cache.zip для переноса на другой компьютер
+kl --import-cache cache.zip               --загружает кэш из архива cache.zip
 
 
 * Можно указать Kinopoisk_id напрямую, используя тег KP~XXX в названии фильма (где XXX - Kinopoisk_id)
@@ -809,11 +1657,17 @@ kl --loc --a5                             --создает список из т
                         const=os.getcwd(),
                         help="записывает теги в файл mp4 (или во все mp4 файлы в текущем каталоге)")
     parser.add_argument("-kp", "--kinopoisk_id", nargs=1, help="указывает значение kinopoisk_id для записи в тег")
+    parser.add_argument("--padding",
+                        type=int,
+                        default=TAG_PADDING // 1024,
+                        help="резерв для тегов в КБ, позволяет перезаписывать теги без перезаписи файла (256 по умолчанию)")
     parser.add_argument("--cleartags",
                         nargs="?",
                         const=os.getcwd(),
                         help="удаляет все теги в файле mp4 (или во всех mp4 файлах в текущем каталоге)")
     parser.add_argument("-r", "--rename", nargs="?", const=os.getcwd(), help="переименовывает mp4 файлы в текущем каталоге")
+    parser.add_argument("--plan", nargs=1, metavar="FILE", help="модификатор для --rename: сохраняет план переименования в файл")
+    parser.add_argument("--apply-plan", nargs=1, metavar="FILE", help="переименовывает файлы по сохраненному плану без поиска")
     parser.add_argument("-l",
                         "--list",
                         nargs="?",
@@ -823,7 +1677,14 @@ kl --loc --a5                             --создает список из т
                         nargs="?",
                         const=os.getcwd(),
                         help="создает список фильмов в формате docx из тегов mp4 файлов в текущем каталоге")
+    parser.add_argument("-R", "--recursive", action='store_true', help="модификатор для --tag, --cleartags, --list, --loc и --reindex: обработка вложенных каталогов")
+    parser.add_argument("--watch", action='store_true', help="модификатор для --loc: отслеживает изменения файлов и обновляет список")
+    parser.add_argument("--tagindex", nargs=1, metavar="DB", help="путь к индексу тегов для --loc (kinolist_tags.db по умолчанию)")
     parser.add_argument("-nf", "--newformat", action='store_true', help="модификатор для создания списка фильмов в новом формате")
+    parser.add_argument("--formats",
+                        nargs="+",
+                        choices=OUTPUT_FORMATS,
+                        help="создает список сразу в нескольких форматах по одной загрузке: docx, pdf, newformat (краткий список), txt")
     parser.add_argument("-g", "--genres", action='store_true', help="модификатор добавляет жанры в список фильмов")
     parser.add_argument("--a5", action='store_true', help="Cписок в формате A5, работает пока только с параметром --loc")
     parser.add_argument(
@@ -835,11 +1696,68 @@ kl --loc --a5                             --создает список из т
     )
     parser.add_argument("--nocache", action='store_true', help="Не использовать кэш")
     parser.add_argument("--clearcache", action='store_true', help="Очистить кэш")
-
-    args = parser.parse_args()
-
-    # загружаем кэш для запросов к Kinopoisk API
-    requests_cache.install_cache(get_resource_path('cache'), expire_after=3600)
+    parser.add_argument("--quota", action='store_true', help="выводит остаток дневного лимита запросов ключей Kinopoisk API")
+    parser.add_argument("--warm", nargs=1, metavar="FILE",
+                        help="заполняет кэш фильмами из текстового файла (названия или KP~xxx)")
+    parser.add_argument("--restart", action='store_true', help="--warm обрабатывает весь файл заново")
+    parser.add_argument("-j", "--jobs", type=int, default=4, help="количество одновременных запросов для --warm и файлов для --tag (4 по умолчанию)")
+    parser.add_argument("--export-cache", nargs=1, metavar="BUNDLE", help="сохраняет кэш в переносимый архив")
+    parser.add_argument("--import-cache", nargs=1, metavar="BUNDLE", help="загружает кэш из архива, созданного --export-cache")
+    parser.add_argument("--reindex",
+                        nargs="?",
+                        const=os.getcwd(),
+                        help="обновляет локальный индекс названий по кэшу и тегам mp4 файлов в каталоге")
+    parser.add_argument("--offline", action='store_true', help="автономный режим: списки создаются только из кэша, без запросов к Kinopoisk API")
+    parser.add_argument("--metrics",
+                        nargs="?",
+                        type=int,
+                        const=METRICS_PORT,
+                        metavar="PORT",
+                        help=f"отдает метрики Prometheus по адресу http://127.0.0.1:PORT/metrics (порт {METRICS_PORT} по умолчанию)")
+    parser.add_argument("--trace", nargs=1, metavar="FILE", help="сохраняет трассировки заданий в FILE (json lines)")
+    parser.add_argument("--slow",
+                        type=float,
+                        metavar="SECONDS",
+                        help="записывает в лог дерево этапов заданий, которые выполнялись дольше SECONDS секунд")
+    parser.add_argument("--profile",
+                        nargs="?",
+                        const="profiles",
+                        metavar="DIR",
+                        help="сохраняет профиль выполнения в формате folded stacks (для flamegraph) в каталог DIR (profiles по умолчанию)")
+    parser.add_argument("--daemon",
+                        nargs="?",
+                        const="",
+                        metavar="SOCKET",
+                        help="запускает фоновый процесс, который выполняет команды kl, полученные через сокет (клиент - kinolist_daemon.py)")
+
+    args = parser.parse_args(argv)
+    annotate(argv=" ".join(sys.argv[1:] if argv is None else argv))
+    if args.trace or args.slow is not None:
+        configure_tracing(args.trace[0] if args.trace else None, args.slow)
+    if args.profile and current_profile() is None:
+        with profile(args.profile, "kl"):
+            return main(argv)
+    import requests_cache
+    global _metrics_server
+    if args.metrics and _metrics_server is None:
+        _metrics_server = start_http_server(args.metrics)
+    if args.daemon is not None:
+        from kinolist_daemon import serve
+        serve(args.daemon or None)
+        return
+    from kinolist_library import LibraryScanner, LiveList, TagIndex, watch_changes
+    tag_index = TagIndex(args.tagindex[0] if args.tagindex else None)
+    scanner = LibraryScanner(tag_index.backend)
+    # хранилище открывается один раз за время работы процесса (повторные вызовы main в режиме --daemon)
+    state_path = get_resource_path('kinolist_state.db')
+    if cache_backend is None or getattr(cache_backend, "path", None) != state_path:
+        set_cache_backend(open_backend(state_path))
+    backend = cache_backend
+    api = api_from_config(config, backend)
+    set_offline_mode(args.offline)
+
+    # загружаем кэш для запросов к Kinopoisk API (в режиме --daemon кэш уже может быть загружен)
+    install_http_cache(get_resource_path('cache'), getattr(config, "HTTP_CACHE_MAX_SIZE", HTTP_CACHE_MAX_SIZE))
 
     # очищаем кэш при запуске с параметром --clearcache
     if args.clearcache:
@@ -847,6 +1765,34 @@ kl --loc --a5                             --создает список из т
         log.info("Кэш очищен.")
         return
 
+    # остаток лимитов ключей Kinopoisk API
+    if args.quota:
+        api.sync()
+        for key_info in api.report():
+            print(f"Ключ {key_info['key']}: использовано {key_info['used']}, осталось {key_info['remaining']}"
+                  f"{' (исчерпан)' if key_info['exhausted'] else ''}")
+        print(f"Всего осталось запросов: {api.remaining()}")
+        return
+
+    # обновление индекса названий
+    if args.reindex:
+        mp4_files = scanner.scan(args.reindex, recursive=args.recursive) if os.path.isdir(args.reindex) else []
+        log.info(f"Индекс названий обновлен, фильмов в индексе: {update_title_index(mp4_files)}")
+        return
+
+    # прогрев, экспорт и импорт кэша
+    if args.warm:
+        warm_cache(args.warm[0], api, args.jobs, args.restart)
+        return
+    if args.export_cache:
+        counts = export_bundle(backend, args.export_cache[0], CACHE_NAMESPACES)
+        log.info(f"Кэш сохранен в {args.export_cache[0]}: {counts}")
+        return
+    if args.import_cache:
+        counts = import_bundle(backend, args.import_cache[0])
+        log.info(f"Кэш загружен из {args.import_cache[0]}: {counts}")
+        return
+
     # отключаем кэш при запуске с параметром --nocache
     if args.nocache:
         requests_cache.uninstall_cache()
@@ -882,7 +1828,7 @@ kl --loc --a5                             --создает список из т
                 template = "template_a5.docx"
             else:
                 template = "template.docx"
-            make_docx(kp_codes[0], output, template, api, args.shorten, args.txtlist, args.newformat, args.genres)
+            make_docx(kp_codes[0], output, template, api, args.shorten, args.txtlist, args.newformat, args.genres, args.formats)
         else:
             log.info("Список не создан.")
 
@@ -903,7 +1849,7 @@ kl --loc --a5                             --создает список из т
             template = "template_a5.docx"
         else:
             template = "template.docx"
-        make_docx(kp_codes[0], output, template, api, args.shorten, args.txtlist, args.newformat, args.genres)
+        make_docx(kp_codes[0], output, template, api, args.shorten, args.txtlist, args.newformat, args.genres, args.formats)
 
     # запись тегов в mp4
     elif args.tag:
@@ -925,14 +1871,15 @@ kl --loc --a5                             --создает список из т
                     return
                 kp_id = kp_ids[0][0]
             film_info = get_film_info(kp_id, api)
-            if not write_tags_to_mp4(film_info, path):
+            mode = write_tags_to_mp4(film_info, path, args.padding * 1024)
+            if not mode:
                 log.warning(f"Тег не записан в файл: {mp4_file}")
                 return
-            log.info(f"Записан тег в файл: {mp4_file}")
+            log.info(f"Записан тег в файл{' (файл перезаписан)' if mode == 'rewritten' else ' (на месте)'}: {mp4_file}")
 
         elif os.path.isdir(path):
             log.info(f"Поиск файлов mp4 в каталоге: {os.path.abspath(path)}")
-            mp4_files = glob.glob(os.path.join(path, '*.mp4'))
+            mp4_files = scanner.scan(path, recursive=args.recursive)
             if len(mp4_files) == 0:
                 log.warning(f'В каталоге "{path}" файлы mp4 не найдены.')
                 return
@@ -943,26 +1890,16 @@ kl --loc --a5                             --создает список из т
                 log.info(f"Найден файл: {file}")
             log.info(f"Всего найдено файлов: {len(mp4_files)}")
 
-            film_list = []
-            for file in mp4_files:
-                film_list.append(os.path.splitext(os.path.basename(file))[0])
-            kp_ids, films_not_found = find_kp_id(film_list, api)
             if args.test:
+                film_list = []
+                for file in mp4_files:
+                    film_list.append(os.path.splitext(os.path.basename(file))[0])
+                kp_ids, films_not_found = find_kp_id(film_list, api)
                 if films_not_found:
                     print("Следующие фильмы не найдены:")
-                    "\n".join(films_not_found)
+                    print("\n".join(films_not_found))
                 return
-            mp4_files_valid = []
-            for i in range(len(mp4_files)):
-                if film_list[i] not in films_not_found:
-                    mp4_files_valid.append(mp4_files[i])
-            full_films_list = get_full_film_list(kp_ids, api)
-            for i, film in enumerate(full_films_list):
-                if not write_tags_to_mp4(film, mp4_files_valid[i]):
-                    log.warning(f"Тег не записан в файл: {os.path.basename(mp4_files_valid[i])}")
-                    continue
-                else:
-                    log.info(f"Записан тег в файл: {os.path.basename(mp4_files_valid[i])}")
+            tag_files(mp4_files, api, args.jobs, args.padding * 1024)
         else:
             log.error("Неверно указан путь.")
 
@@ -982,7 +1919,7 @@ kl --loc --a5                             --создает список из т
 
         elif os.path.isdir(path):
             log.info(f"Поиск файлов mp4 в каталоге: {os.path.abspath(path)}")
-            mp4_files = glob.glob(os.path.join(path, '*.mp4'))
+            mp4_files = scanner.scan(path, recursive=args.recursive)
             if len(mp4_files) == 0:
                 log.warning(f'В каталоге "{path}" файлы mp4 не найдены.')
                 return
@@ -998,7 +1935,7 @@ kl --loc --a5                             --создает список из т
     elif args.list:
         path = args.list
         log.info(f"Поиск файлов mp4 в каталоге: {os.path.abspath(path)}")
-        mp4_files = glob.glob(os.path.join(path, '*.mp4'))
+        mp4_files = scanner.scan(path, recursive=args.recursive)
         if len(mp4_files) == 0:
             log.warning(f'В каталоге "{path}" файлы mp4 не найдены.')
             return
@@ -1016,11 +1953,16 @@ kl --loc --a5                             --создает список из т
         if len(films_not_found) > 0:
             log.warning("Следующие фильмы не найдены: " + ", ".join(films_not_found))
         template = "template.docx"
-        make_docx(kp_id, output, template, api, args.shorten, args.txtlist, args.newformat, args.genres)
+        make_docx(kp_id, output, template, api, args.shorten, args.txtlist, args.newformat, args.genres, args.formats)
 
     # переимонование torrent файлов
     elif args.rename:
-        rename_torrents(api, args.rename)
+        rename_torrents(api, args.rename, args.jobs, args.plan[0] if args.plan else None)
+
+    # переименование по сохраненному плану
+    elif args.apply_plan:
+        with open(args.apply_plan[0], encoding="utf-8") as f:
+            apply_renames(json.load(f))
 
     elif args.loc:
         path = args.loc
@@ -1028,13 +1970,6 @@ kl --loc --a5                             --создает список из т
             log.error("Ошибка! В качестве параметра должен быть путь до каталога с файлами mp4.")
             return
         log.info(f"Поиск файлов mp4 в каталоге: {os.path.abspath(path)}")
-        mp4_files_in_dir = glob.glob(os.path.join(path, '*.mp4'))
-        lnk_files_in_dir = glob.glob(os.path.join(path, '*.lnk'))
-        mp4_files_from_lnk = [get_target(x) for x in lnk_files_in_dir if os.path.splitext(get_target(x))[1] == ".mp4"]
-        mp4_files = mp4_files_in_dir + mp4_files_from_lnk
-        if not mp4_files:
-            log.warning(f'В каталоге "{path}" файлы mp4 не найдены.')
-            return
 
         # сортировка файлов
         sort_options = {
@@ -1047,31 +1982,57 @@ kl --loc --a5                             --создает список из т
         }
         if args.sort and args.sort[0] in sort_options.keys():
             sort_option, reverse_option, message = sort_options.get(args.sort[0], (os.path.basename, False))
-            mp4_files.sort(key=sort_option, reverse=reverse_option)
             log.info(f"Сортировка файлов: {message}")
         else:
-            mp4_files.sort(key=os.path.basename)
+            sort_option, reverse_option = os.path.basename, False
+
+        def find_loc_files():
+            files_in_dir = scanner.scan(path, (".mp4", ".lnk"), args.recursive)
+            mp4_files_in_dir = [x for x in files_in_dir if os.path.splitext(x)[1].lower() == ".mp4"]
+            lnk_targets = [tag_index.get_target(x) for x in files_in_dir if os.path.splitext(x)[1].lower() == ".lnk"]
+            mp4_files_from_lnk = [x for x in lnk_targets if os.path.splitext(x)[1] == ".mp4"]
+            files = mp4_files_in_dir + mp4_files_from_lnk
+            files.sort(key=sort_option, reverse=reverse_option)
+            return files
+
+        mp4_files = find_loc_files()
+        tag_index.prune(path)
+        if not mp4_files:
+            log.warning(f'В каталоге "{path}" файлы mp4 не найдены.')
+            return
+
+        if args.a5:
+            template = "template_a5.docx"
+        else:
+            template = "template.docx"
+        if args.watch:
+            live_list = LiveList(tag_index, output, get_resource_path(template), args.newformat, args.genres, args.jobs)
+            live_list.build(mp4_files)
+            log.info(f"Отслеживание изменений в каталоге: {os.path.abspath(path)} (Ctrl+C - выход)")
+            try:
+                for _ in watch_changes(path, args.recursive):
+                    live_list.update(find_loc_files())
+            except KeyboardInterrupt:
+                log.info("Отслеживание остановлено.")
+            return
 
         for file in mp4_files:
             log.info(f"Найден файл: {os.path.basename(file)}")
         log.info(f"Всего: {len(mp4_files)}")
         full_films_list = []
-        for file in tqdm(mp4_files, desc="Загрузка тегов...        "):
-            film_info = read_tags_from_mp4(file)
+        for file, film_info in zip(mp4_files, tag_index.read_all(mp4_files, args.jobs)):
             if film_info:
                 full_films_list.append(film_info)
+                if film_info[10]:
+                    title_index.add(film_info[10], [film_info[0]], film_info[1])
             else:
                 log.warning(f"Не удалось прочитать теги в файле: '{os.path.basename(file)}'! Файл пропущен.")
         if full_films_list:
             if args.newformat:
                 write_all_films_to_docx_newformat(full_films_list, output, genres=args.genres)
             else:
-                if args.a5:
-                    template = "template_a5.docx"
-                else:
-                    template = "template.docx"
                 file_path = get_resource_path(template)
-                doc = Document(file_path)
+                doc = load_template(file_path)
                 write_all_films_to_docx(doc, full_films_list, output, genres=args.genres)
         else:
             log.error("Ошибка, список не создан!")
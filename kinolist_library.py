@@ -0,0 +1,370 @@
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import kinolist_lib
+from kinolist_storage import SQLiteBackend
+
+log = logging.getLogger("Library")
+
+TAG_INDEX_NAME = "kinolist_tags.db"
+
+
+def file_signature(path: str) -> list:
+    """Размер и время изменения файла (для определения измененных файлов)."""
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+class TagIndex:
+    """Индекс тегов mp4 файлов в базе SQLite.
+
+    Хранит прочитанные теги и обложку для каждого файла вместе с его размером и временем изменения.
+    Файлы, которые не изменились, повторно не открываются. Также хранятся цели ярлыков .lnk.
+    База по умолчанию локальная (SQLite в режиме WAL не работает на сетевых дисках),
+    файлы в ней хранятся по абсолютному пути.
+    """
+
+    def __init__(self, path: str = None):
+        self.path = path or kinolist_lib.get_resource_path(TAG_INDEX_NAME)
+        self.backend = SQLiteBackend(self.path)
+
+    def get(self, file: str):
+        """Запись индекса для файла, если файл не изменился: (теги, обложка) или None."""
+        key = os.path.abspath(file)
+        entry = self.backend.get("tags", key)
+        if entry is None or entry["signature"] != file_signature(file):
+            return None
+        if entry["record"] is None:
+            return None, None
+        return entry["record"], self.backend.get("covers", key)
+
+    def put(self, file: str, film):
+        key = os.path.abspath(file)
+        if film:
+            record = list(film)
+            cover = record[9]
+            record[9] = None
+            self.backend.set("covers", key, cover)
+        else:
+            record = None
+        self.backend.set("tags", key, {"signature": file_signature(file), "record": record})
+
+    def contains(self, file: str) -> bool:
+        return self.get(file) is not None
+
+    def read(self, file: str):
+        """Теги файла (см. kinolist_lib.read_tags_record) из индекса или из файла."""
+        entry = self.get(file)
+        if entry is not None:
+            return self._film(entry)
+        return self._read_file(file)
+
+    @staticmethod
+    def _film(entry):
+        record, cover = entry
+        if record is None:
+            return None
+        film = list(record)
+        film[9] = cover
+        return film
+
+    def _read_file(self, file: str):
+        film = kinolist_lib.read_tags_record(file)
+        self.put(file, film)
+        return film
+
+    def read_all(self, files: list, jobs: int = 8) -> list:
+        """Читает теги файлов, открывая в параллельных потоках только новые и измененные файлы.
+
+        Returns:
+            list: теги в порядке files (None для файлов без тегов)
+        """
+        results = {}
+        changed = []
+        for file in files:
+            entry = self.get(file)
+            if entry is None:
+                changed.append(file)
+            else:
+                results[file] = self._film(entry)
+        log.info(f"Файлов в индексе тегов: {len(files) - len(changed)}, новых или измененных: {len(changed)}")
+        if changed:
+            with ThreadPoolExecutor(max_workers=jobs) as executor:
+                results.update(zip(changed, executor.map(self._read_file, changed)))
+        return [results[file] for file in files]
+
+    def get_target(self, lnk: str) -> str:
+        """Цель ярлыка .lnk (запоминается, пока ярлык не изменится)."""
+        key = os.path.abspath(lnk)
+        entry = self.backend.get("links", key)
+        signature = file_signature(lnk)
+        if entry is not None and entry["signature"] == signature:
+            return entry["target"]
+        target = kinolist_lib.get_target(lnk)
+        self.backend.set("links", key, {"signature": signature, "target": target})
+        return target
+
+    def forget(self, files):
+        """Удаляет файлы из индекса (удаленные или переименованные файлы)."""
+        for file in files:
+            key = os.path.abspath(file)
+            self.backend.delete("tags", key)
+            self.backend.delete("covers", key)
+
+    def prune(self, root: str):
+        """Удаляет из индекса файлы и ярлыки в каталоге root (и во вложенных), которых больше нет на диске.
+
+        Индекс общий для всех каталогов, поэтому записи других каталогов не затрагиваются.
+        """
+        prefix = os.path.join(os.path.abspath(root), "")
+        missing = [key for key, _value, _stored, _expires in list(self.backend.items("tags"))
+                   if key.startswith(prefix) and not os.path.exists(key)]
+        self.forget(missing)
+        for key, _value, _stored, _expires in list(self.backend.items("links")):
+            if key.startswith(prefix) and not os.path.exists(key):
+                self.backend.delete("links", key)
+        if missing:
+            log.info(f"Из индекса тегов удалено отсутствующих файлов: {len(missing)}")
+
+
+class LibraryScanner:
+    """Обход каталогов библиотеки через os.scandir с кэшированием списков файлов.
+
+    Список файлов каталога запоминается вместе с временем изменения каталога и используется повторно,
+    пока в каталоге не добавятся, не удалятся или не переименуются файлы.
+    """
+
+    def __init__(self, backend=None):
+        self.backend = backend
+
+    def listdir(self, directory: str):
+        """Имена файлов и подкаталогов каталога: (files, dirs)."""
+        key = os.path.abspath(directory)
+        mtime = os.stat(directory).st_mtime_ns
+        if self.backend is not None:
+            entry = self.backend.get("dirs", key)
+            if entry is not None and entry["mtime"] == mtime:
+                return entry["files"], entry["dirs"]
+        files, dirs = [], []
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    dirs.append(entry.name)
+                elif entry.is_file():
+                    files.append(entry.name)
+        if self.backend is not None:
+            self.backend.set("dirs", key, {"mtime": mtime, "files": files, "dirs": dirs})
+        return files, dirs
+
+    def scan(self, path: str, extensions=(".mp4",), recursive: bool = False) -> list:
+        """Файлы с расширениями extensions в каталоге path (и во вложенных каталогах, если recursive)."""
+        result = []
+        pending = [path]
+        while pending:
+            directory = pending.pop()
+            try:
+                files, dirs = self.listdir(directory)
+            except OSError as error:
+                log.warning(f"Не удалось прочитать каталог ({error}): {directory}")
+                continue
+            result.extend(os.path.join(directory, name) for name in files if os.path.splitext(name)[1].lower() in extensions)
+            if recursive:
+                pending.extend(os.path.join(directory, name) for name in dirs if not name.startswith("."))
+        return result
+
+
+class LiveList:
+    """Список фильмов в формате docx, который обновляется при изменении файлов.
+
+    Перезаписываются только карточки (таблицы) добавленных, удаленных, переименованных и измененных файлов
+    (см. kinolist_lib.CardDocument), остальные карточки не изменяются. В новом формате (newformat)
+    документ создается заново (теги неизмененных файлов берутся из индекса).
+    """
+
+    def __init__(self, tag_index: TagIndex, output: str, template: str = None, newformat: bool = False,
+                 genres: bool = False, jobs: int = 8):
+        self.tag_index = tag_index
+        self.output = output
+        self.template = template
+        self.newformat = newformat
+        self.genres = genres
+        self.jobs = jobs
+        self.files = []
+        self.signatures = {}
+        self.cards = []  # файлы карточек документа в порядке списка
+        self.card = None
+
+    def build(self, files: list):
+        """Создает документ заново."""
+        films = []
+        self.cards = []
+        self.card = None
+        for file, film in zip(files, self.tag_index.read_all(files, self.jobs)):
+            if film:
+                self.cards.append(file)
+                films.append(film)
+            else:
+                log.warning(f"Не удалось прочитать теги в файле: '{os.path.basename(file)}'! Файл пропущен.")
+        self.files = list(files)
+        self.signatures = {file: self._signature(file) for file in files}
+        if not films:
+            log.error("Ошибка, список не создан!")
+            return
+        if self.newformat:
+            kinolist_lib.write_all_films_to_docx_newformat(films, self.output, genres=self.genres)
+            return
+        self.card = kinolist_lib.CardDocument(self.template, self.genres)
+        self.card.build(films, self.output)
+
+    @staticmethod
+    def _signature(file):
+        try:
+            return file_signature(file)
+        except OSError:
+            return None
+
+    def update(self, files: list):
+        """Обновляет документ после изменения файлов (files - новый отсортированный список файлов)."""
+        removed = set(self.files) - set(files)
+        if removed:
+            self.tag_index.forget(removed)
+        if self.newformat or self.card is None:
+            if files != self.files or any(self.signatures.get(file) != self._signature(file) for file in files):
+                log.info("Изменился список, документ создается заново.")
+                self.build(files)
+            return
+        known = set(self.files)
+        changed = [file for file in files if file not in known or self.signatures.get(file) != self._signature(file)]
+        if not changed and files == self.files:
+            return
+        films = {file: self.tag_index.read(file) for file in changed}
+        for file, film in films.items():
+            if not film:
+                log.warning(f"Не удалось прочитать теги в файле: '{os.path.basename(file)}'! Файл пропущен.")
+        in_list = set(self.cards)
+        wanted = [file for file in files if (films[file] if file in films else file in in_list)]
+        if not wanted:
+            self.build(files)
+            return
+
+        wanted_set = set(wanted)
+        for index in reversed(range(len(self.cards))):
+            file = self.cards[index]
+            if file not in wanted_set:
+                self.card.remove(index)
+                del self.cards[index]
+                log.info(f"Удален фильм из списка: {os.path.basename(file)}")
+        for index, file in enumerate(self.cards):
+            if file in films:
+                self.card.replace(index, films[file])
+                log.info(f"Обновлен фильм в списке: {films[file][0]} ({os.path.basename(file)})")
+        for index, file in enumerate(wanted):
+            if index < len(self.cards) and self.cards[index] == file:
+                continue
+            if file in self.cards:
+                source = self.cards.index(file)
+                self.card.move(source, index)
+                self.cards.insert(index, self.cards.pop(source))
+            else:
+                self.card.insert(index, films[file])
+                self.cards.insert(index, file)
+                log.info(f"Добавлен фильм в список: {films[file][0]} ({os.path.basename(file)})")
+
+        self.files = list(files)
+        self.signatures = {file: self._signature(file) for file in files}
+        self.card.save(self.output)
+        log.info(f'Файл "{self.output}" обновлен.')
+
+
+def watch_changes(path: str, recursive: bool = False, interval: float = 2.0, debounce: float = 1.0):
+    """Ожидает изменений файлов в каталоге. Каждая итерация - пачка изменений после паузы debounce.
+
+    В Linux используется inotify, в остальных системах - опрос каталога раз в interval секунд.
+    """
+    if sys.platform.startswith("linux"):
+        try:
+            yield from _watch_inotify(path, recursive, debounce)
+            return
+        except OSError as error:
+            log.warning(f"inotify недоступен ({error}), используется опрос каталога.")
+    yield from _watch_polling(path, recursive, interval)
+
+
+def _watch_polling(path, recursive, interval):
+    scanner = LibraryScanner()
+
+    def snapshot():
+        result = {}
+        for file in scanner.scan(path, (".mp4", ".lnk"), recursive):
+            try:
+                result[file] = file_signature(file)
+            except OSError:
+                pass
+        return result
+
+    previous = snapshot()
+    while True:
+        time.sleep(interval)
+        current = snapshot()
+        if current != previous:
+            previous = current
+            yield
+
+
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_ISDIR = 0x40000000
+INOTIFY_MASK = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+
+def _watch_inotify(path, recursive, debounce):
+    libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+    fd = libc.inotify_init()
+    if fd < 0:
+        raise OSError(ctypes.get_errno(), "inotify_init")
+    watches = {}
+
+    def add_watch(directory):
+        wd = libc.inotify_add_watch(fd, os.fsencode(directory), INOTIFY_MASK)
+        if wd < 0:
+            log.warning(f"Не удалось отслеживать каталог: {directory}")
+            return
+        watches[wd] = directory
+        if recursive:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.is_dir() and not entry.name.startswith("."):
+                        add_watch(entry.path)
+
+    def read_events():
+        data = os.read(fd, 65536)
+        offset = 0
+        while offset < len(data):
+            wd, mask, _cookie, length = struct.unpack_from("iIII", data, offset)
+            name = data[offset + 16:offset + 16 + length].rstrip(b"\0").decode(errors="replace")
+            offset += 16 + length
+            if recursive and mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO) and wd in watches:
+                add_watch(os.path.join(watches[wd], name))
+
+    add_watch(path)
+    try:
+        while True:
+            select.select([fd], [], [])
+            read_events()
+            # ждем окончания записи файла (несколько событий подряд)
+            while select.select([fd], [], [], debounce)[0]:
+                read_events()
+            yield
+    finally:
+        os.close(fd)
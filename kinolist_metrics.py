@@ -0,0 +1,394 @@
+"""Метрики в формате Prometheus (text exposition format 0.0.4).
+
+Гистограммы длительности этапов создания списка, счетчики обращений к кэшу, ошибок
+и повторов запросов к Kinopoisk API, ненайденных фильмов и показатели бота (очередь, активные задания).
+Память процесса (RSS) и для каждого этапа - RSS в конце этапа и, если включен tracemalloc,
+пик выделенной Python памяти во время этапа.
+Метрики отдаются по адресу http://127.0.0.1:PORT/metrics (см. start_http_server).
+Каждый процесс хранит свои метрики; воркеры бота используют порты PORT, PORT+1, ...
+"""
+import logging
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from kinolist_trace import span
+
+log = logging.getLogger("Metrics")
+
+DEFAULT_PORT = 9108
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels.items()) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """Базовый класс метрики с метками. Значения для каждого набора меток - в дочерних объектах (labels)."""
+
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+        (REGISTRY if registry is None else registry).register(self)
+
+    def labels(self, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            if key not in self._children:
+                self._children[key] = self._new_child()
+            return self._children[key]
+
+    def _default(self):
+        if self.labelnames:
+            raise ValueError(f"Метрика {self.name} требует метки: {', '.join(self.labelnames)}")
+        return self.labels()
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def collect(self) -> list:
+        """Строки метрики в текстовом формате."""
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            children = list(self._children.items())
+        for key, child in children:
+            labels = dict(zip(self.labelnames, key))
+            for suffix, extra, value in child.samples():
+                lines.append(f"{self.name}{suffix}{_format_labels({**labels, **extra})} {_format_value(value)}")
+        return lines
+
+
+class _CounterChild:
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1):
+        with self._lock:
+            self.value += amount
+
+    def samples(self):
+        return [("_total", {}, self.value)]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount: float = 1):
+        self._default().inc(amount)
+
+
+class _GaugeChild:
+    def __init__(self):
+        self.value = 0
+        self.function = None
+        self._lock = threading.Lock()
+
+    def set(self, value: float):
+        self.value = value
+
+    def inc(self, amount: float = 1):
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount: float = 1):
+        self.inc(-amount)
+
+    def set_function(self, function):
+        """Значение вычисляется при каждом чтении метрик."""
+        self.function = function
+
+    def samples(self):
+        value = self.value
+        if self.function is not None:
+            try:
+                value = self.function()
+            except Exception as e:
+                log.warning(f"Не удалось получить значение метрики: {e}")
+        return [("", {}, value)]
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def _new_child(self):
+        return _GaugeChild()
+
+    def set(self, value: float):
+        self._default().set(value)
+
+    def inc(self, amount: float = 1):
+        self._default().inc(amount)
+
+    def dec(self, amount: float = 1):
+        self._default().dec(amount)
+
+    def set_function(self, function):
+        self._default().set_function(function)
+
+    def values(self) -> dict:
+        """Значения по значениям меток: {(метки...): значение}."""
+        with self._lock:
+            children = list(self._children.items())
+        return {key: child.samples()[0][2] for key, child in children}
+
+
+class _HistogramChild:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        with self._lock:
+            self.sum += value
+            self.count += 1
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self.counts[i] += 1
+
+    @contextmanager
+    def time(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def samples(self):
+        with self._lock:
+            result = [("_bucket", {"le": _format_value(bound)}, count) for bound, count in zip(self.buckets, self.counts)]
+            result += [("_sum", {}, self.sum), ("_count", {}, self.count)]
+        return result
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS,
+                 registry=None):
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+        super().__init__(name, documentation, labelnames, registry)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value: float):
+        self._default().observe(value)
+
+    def time(self):
+        return self._default().time()
+
+    def totals(self) -> dict:
+        """Количество и сумма наблюдений по значениям меток: {(метки...): (count, sum)}."""
+        with self._lock:
+            children = list(self._children.items())
+        return {key: (child.count, child.sum) for key, child in children}
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric: Metric):
+        self._metrics.append(metric)
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.collect())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = Histogram("kinolist_stage_seconds", "Длительность этапов создания списка, с", ("stage",))
+CACHE_REQUESTS = Counter("kinolist_cache_requests", "Обращения к кэшу", ("cache", "result"))
+UPSTREAM_ERRORS = Counter("kinolist_upstream_errors", "Ошибки запросов к внешним сервисам", ("endpoint", "status"))
+RETRIES = Counter("kinolist_retries", "Повторы запросов к внешним сервисам")
+RETRY_FAILURES = Counter("kinolist_retry_failures", "Запросы, не выполненные после всех повторов")
+FILMS_NOT_FOUND = Counter("kinolist_films_not_found", "Фильмы, которые не удалось найти")
+LISTS_CREATED = Counter("kinolist_lists_created", "Созданные списки", ("format",))
+QUEUE_DEPTH = Gauge("kinolist_queue_depth", "Обновления Telegram в очереди воркеров")
+ACTIVE_JOBS = Gauge("kinolist_active_jobs", "Задания, выполняемые в данный момент")
+PROCESS_RSS = Gauge("kinolist_process_resident_memory_bytes", "Резидентная память процесса (RSS), байт")
+PROCESS_PEAK_RSS = Gauge("kinolist_process_peak_resident_memory_bytes", "Наибольшая резидентная память процесса, байт")
+STAGE_RSS = Gauge("kinolist_stage_rss_bytes", "Наибольший RSS процесса в конце этапа, байт", ("stage",))
+STAGE_TRACED_PEAK = Gauge("kinolist_stage_traced_peak_bytes",
+                          "Наибольший прирост памяти Python во время этапа (tracemalloc), байт", ("stage",))
+
+
+def _windows_memory() -> tuple:
+    """(RSS, пиковый RSS) процесса в Windows, байт."""
+    import ctypes
+    from ctypes import wintypes
+
+    class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+        _fields_ = [("cb", wintypes.DWORD), ("PageFaultCount", wintypes.DWORD),
+                    ("PeakWorkingSetSize", ctypes.c_size_t), ("WorkingSetSize", ctypes.c_size_t),
+                    ("QuotaPeakPagedPoolUsage", ctypes.c_size_t), ("QuotaPagedPoolUsage", ctypes.c_size_t),
+                    ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t), ("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+                    ("PagefileUsage", ctypes.c_size_t), ("PeakPagefileUsage", ctypes.c_size_t)]
+
+    counters = PROCESS_MEMORY_COUNTERS()
+    counters.cb = ctypes.sizeof(counters)
+    process = ctypes.windll.kernel32.GetCurrentProcess()
+    ctypes.windll.psapi.GetProcessMemoryInfo(process, ctypes.byref(counters), counters.cb)
+    return counters.WorkingSetSize, counters.PeakWorkingSetSize
+
+
+def peak_rss() -> int:
+    """Наибольшая резидентная память процесса за время работы, байт."""
+    if sys.platform == "win32":
+        return _windows_memory()[1]
+    import resource
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss if sys.platform == "darwin" else maxrss * 1024  # Linux - в килобайтах
+
+
+def rss() -> int:
+    """Текущая резидентная память процесса, байт (в macOS - наибольшая)."""
+    if sys.platform == "win32":
+        return _windows_memory()[0]
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        return peak_rss()
+
+
+PROCESS_RSS.set_function(rss)
+PROCESS_PEAK_RSS.set_function(peak_rss)
+
+# Этапы, выполняемые в данный момент, для учета пика tracemalloc (пик процесса общий, поэтому
+# при сбросе пика он переносится во все выполняемые этапы)
+_traced_stages = []
+_traced_lock = threading.Lock()
+
+
+def _update_traced_peaks():
+    _current, peak = tracemalloc.get_traced_memory()
+    for measurement in _traced_stages:
+        measurement[1] = max(measurement[1], peak)
+    tracemalloc.reset_peak()
+
+
+def stage(name: str, **attrs):
+    """Измерение длительности и памяти этапа name: контекстный менеджер или декоратор.
+
+    Этап также записывается как интервал текущей трассировки (kinolist_trace) с атрибутами attrs.
+
+    with stage("docx_write"): ...
+
+    @stage("search")
+    def search_film(...): ...
+    """
+    return _Stage(name, attrs)
+
+
+class _Stage:
+    def __init__(self, name, attrs):
+        self.name = name
+        self.attrs = attrs
+        self.child = STAGE_SECONDS.labels(stage=name)
+
+    def __enter__(self):
+        self.span = span(self.name, **self.attrs)
+        self.span.__enter__()
+        self.traced = None
+        if tracemalloc.is_tracing():
+            with _traced_lock:
+                _update_traced_peaks()
+                current = tracemalloc.get_traced_memory()[0]
+                self.traced = [current, current]  # [в начале этапа, пик]
+                _traced_stages.append(self.traced)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.child.observe(time.perf_counter() - self.start)
+        if self.traced is not None:
+            with _traced_lock:
+                _update_traced_peaks()
+                del _traced_stages[next(i for i, item in enumerate(_traced_stages) if item is self.traced)]
+            _max_gauge(STAGE_TRACED_PEAK.labels(stage=self.name), self.traced[1] - self.traced[0])
+        _max_gauge(STAGE_RSS.labels(stage=self.name), rss())
+        self.span.__exit__(*exc)
+        return False
+
+    def __call__(self, function):
+        name, attrs = self.name, self.attrs
+
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with _Stage(name, attrs):
+                return function(*args, **kwargs)
+        return wrapper
+
+
+def _max_gauge(child, value: float):
+    with child._lock:
+        if value > child.value:
+            child.value = value
+
+
+def reset_memory_stages():
+    """Обнуляет показатели памяти этапов (например, перед очередным замером в тесте)."""
+    for metric in (STAGE_RSS, STAGE_TRACED_PEAK):
+        with metric._lock:
+            metric._children.clear()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = self.registry.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_http_server(port: int = DEFAULT_PORT, addr: str = "127.0.0.1") -> ThreadingHTTPServer:
+    """Запускает в фоновом потоке HTTP-сервер, который отдает метрики по адресу /metrics."""
+    server = ThreadingHTTPServer((addr, port), _Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    log.info(f"Метрики: http://{addr}:{port}/metrics")
+    return server
@@ -0,0 +1,199 @@
+"""Профилирование заданий kl и бота.
+
+Статистический профилировщик: фоновый поток с интервалом interval снимает стеки потоков процесса
+(sys._current_frames) и считает одинаковые стеки. Результат сохраняется в формате folded stacks
+("main;get_film_info;api_get 42"), который понимают flamegraph.pl, speedscope и inferno.
+Файл профиля сохраняется для каждого задания, имя содержит тип задания и теги (количество фильмов, формат),
+сведения о профилях добавляются в profiles.jsonl в том же каталоге.
+
+Профиль kl - весь процесс. Задания бота выполняются одновременно в одном потоке событий и общих потоках,
+поэтому в профиль задания бота попадают только стеки, проходящие через кадр самого задания
+(корутина обработчика и функции, запущенные в других потоках через kinolist_trace.bind).
+
+    kl --profile [DIR] ...                         -- профиль запуска kl
+    kinolist_bot.py --profile-every 50             -- профиль каждого 50-го задания бота
+"""
+import contextvars
+import functools
+import inspect
+import itertools
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+log = logging.getLogger("Profile")
+
+DEFAULT_INTERVAL = 0.005  # 200 снимков в секунду
+
+_current = contextvars.ContextVar("kinolist_profile", default=None)
+
+# Выборочное профилирование заданий бота (см. configure_sampling)
+sample_every = 0
+sample_directory = "profiles"
+_jobs = itertools.count(1)
+
+
+class Profiler:
+    """Статистический профилировщик (снимки стеков всех потоков, кроме собственного).
+
+    Если scoped, учитываются только стеки, содержащие один из кадров anchors (кадры задания).
+    """
+
+    def __init__(self, interval: float = DEFAULT_INTERVAL, scoped: bool = False):
+        self.interval = interval
+        self.scoped = scoped
+        self.anchors = set()
+        self.stacks = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own or names.get(ident) == "profiler":
+                    continue
+                if self.scoped and not self._in_scope(frame):
+                    continue
+                self.stacks[self._stack(frame, names.get(ident, str(ident)))] += 1
+            self.samples += 1
+
+    def _in_scope(self, frame) -> bool:
+        anchors = set(self.anchors)
+        while frame is not None:
+            if frame in anchors:
+                return True
+            frame = frame.f_back
+        return False
+
+    @staticmethod
+    def _stack(frame, thread_name: str) -> str:
+        names = []
+        while frame is not None:
+            code = frame.f_code
+            names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+            frame = frame.f_back
+        names.append(thread_name)
+        return ";".join(reversed(names))
+
+    def folded(self) -> list:
+        """Строки в формате folded stacks: "стек количество"."""
+        return [f"{stack} {count}" for stack, count in self.stacks.most_common()]
+
+
+class ProfileSession:
+    """Профиль одного задания с тегами (добавляются в имя файла)."""
+
+    def __init__(self, directory: str, name: str, tags: dict, interval: float = DEFAULT_INTERVAL, scoped: bool = False):
+        self.directory = directory
+        self.name = name
+        self.tags = dict(tags)
+        self.profiler = Profiler(interval, scoped)
+        self.path = None
+        self._token = None
+
+    def __enter__(self):
+        self.start = time.time()
+        self._perf = time.perf_counter()
+        self._token = _current.set(self)
+        self.profiler.anchors.add(sys._getframe(1))  # кадр задания (with profile(...) в нем)
+        self.profiler.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler.stop()
+        _current.reset(self._token)
+        duration = time.perf_counter() - self._perf
+        try:
+            self.save(duration)
+        except OSError as e:
+            log.warning(f"Не удалось сохранить профиль: {e}")
+        return False
+
+    def save(self, duration: float):
+        os.makedirs(self.directory, exist_ok=True)
+        tags = "".join(f"_{key}-{value}" for key, value in self.tags.items())
+        stamp = time.strftime("%Y%m%d-%H%M%S", time.localtime(self.start))
+        self.path = os.path.join(self.directory, f"{stamp}_{self.name}{tags}_{os.getpid()}.folded")
+        with open(self.path, "w", encoding="utf-8") as f:
+            f.write("\n".join(self.profiler.folded()) + "\n")
+        record = {"file": os.path.basename(self.path), "name": self.name, "start": self.start,
+                  "duration": round(duration, 3), "samples": self.profiler.samples, "tags": self.tags}
+        with open(os.path.join(self.directory, "profiles.jsonl"), "a", encoding="utf-8") as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        log.info(f"Профиль сохранен: {self.path} ({duration:.1f} с, снимков: {self.profiler.samples})")
+
+
+def profile(directory: str, name: str, scoped: bool = False, **tags) -> ProfileSession:
+    """Профиль задания name (контекстный менеджер), сохраняется в каталог directory.
+
+    scoped - только стеки задания (кадр, в котором открыт профиль, и run_attached), иначе весь процесс.
+    """
+    return ProfileSession(directory, name, tags, scoped=scoped)
+
+
+def current_profile():
+    return _current.get()
+
+
+def run_attached(function, *args, **kwargs):
+    """Выполняет function в текущем потоке как часть профилируемого задания (см. kinolist_trace.bind)."""
+    session = _current.get()
+    if session is None:
+        return function(*args, **kwargs)
+    frame = sys._getframe()
+    session.profiler.anchors.add(frame)
+    try:
+        return function(*args, **kwargs)
+    finally:
+        session.profiler.anchors.discard(frame)
+
+
+def tag(**tags):
+    """Добавляет теги к профилю текущего задания (если задание профилируется)."""
+    session = _current.get()
+    if session is not None:
+        session.tags.update(tags)
+
+
+def configure_sampling(every: int, directory: str = "profiles"):
+    """Профилирование каждого every-го задания бота (0 - отключено)."""
+    global sample_every, sample_directory
+    sample_every = every
+    sample_directory = directory
+
+
+def sampled(name: str):
+    """Декоратор задания: профилирует каждый sample_every-й вызов (см. configure_sampling)."""
+    def decorator(function):
+        if inspect.iscoroutinefunction(function):
+            @functools.wraps(function)
+            async def async_wrapper(*args, **kwargs):
+                if not sample_every or next(_jobs) % sample_every:
+                    return await function(*args, **kwargs)
+                with profile(sample_directory, name, scoped=True):
+                    return await function(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not sample_every or next(_jobs) % sample_every:
+                return function(*args, **kwargs)
+            with profile(sample_directory, name, scoped=True):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,302 @@
+import base64
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import zipfile
+
+log = logging.getLogger("Storage")
+
+
+class StateBackend:
+    """Общее хранилище состояния для нескольких процессов.
+
+    Хранит пары ключ-значение по пространствам имен (состояния FSM, кэши фильмов и поиска),
+    блокировки заданий и очередь входящих обновлений, распределенных по воркерам.
+    Значения - объекты, сериализуемые в json, или bytes.
+    """
+
+    def get(self, namespace: str, key: str, default=None):
+        raise NotImplementedError
+
+    def get_entry(self, namespace: str, key: str):
+        """Запись вместе со временем сохранения и истечения срока: (value, stored, expires) или None.
+
+        В отличие от get, возвращает и устаревшие записи.
+        """
+        raise NotImplementedError
+
+    def set(self, namespace: str, key: str, value, ttl: float = None):
+        raise NotImplementedError
+
+    def set_entry(self, namespace: str, key: str, value, stored: float, expires: float = None):
+        """Сохраняет запись с заданными временем сохранения и истечения срока (для импорта)."""
+        raise NotImplementedError
+
+    def items(self, namespace: str):
+        """Все записи пространства имен: (key, value, stored, expires)."""
+        raise NotImplementedError
+
+    def delete(self, namespace: str, key: str):
+        raise NotImplementedError
+
+    def incr(self, namespace: str, key: str, amount: int = 1, ttl: float = None) -> int:
+        """Атомарно увеличивает числовое значение и возвращает новое."""
+        raise NotImplementedError
+
+    def acquire_lock(self, name: str, owner: str, ttl: float) -> bool:
+        raise NotImplementedError
+
+    def release_lock(self, name: str, owner: str = None):
+        raise NotImplementedError
+
+    def push_update(self, shard: int, payload: dict):
+        raise NotImplementedError
+
+    def pop_updates(self, shard: int, limit: int = 20) -> list:
+        raise NotImplementedError
+
+    def pending_updates(self) -> int:
+        """Количество обновлений в очередях всех воркеров."""
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class SQLiteBackend(StateBackend):
+    """Хранилище на SQLite в режиме WAL.
+
+    Одна база данных может использоваться одновременно несколькими процессами на одной машине.
+    Соединения создаются отдельно для каждого потока и процесса.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        self._init_db()
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _init_db(self):
+        conn = self._conn()
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS kv (
+                namespace TEXT NOT NULL,
+                key TEXT NOT NULL,
+                kind TEXT NOT NULL,
+                value BLOB,
+                stored REAL NOT NULL,
+                expires REAL,
+                PRIMARY KEY (namespace, key)
+            );
+            CREATE TABLE IF NOT EXISTS locks (
+                name TEXT PRIMARY KEY,
+                owner TEXT NOT NULL,
+                expires REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS updates (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                shard INTEGER NOT NULL,
+                payload TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS updates_shard ON updates (shard, id);
+        """)
+
+    @staticmethod
+    def _encode(value):
+        if isinstance(value, (bytes, bytearray)):
+            return "bytes", bytes(value)
+        return "json", json.dumps(value, ensure_ascii=False).encode()
+
+    @staticmethod
+    def _decode(kind, value):
+        if kind == "bytes":
+            return bytes(value)
+        return json.loads(value)
+
+    def get(self, namespace, key, default=None):
+        row = self._conn().execute("SELECT kind, value, expires FROM kv WHERE namespace=? AND key=?",
+                                   (namespace, str(key))).fetchone()
+        if row is None:
+            return default
+        kind, value, expires = row
+        if expires is not None and expires < time.time():
+            return default
+        return self._decode(kind, value)
+
+    def get_entry(self, namespace, key):
+        row = self._conn().execute("SELECT kind, value, stored, expires FROM kv WHERE namespace=? AND key=?",
+                                   (namespace, str(key))).fetchone()
+        if row is None:
+            return None
+        kind, value, stored, expires = row
+        return self._decode(kind, value), stored, expires
+
+    def set(self, namespace, key, value, ttl=None):
+        now = time.time()
+        self.set_entry(namespace, key, value, now, now + ttl if ttl else None)
+
+    def set_entry(self, namespace, key, value, stored, expires=None):
+        kind, data = self._encode(value)
+        self._conn().execute("INSERT OR REPLACE INTO kv (namespace, key, kind, value, stored, expires) VALUES (?, ?, ?, ?, ?, ?)",
+                             (namespace, str(key), kind, data, stored, expires))
+
+    def items(self, namespace):
+        rows = self._conn().execute("SELECT key, kind, value, stored, expires FROM kv WHERE namespace=? ORDER BY key",
+                                    (namespace,))
+        for key, kind, value, stored, expires in rows:
+            yield key, self._decode(kind, value), stored, expires
+
+    def delete(self, namespace, key):
+        self._conn().execute("DELETE FROM kv WHERE namespace=? AND key=?", (namespace, str(key)))
+
+    def incr(self, namespace, key, amount=1, ttl=None):
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT kind, value, expires FROM kv WHERE namespace=? AND key=?",
+                               (namespace, str(key))).fetchone()
+            if row is None or (row[2] is not None and row[2] < time.time()):
+                value = amount
+            else:
+                value = self._decode(row[0], row[1]) + amount
+            self.set(namespace, key, value, ttl)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return value
+
+    def acquire_lock(self, name, owner, ttl):
+        conn = self._conn()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT owner, expires FROM locks WHERE name=?", (name,)).fetchone()
+            if row and row[1] > now and row[0] != owner:
+                conn.execute("COMMIT")
+                return False
+            conn.execute("INSERT OR REPLACE INTO locks (name, owner, expires) VALUES (?, ?, ?)", (name, owner, now + ttl))
+            conn.execute("COMMIT")
+            return True
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def release_lock(self, name, owner=None):
+        if owner is None:
+            self._conn().execute("DELETE FROM locks WHERE name=?", (name,))
+        else:
+            self._conn().execute("DELETE FROM locks WHERE name=? AND owner=?", (name, owner))
+
+    def push_update(self, shard, payload):
+        self._conn().execute("INSERT INTO updates (shard, payload) VALUES (?, ?)",
+                             (shard, json.dumps(payload, ensure_ascii=False)))
+
+    def pop_updates(self, shard, limit=20):
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            rows = conn.execute("SELECT id, payload FROM updates WHERE shard=? ORDER BY id LIMIT ?", (shard, limit)).fetchall()
+            if rows:
+                conn.executemany("DELETE FROM updates WHERE id=?", [(row[0],) for row in rows])
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return [json.loads(row[1]) for row in rows]
+
+    def pending_updates(self):
+        return self._conn().execute("SELECT COUNT(*) FROM updates").fetchone()[0]
+
+    def close(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None and self._local.pid == os.getpid():
+            conn.close()
+        self._local.conn = None
+
+
+def export_bundle(backend: StateBackend, path: str, namespaces: list) -> dict:
+    """Сохраняет пространства имен хранилища в переносимый архив zip.
+
+    Returns:
+        dict: количество записей по пространствам имен
+    """
+    counts = {}
+    with zipfile.ZipFile(path, "w", compression=zipfile.ZIP_DEFLATED) as bundle:
+        for namespace in namespaces:
+            lines = []
+            for key, value, stored, expires in backend.items(namespace):
+                if isinstance(value, bytes):
+                    record = {"key": key, "bytes": base64.b64encode(value).decode(), "stored": stored, "expires": expires}
+                else:
+                    record = {"key": key, "value": value, "stored": stored, "expires": expires}
+                lines.append(json.dumps(record, ensure_ascii=False))
+            bundle.writestr(f"{namespace}.jsonl", "\n".join(lines))
+            counts[namespace] = len(lines)
+        bundle.writestr("manifest.json", json.dumps({"version": 1, "created": time.time(), "namespaces": counts}))
+    return counts
+
+
+def import_bundle(backend: StateBackend, path: str) -> dict:
+    """Загружает архив, созданный export_bundle. Существующие более новые записи не заменяются.
+
+    Returns:
+        dict: количество загруженных записей по пространствам имен
+    """
+    counts = {}
+    with zipfile.ZipFile(path) as bundle:
+        manifest = json.loads(bundle.read("manifest.json"))
+        for namespace in manifest["namespaces"]:
+            counts[namespace] = 0
+            for line in bundle.read(f"{namespace}.jsonl").decode().splitlines():
+                record = json.loads(line)
+                current = backend.get_entry(namespace, record["key"])
+                if current is not None and current[1] >= record["stored"]:
+                    continue
+                if "bytes" in record:
+                    value = base64.b64decode(record["bytes"])
+                else:
+                    value = record["value"]
+                backend.set_entry(namespace, record["key"], value, record["stored"], record["expires"])
+                counts[namespace] += 1
+    return counts
+
+
+# Схемы адресов хранилищ. Сетевые хранилища (например, redis://) регистрируются через register_backend.
+BACKENDS = {
+    "sqlite": SQLiteBackend,
+}
+
+
+def register_backend(scheme: str, backend_class):
+    """Регистрирует класс хранилища для схемы адреса scheme://"""
+    BACKENDS[scheme] = backend_class
+
+
+def open_backend(url: str) -> StateBackend:
+    """Открывает хранилище по адресу вида sqlite:///path/to/state.db
+
+    Адрес без схемы считается путем к базе данных SQLite.
+    """
+    if "://" not in url:
+        return SQLiteBackend(url)
+    scheme, location = url.split("://", 1)
+    if scheme not in BACKENDS:
+        raise ValueError(f"Неизвестный тип хранилища: {scheme}")
+    if scheme == "sqlite":
+        # sqlite:///state.db -> state.db, sqlite:////abs/state.db -> /abs/state.db
+        location = location[1:] if location.startswith("/") else location
+    log.info(f"Хранилище состояния: {url}")
+    return BACKENDS[scheme](location)
@@ -0,0 +1,206 @@
+"""Трассировка заданий: вложенные интервалы (spans) с длительностью и атрибутами.
+
+Каждое задание (сообщение боту, запуск kl) получает идентификатор трассировки. Этапы задания
+(поиск каждого названия, загрузка информации о фильме и ее части, запись docx, конвертация, отправка)
+записываются как вложенные интервалы. Завершенные трассировки сохраняются в файл в формате json lines,
+трассировки дольше порога - дополнительно в журнал медленных запросов в виде дерева.
+
+    with trace("pdf", chat_id=chat_id):
+        with span("search", query=title):
+            ...
+
+Идентификатор трассировки добавляется в записи лога (%(trace_id)s, см. install_log_factory).
+Вне трассировки span ничего не записывает.
+"""
+import contextvars
+import functools
+import inspect
+import json
+import logging
+import threading
+import time
+import uuid
+
+from kinolist_profile import run_attached
+
+log = logging.getLogger("Trace")
+slow_log = logging.getLogger("Slow")
+
+_current = contextvars.ContextVar("kinolist_span", default=None)
+_write_lock = threading.Lock()
+
+# Настройки (см. configure)
+trace_file = None
+slow_threshold = None
+slow_file = None
+
+
+def configure(file: str = None, slow: float = None, slow_log_file: str = None):
+    """Настройка записи трассировок.
+
+    Args:
+        file (str, optional): файл для завершенных трассировок (json lines)
+        slow (float, optional): порог длительности задания, с; более долгие задания записываются в журнал медленных запросов
+        slow_log_file (str, optional): файл журнала медленных запросов (по умолчанию - только лог)
+    """
+    global trace_file, slow_threshold, slow_file
+    trace_file = file
+    slow_threshold = slow
+    slow_file = slow_log_file
+
+
+class Span:
+    __slots__ = ("name", "attrs", "trace_id", "span_id", "start", "duration", "children", "_perf")
+
+    def __init__(self, name: str, attrs: dict, trace_id: str):
+        self.name = name
+        self.attrs = attrs
+        self.trace_id = trace_id
+        self.span_id = uuid.uuid4().hex[:8]
+        self.start = time.time()
+        self.duration = None
+        self.children = []
+        self._perf = time.perf_counter()
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def finish(self):
+        self.duration = time.perf_counter() - self._perf
+
+    def to_dict(self) -> dict:
+        return {
+            "name": self.name,
+            "span_id": self.span_id,
+            "start": round(self.start, 6),
+            "duration": round(self.duration or 0.0, 6),
+            "attrs": self.attrs,
+            "spans": [child.to_dict() for child in list(self.children)],
+        }
+
+    def tree(self, indent: int = 0) -> list:
+        """Дерево интервалов в виде строк текста."""
+        attrs = " ".join(f"{key}={value}" for key, value in self.attrs.items())
+        lines = [f"{'  ' * indent}{self.name} {(self.duration or 0.0) * 1000:.1f} мс {attrs}".rstrip()]
+        for child in list(self.children):
+            lines.extend(child.tree(indent + 1))
+        return lines
+
+
+def current_span():
+    return _current.get()
+
+
+def current_trace_id() -> str:
+    current = _current.get()
+    return current.trace_id if current is not None else "-"
+
+
+def annotate(**attrs):
+    """Добавляет атрибуты в текущий интервал."""
+    current = _current.get()
+    if current is not None:
+        current.set(**attrs)
+
+
+class _SpanContext:
+    """Контекстный менеджер и декоратор интервала (root=True - начало новой трассировки)."""
+
+    def __init__(self, name: str, attrs: dict, root: bool):
+        self.name = name
+        self.attrs = attrs
+        self.root = root
+        self.span = None
+        self.token = None
+
+    def __enter__(self):
+        parent = _current.get()
+        if parent is None and not self.root:
+            return None
+        trace_id = parent.trace_id if parent is not None else uuid.uuid4().hex[:16]
+        self.span = Span(self.name, dict(self.attrs), trace_id)
+        if parent is not None:
+            parent.children.append(self.span)
+        self.token = _current.set(self.span)
+        return self.span
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.span is None:
+            return False
+        self.span.finish()
+        if exc_type is not None:
+            self.span.attrs["error"] = f"{exc_type.__name__}: {exc}"
+        _current.reset(self.token)
+        if self.root and _current.get() is None:
+            export(self.span)
+        return False
+
+    def __call__(self, function):
+        name, attrs, root = self.name, self.attrs, self.root
+        if inspect.iscoroutinefunction(function):
+            @functools.wraps(function)
+            async def async_wrapper(*args, **kwargs):
+                with _SpanContext(name, attrs, root):
+                    return await function(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with _SpanContext(name, attrs, root):
+                return function(*args, **kwargs)
+        return wrapper
+
+
+def span(name: str, **attrs):
+    """Вложенный интервал текущей трассировки (контекстный менеджер или декоратор)."""
+    return _SpanContext(name, attrs, root=False)
+
+
+def trace(name: str, **attrs):
+    """Начало трассировки задания (внутри другой трассировки - вложенный интервал)."""
+    return _SpanContext(name, attrs, root=True)
+
+
+def bind(function):
+    """Функция для выполнения в другом потоке в контексте текущей трассировки (например, executor.submit).
+
+    Если задание профилируется, стеки этого потока попадают в его профиль (см. kinolist_profile.run_attached).
+    """
+    context = contextvars.copy_context()
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        # копия на каждый вызов: один контекст нельзя использовать одновременно в нескольких потоках
+        return context.copy().run(run_attached, function, *args, **kwargs)
+    return wrapper
+
+
+def export(root: Span):
+    """Записывает завершенную трассировку в файл и, если она дольше порога, в журнал медленных запросов."""
+    record = root.to_dict()
+    record["trace_id"] = root.trace_id
+    if trace_file:
+        line = json.dumps(record, ensure_ascii=False, default=str)
+        with _write_lock, open(trace_file, "a", encoding="utf-8") as f:
+            f.write(line + "\n")
+    if slow_threshold is not None and root.duration >= slow_threshold:
+        text = "\n".join(root.tree())
+        slow_log.warning(f"Медленное задание {root.trace_id} ({root.duration:.2f} с):\n{text}")
+        if slow_file:
+            with _write_lock, open(slow_file, "a", encoding="utf-8") as f:
+                f.write(f"[{time.strftime('%d.%m.%Y %H:%M:%S', time.localtime(root.start))}] {root.trace_id}\n{text}\n\n")
+
+
+def install_log_factory():
+    """Добавляет в записи лога атрибут trace_id (идентификатор текущей трассировки или "-")."""
+    factory = logging.getLogRecordFactory()
+    if getattr(factory, "kinolist_trace", False):
+        return
+
+    def record_factory(*args, **kwargs):
+        record = factory(*args, **kwargs)
+        record.trace_id = current_trace_id()
+        return record
+
+    record_factory.kinolist_trace = True
+    logging.setLogRecordFactory(record_factory)
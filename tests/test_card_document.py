@@ -0,0 +1,86 @@
+"""Структура документа CardDocument после /add, /remove и /move: за каждой таблицей-карточкой идет
+пустой абзац-разделитель (соседние таблицы Word и Libre Office объединяют в одну)."""
+import os
+import sys
+import tempfile
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault("TQDM_DISABLE", "1")
+
+from PIL import Image  # noqa: E402
+
+from kinolist_lib import CardDocument  # noqa: E402
+
+
+def make_film(kp_id: int) -> list:
+    poster = Image.new("RGB", (300, 450), (kp_id % 256, 0, 0))
+    return [f"Фильм {kp_id}", "2000", "7.5", ["США"], "Описание", "Описание", None, ["Режиссер"], ["Актер"],
+            poster, kp_id]
+
+
+def layout(card: CardDocument) -> str:
+    """Элементы тела документа: T - таблица, P - абзац (w:sectPr не учитывается)."""
+    tags = [element.tag.rsplit("}", 1)[-1] for element in card.document.element.body]
+    return " ".join({"tbl": "T", "p": "P"}[tag] for tag in tags if tag != "sectPr")
+
+
+class CardDocumentLayoutTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.TemporaryDirectory()
+        self.card = CardDocument(os.path.join(ROOT, "template.docx"))
+        self.card.build([make_film(kp_id) for kp_id in (1, 2, 3)], os.path.join(self.workdir.name, "list.docx"))
+
+    def tearDown(self):
+        self.workdir.cleanup()
+
+    def assertCards(self, codes: list):
+        self.assertEqual(self.card.codes, codes)
+        self.assertEqual(layout(self.card), " ".join(["T P"] * len(codes)))
+        self.assertEqual([table.cell(0, 1).text.split(" - ")[0] for table in self.card.document.tables],
+                         [f"Фильм {kp_id}" for kp_id in codes])
+
+    def test_build(self):
+        self.assertCards([1, 2, 3])
+
+    def test_move(self):
+        self.card.move(2, 0)
+        self.assertCards([3, 1, 2])
+        self.card.move(0, 2)
+        self.assertCards([1, 2, 3])
+        self.card.move(1, 2)
+        self.assertCards([1, 3, 2])
+
+    def test_remove(self):
+        self.card.remove(2)
+        self.assertCards([1, 2])
+        self.card.remove(0)
+        self.assertCards([2])
+
+    def test_add(self):
+        self.card.add([make_film(4)])
+        self.assertCards([1, 2, 3, 4])
+
+    def test_move_then_remove_and_add(self):
+        self.card.move(2, 0)
+        self.card.remove(0)
+        self.assertCards([1, 2])
+        self.card.add([make_film(5), make_film(6)])
+        self.card.move(3, 1)
+        self.assertCards([1, 6, 2, 5])
+        self.card.remove(3)
+        self.assertCards([1, 6, 2])
+
+    def test_save_after_edit(self):
+        self.card.move(2, 0)
+        self.card.remove(1)
+        path = os.path.join(self.workdir.name, "edited.docx")
+        self.card.save(path)
+        from docx import Document
+        self.assertEqual(len(Document(path).tables), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,96 @@
+"""LiveList.update: при добавлении, удалении, переименовании и изменении файлов перезаписываются только
+карточки этих файлов, порядок карточек совпадает с порядком файлов."""
+import os
+import sys
+import tempfile
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault("TQDM_DISABLE", "1")
+
+from PIL import Image  # noqa: E402
+
+from kinolist_library import LiveList  # noqa: E402
+
+
+class FakeTagIndex:
+    """Теги файлов: название фильма - первая строка файла."""
+
+    def __init__(self):
+        self.reads = []
+        self.forgotten = []
+
+    def read(self, file):
+        self.reads.append(os.path.basename(file))
+        with open(file, encoding="utf-8") as f:
+            title = f.readline().strip()
+        if not title:
+            return None
+        return [title, "2000", "7.5", ["США"], "Описание", "Описание", None, ["Режиссер"], ["Актер"],
+                Image.new("RGB", (360, 540), (len(title) * 10 % 256, 0, 0)), title]
+
+    def read_all(self, files, jobs=8):
+        return [self.read(file) for file in files]
+
+    def forget(self, files):
+        self.forgotten.extend(os.path.basename(file) for file in files)
+
+
+class LiveListTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.TemporaryDirectory()
+        self.index = FakeTagIndex()
+        self.live = LiveList(self.index, os.path.join(self.workdir.name, "list.docx"), os.path.join(ROOT, "template.docx"))
+
+    def tearDown(self):
+        self.workdir.cleanup()
+
+    def write(self, name, title):
+        path = os.path.join(self.workdir.name, name)
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(title + "\n")
+        stat = os.stat(path)
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))  # новая подпись файла
+        return path
+
+    def files(self):
+        return sorted(os.path.join(self.workdir.name, name) for name in os.listdir(self.workdir.name)
+                      if name.endswith(".mp4"))
+
+    def assertCards(self, titles):
+        self.assertEqual(self.live.card.codes, titles)
+        self.assertEqual([table.cell(0, 1).text.split(" - ")[0] for table in self.live.card.document.tables], titles)
+        tags = [element.tag.rsplit("}", 1)[-1] for element in self.live.card.document.element.body]
+        self.assertEqual([tag for tag in tags if tag != "sectPr"], ["tbl", "p"] * len(titles))
+
+    def test_update_only_affected_cards(self):
+        for name, title in (("a.mp4", "A"), ("c.mp4", "C"), ("e.mp4", "E")):
+            self.write(name, title)
+        self.live.build(self.files())
+        self.assertCards(["A", "C", "E"])
+
+        self.index.reads.clear()
+        self.write("b.mp4", "B")
+        self.live.update(self.files())
+        self.assertCards(["A", "B", "C", "E"])
+        self.assertEqual(self.index.reads, ["b.mp4"])
+
+        self.index.reads.clear()
+        os.remove(os.path.join(self.workdir.name, "c.mp4"))
+        os.rename(os.path.join(self.workdir.name, "a.mp4"), os.path.join(self.workdir.name, "f.mp4"))
+        self.write("e.mp4", "E2")
+        self.live.update(self.files())
+        self.assertCards(["B", "E2", "A"])
+        self.assertEqual(sorted(self.index.reads), ["e.mp4", "f.mp4"])
+        self.assertEqual(sorted(self.index.forgotten), ["a.mp4", "c.mp4"])
+
+        self.index.reads.clear()
+        self.live.update(self.files())
+        self.assertEqual(self.index.reads, [])
+        self.assertTrue(os.path.isfile(self.live.output))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,60 @@
+"""render_formats: docx и pdf по разным шаблонам создаются параллельно из одних и тех же фильмов
+(постеры из кэша - лениво открытые изображения PIL)."""
+import io
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault("TQDM_DISABLE", "1")
+
+from PIL import Image  # noqa: E402
+
+import kinolist_lib  # noqa: E402
+
+
+def make_film(kp_id: int) -> list:
+    poster = io.BytesIO()
+    Image.effect_noise((360, 540), 64 + kp_id).convert("RGB").save(poster, format="JPEG", quality=95)
+    info = [f"Фильм {kp_id}", "2000", "7.5", ["США"], "Описание", "Описание", None, ["Режиссер"], ["Актер"],
+            None, kp_id]
+    return kinolist_lib.film_from_record(info, poster.getvalue())
+
+
+def fake_docx_to_pdf(path_docx: str, libre: bool = True) -> str:
+    path_pdf = os.path.splitext(path_docx)[0] + ".pdf"
+    shutil.copy(path_docx, path_pdf)
+    return path_pdf
+
+
+class RenderFormatsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.TemporaryDirectory()
+        self.cwd = os.getcwd()
+        os.chdir(ROOT)  # шаблоны ищутся через get_resource_path
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.workdir.cleanup()
+
+    def test_docx_and_pdf_with_different_templates(self):
+        from docx import Document
+        output = os.path.join(self.workdir.name, "list.docx")
+        for attempt in range(5):
+            kinolist_lib._poster_files.clear()
+            films = [make_film(attempt * 10 + kp_id) for kp_id in range(8)]
+            with mock.patch.object(kinolist_lib, "docx_to_pdf", fake_docx_to_pdf):
+                result = kinolist_lib.render_formats(films, ["docx", "pdf"], output, "template.docx",
+                                                     "template_libre.docx", libre=True)
+            self.assertEqual(result, {"docx": output, "pdf": os.path.join(self.workdir.name, "list.pdf")})
+            self.assertEqual(len(Document(result["docx"]).tables), len(films))
+            self.assertEqual(len(Document(result["pdf"]).tables), len(films))
+
+
+if __name__ == "__main__":
+    unittest.main()